@@ -0,0 +1,79 @@
+"""Compares the cost of deciding whether a path is protected with the compiled rules of ucamwebauth.access and with a
+list of regular expressions matched one by one (as login-required middlewares usually do), for growing numbers of
+rules, and measures RavenLoginRequiredMiddleware with the largest set.
+
+    python benchmarks/bench_access.py [-n 20000] [--rules 10 100 500 1000]
+"""
+import argparse
+import random
+import re
+
+import common
+
+common.setup()
+
+from django.contrib.auth.models import AnonymousUser  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+from ucamwebauth.access import PathRules  # noqa: E402
+from ucamwebauth.middleware import RavenLoginRequiredMiddleware  # noqa: E402
+
+
+def make_rules(number, seed=0):
+    """Returns number protected prefixes, with an exempt prefix under every tenth, a few regular expressions of each
+    kind, and paths that match the rules near the start, the end and none of them"""
+    rng = random.Random(seed)
+    protected = ['/app%d/' % i for i in range(number)]
+    exempt = ['/app%d/public/' % i for i in range(0, number, 10)]
+    protected += ['^/api/v%d/private/' % i for i in range(3)]
+    exempt += [r'^/static/.*\.css$', r'^/media/']
+    paths = ['/app%d/page/%d' % (rng.randrange(number), i) for i in range(50)]
+    paths += ['/app%d/public/page' % (rng.randrange(0, number, 10)) for i in range(20)]
+    paths += ['/other/page/%d' % i for i in range(20)] + ['/static/site.css', '/api/v2/private/x']
+    return protected, exempt, paths
+
+
+class RegexList(object):
+    """The usual implementation: exempt patterns first, then protected ones, each matched in turn"""
+
+    def __init__(self, protected, exempt):
+        def regex(pattern):
+            return re.compile(pattern if pattern.startswith('^') else '^' + re.escape(pattern))
+        self.protected = [regex(pattern) for pattern in protected]
+        self.exempt = [regex(pattern) for pattern in exempt]
+
+    def is_protected(self, path):
+        if any(regex.match(path) for regex in self.exempt):
+            return False
+        return any(regex.match(path) for regex in self.protected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=20000, help='number of paths per case')
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 100, 500, 1000], help='numbers of rules')
+    args = parser.parse_args()
+
+    for number in args.rules:
+        protected, exempt, paths = make_rules(number)
+        compiled, listed = PathRules(protected, exempt), RegexList(protected, exempt)
+        assert [compiled.is_protected(path) for path in paths] == [listed.is_protected(path) for path in paths]
+        requests = [(paths[i % len(paths)], ) for i in range(args.n)]
+        common.bench('%d rules, compiled' % number, compiled.is_protected, requests)
+        common.bench('%d rules, one by one' % number, listed.is_protected, requests)
+
+    protected, exempt, paths = make_rules(max(args.rules))
+    with override_settings(UCAMWEBAUTH_PROTECTED_PATHS=protected, UCAMWEBAUTH_EXEMPT_PATHS=exempt):
+        middleware = RavenLoginRequiredMiddleware(lambda request: HttpResponse())
+        factory = RequestFactory()
+        requests = []
+        for i in range(args.n):
+            request = factory.get(paths[i % len(paths)])
+            request.user = AnonymousUser()
+            requests.append((request, ))
+        common.bench('middleware, %d rules' % max(args.rules), middleware, requests)
+
+
+if __name__ == '__main__':
+    main()
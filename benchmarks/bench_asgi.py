@@ -0,0 +1,91 @@
+"""Compares Raven logins (GET raven_return) served by the sync views under WSGI with the async views under ASGI, using
+Django's test clients: per-request latency, then throughput with concurrent requests (threads for WSGI, tasks for
+ASGI). The database is a temporary SQLite file, so that it can be used from any thread.
+
+    python benchmarks/bench_asgi.py [-n 500] [-c 8]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+
+_db = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+common.setup(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': _db.name, 'OPTIONS': {'timeout': 30}}},
+    SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+)
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.test import AsyncClient, Client  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+PRINCIPALS = ['bench%d' % i for i in range(50)]
+
+
+def responses(n):
+    return [common.make_response(raven_principal=PRINCIPALS[i % len(PRINCIPALS)]) for i in range(n)]
+
+
+def check(response):
+    assert response.status_code == 302 and response.url == '/', (response.status_code, response.content[:200])
+
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    print("%-30s p50 %7.2f ms  p99 %7.2f ms  %8.1f req/s  (%d requests)" %
+          (name, latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3,
+           len(latencies) / elapsed, len(latencies)))
+
+
+def wsgi(wls_responses, concurrency):
+    def login(wls_response):
+        client = Client()
+        start = time.perf_counter()
+        check(client.get('/raven_return/', {'WLS-Response': wls_response}))
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(login, wls_responses))
+    return latencies, time.perf_counter() - start
+
+
+async def asgi(wls_responses, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login(wls_response):
+        async with semaphore:
+            start = time.perf_counter()
+            check(await AsyncClient().get('/raven_return/', {'WLS-Response': wls_response}))
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(login(wls_response) for wls_response in wls_responses))
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=500, help='number of requests per run')
+    parser.add_argument('-c', type=int, default=8, help='number of concurrent requests')
+    args = parser.parse_args()
+
+    # Create the users and their profiles, so that every run measures logins by existing users
+    wsgi(responses(len(PRINCIPALS)), 1)
+    assert User.objects.filter(username__in=PRINCIPALS, profile__isnull=False).count() == len(PRINCIPALS)
+
+    for concurrency in (1, args.c):
+        report('WSGI, sync views, c=%d' % concurrency, *wsgi(responses(args.n), concurrency))
+        with override_settings(ROOT_URLCONF='ucamwebauth.async_urls'):
+            report('ASGI, async views, c=%d' % concurrency, *asyncio.run(asgi(responses(args.n), concurrency)))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        os.unlink(_db.name)
@@ -0,0 +1,59 @@
+"""Measures the cost of rejecting implausible WLS responses (GET raven_return) with and without
+RavenReturnGateMiddleware, through the whole middleware stack with Django's test client, and of a valid login with
+the gate in place. Logging is disabled: Django logs every 5xx response (rendering a traceback page for mail_admins),
+which would otherwise dominate both.
+
+    python benchmarks/bench_gate.py [-n 2000]
+"""
+import argparse
+import logging
+import time
+
+import common
+
+common.setup()
+
+from django.conf import settings  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+from django.urls import reverse  # noqa: E402
+
+GATE = 'ucamwebauth.middleware.RavenReturnGateMiddleware'
+ERRORS = 'ucamwebauth.middleware.DefaultErrorBehaviour'
+
+
+def flood():
+    stale = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(time.time() - 3600))
+    return {
+        'malformed': 'x' * 200,
+        'stale': common.make_response(raven_issue=stale),
+        'unknown kid': common.make_response(raven_kid='999'),
+        'wrong number of fields': '3!200!' + 'x' * 200,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=2000, help='number of requests per case')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    url = reverse('raven_return')
+    stacks = [('without gate', settings.MIDDLEWARE + [ERRORS]), ('with gate', [GATE] + settings.MIDDLEWARE + [ERRORS])]
+    for case, response_str in flood().items():
+        for label, middleware in stacks:
+            with override_settings(MIDDLEWARE=middleware):
+                client = Client()
+                requests = [(url, {'WLS-Response': response_str})] * args.n
+                assert client.get(*requests[0]).status_code == 500
+                common.bench('%s, %s' % (case, label), client.get, requests)
+
+    with override_settings(MIDDLEWARE=stacks[1][1]):
+        client = Client()
+        requests = [(url, {'WLS-Response': common.make_response(raven_id='id-%d' % i)}) for i in range(args.n)]
+        assert client.get(*requests[0]).status_code == 302
+        common.bench('valid login, with gate', client.get, requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Microbenchmark of raven_login, which builds the redirect to the WLS, against the previous implementation.
+
+    python benchmarks/bench_login.py [-n 50000]
+"""
+import argparse
+from urllib.parse import urlencode
+
+import common
+
+common.setup()
+
+from django.test import RequestFactory  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from ucamwebauth.conf import get_settings  # noqa: E402
+from ucamwebauth.utils import HttpResponseSeeOther  # noqa: E402
+from ucamwebauth.views import raven_login  # noqa: E402
+
+
+def legacy_raven_login(request):
+    """raven_login before the URLs were cached per host"""
+    config = get_settings()
+    return_url = config.return_url
+    if return_url is None:
+        return_url = request.build_absolute_uri(reverse('raven_return'))
+    next_p = request.GET.get('next', None)
+    if next_p is not None:
+        params = urlencode([('next', next_p)])
+        msg = urlencode([('ver', 3), ('url', return_url), ('desc', config.desc), ('iact', config.iact),
+                         ('msg', config.msg), ('params', params), ('fail', config.fail)])
+    else:
+        msg = urlencode([('ver', 3), ('url', return_url), ('desc', config.desc), ('iact', config.iact),
+                         ('msg', config.msg), ('fail', config.fail)])
+    return HttpResponseSeeOther("%s?%s" % (config.login_url, msg))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=50000, help='number of iterations')
+    args = parser.parse_args()
+
+    factory = RequestFactory()
+    for query in ({}, {'next': '/some/page?x=1'}):
+        requests = [(factory.get('/accounts/login/raven', query),)] * args.n
+        assert legacy_raven_login(*requests[0])['Location'] == raven_login(*requests[0])['Location']
+        label = 'with next' if query else 'without next'
+        common.bench('raven_login (legacy), %s' % label, legacy_raven_login, requests)
+        common.bench('raven_login, %s' % label, raven_login, requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Microbenchmark of the WLS-Response tokenizer and time parser against the previous implementation.
+
+    python benchmarks/bench_parser.py [-n 100000]
+"""
+import argparse
+import calendar
+import time
+from urllib.parse import unquote
+
+import common
+
+common.setup()
+
+from ucamwebauth.utils import parse_time, tokenize_response  # noqa: E402
+
+
+def legacy_tokenize(response_str):
+    """The tokenizing done by RavenResponse.__init__ before tokenize_response()"""
+    rawtokens = response_str.split('!')
+    tokens = list(map(unquote, rawtokens))
+    ver = int(tokens[0])
+    versioni = 0 if ver == 3 else 1
+    if len(tokens) != (14 - versioni):
+        raise ValueError("Wrong number of parameters")
+    data = '!'.join(rawtokens[0:(12 - versioni)]).encode()
+    return ver, tokens, data
+
+
+def legacy_parse_time(time_string):
+    return calendar.timegm(time.strptime(time_string, "%Y%m%dT%H%M%SZ"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=100000, help='number of iterations')
+    args = parser.parse_args()
+
+    responses = [(common.make_response(),), (common.make_response(raven_params='next=/a%2Fb', raven_msg='100%'),)]
+    for response in responses:
+        assert legacy_tokenize(*response) == tokenize_response(*response)
+    responses = responses * (args.n // 2)
+    common.bench('tokenize (legacy)', legacy_tokenize, responses)
+    common.bench('tokenize_response', tokenize_response, responses)
+
+    times = [('20110729T123456Z',)] * args.n
+    common.bench('parse_time (legacy, strptime)', legacy_parse_time, times)
+    common.bench('parse_time', parse_time, times)
+
+
+if __name__ == '__main__':
+    main()
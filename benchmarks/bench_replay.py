@@ -0,0 +1,52 @@
+"""Per-login cost of each replay cache backend.
+
+    python benchmarks/bench_replay.py [-n 2000]
+"""
+import argparse
+import time
+
+import common
+
+common.setup()
+
+from django.test import RequestFactory  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from ucamwebauth import RavenResponse  # noqa: E402
+from ucamwebauth.replay import CacheReplayCache, DatabaseReplayCache, LocMemReplayCache  # noqa: E402
+
+BACKENDS = [None, 'ucamwebauth.replay.LocMemReplayCache', 'ucamwebauth.replay.CacheReplayCache',
+            'ucamwebauth.replay.DatabaseReplayCache']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=2000, help='number of responses per backend')
+    args = parser.parse_args()
+
+    factory = RequestFactory()
+    url = reverse('raven_return')
+
+    print("RavenResponse construction (parse + verify + replay check):")
+    for backend in BACKENDS:
+        requests = [(factory.get(url, {'WLS-Response': common.make_response(raven_id='%s-%d' % (backend, i))}),)
+                    for i in range(args.n)]
+        config = {'BACKEND': backend} if backend else None
+        with override_settings(UCAMWEBAUTH_REPLAY_CACHE=config):
+            common.bench(backend or 'disabled', RavenResponse, requests)
+
+    print("\nadd() alone:")
+    now = int(time.time())
+    idents = [(now, str(i)) for i in range(args.n)]
+    for cache in (LocMemReplayCache(600), CacheReplayCache(600), DatabaseReplayCache(600)):
+        common.bench(type(cache).__name__, cache.add, idents)
+
+    print("\nLocMemReplayCache under a flood of %d responses (max_entries=10000):" % (args.n * 100))
+    cache = LocMemReplayCache(600, max_entries=10000)
+    idents = [(now, str(i)) for i in range(args.n * 100)]
+    common.bench('add', cache.add, idents)
+    print("entries held: %d" % len(cache._cache))
+
+
+if __name__ == '__main__':
+    main()
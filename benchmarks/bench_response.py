@@ -0,0 +1,40 @@
+"""Construction time and memory footprint of RavenResponse objects.
+
+    python benchmarks/bench_response.py [-n 5000]
+"""
+import argparse
+import pickle
+import tracemalloc
+
+import common
+
+common.setup()
+
+from ucamwebauth import RavenResponse  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=5000, help='number of responses')
+    args = parser.parse_args()
+
+    cases = {
+        '200': common.make_response(raven_params='next=/somewhere'),
+        '410': common.make_response(raven_status='410', raven_principal='', raven_ptags='', raven_auth='',
+                                    raven_sig_input=False, raven_kid=''),
+    }
+    for name, raw in cases.items():
+        common.bench('RavenResponse (%s)' % name, RavenResponse, [(None, raw)] * args.n)
+
+    responses = [RavenResponse(response_str=cases['200']) for _ in range(args.n)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    copies = [pickle.loads(pickle.dumps(response)) for response in responses]
+    size = (tracemalloc.get_traced_memory()[0] - before) / len(copies)
+    tracemalloc.stop()
+    print("%-50s %10.0f bytes/object" % ('retained size (unpickled copies)', size))
+    print("%-50s %10d bytes" % ('pickled size', len(pickle.dumps(responses[0]))))
+
+
+if __name__ == '__main__':
+    main()
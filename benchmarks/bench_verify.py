@@ -0,0 +1,39 @@
+"""Signature verifications per second per core with each verifier in ucamwebauth.verifiers, and the overhead of
+shadow mode.
+
+    python benchmarks/bench_verify.py [-n 20000]
+"""
+import argparse
+
+import common
+
+common.setup()
+
+from django.conf import settings  # noqa: E402
+from ucamwebauth.utils import decode_sig, tokenize_response  # noqa: E402
+from ucamwebauth.verifiers import CryptographyVerifier, PyOpenSSLVerifier, ShadowVerifier  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=20000, help='number of verifications per verifier')
+    args = parser.parse_args()
+
+    ver, tokens, data = tokenize_response(common.make_response())
+    signature = decode_sig(tokens[-1])
+    pem = settings.UCAMWEBAUTH_CERTS[common.KID]
+
+    for verifier in (PyOpenSSLVerifier(), CryptographyVerifier(), ShadowVerifier()):
+        key = verifier.load_key(pem)
+        assert verifier.verify(key, signature, data)
+        name = type(verifier).__name__
+        mean = common.bench('%s.verify' % name, verifier.verify, [(key, signature, data)] * args.n)
+        print("%-50s %10.0f verifications/s/core" % ('', 1 / mean))
+        if isinstance(verifier, ShadowVerifier):
+            stats = verifier.stats()
+            print("%-50s %10d mismatches, pyOpenSSL %.1f us, cryptography %.1f us" %
+                  ('', stats['mismatches'], stats['primary_mean'] * 1e6, stats['shadow_mean'] * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Compares the database writes of logins (last_login and a changed raven_for_life) made immediately with those made
+by the write-behind buffer (UCAMWEBAUTH_WRITE_BEHIND, see ucamwebauth.writebehind), including the time to flush it,
+for n logins of a number of users. The database is a temporary SQLite file, so that the writes hit a disk.
+
+    python benchmarks/bench_writebehind.py [-n 5000] [--users 500]
+"""
+import argparse
+import os
+import tempfile
+
+import common
+
+database = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+common.setup(DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': database.name}})
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.contrib.auth.signals import user_logged_in  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+from ucamwebauth import writebehind  # noqa: E402
+from ucamwebauth.backends import RavenAuthBackend  # noqa: E402
+from ucamwebauth.models import UserProfile  # noqa: E402
+
+
+class WriteCounter(object):
+    """Counts the queries other than SELECTs. Unlike CaptureQueriesContext, it neither keeps the queries (nor stops at
+    9000 of them) nor turns on the debug cursor."""
+
+    def __init__(self):
+        self.writes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.lstrip().upper().startswith('SELECT'):
+            self.writes += 1
+        return execute(sql, params, many, context)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=5000, help='number of logins per case')
+    parser.add_argument('--users', type=int, default=500, help='number of distinct users')
+    args = parser.parse_args()
+
+    User.objects.bulk_create([User(username='bench%04d' % i) for i in range(args.users)])
+    UserProfile.objects.bulk_create([UserProfile(user=user, raven_for_life=False)
+                                     for user in User.objects.filter(username__startswith='bench')])
+    users = list(User.objects.select_related('profile').filter(username__startswith='bench'))
+    backend = RavenAuthBackend()
+
+    def login(user, raven_for_life):
+        backend.update_profile(user, raven_for_life)
+        user_logged_in.send(sender=User, request=None, user=user)
+
+    # raven_for_life flips at every login of a user, the worst case for the profile
+    logins = [(users[i % len(users)], bool(i // len(users) % 2)) for i in range(args.n)]
+    for label, enabled in (('immediate', False), ('write-behind', True)):
+        with override_settings(UCAMWEBAUTH_WRITE_BEHIND=enabled, UCAMWEBAUTH_WRITE_BEHIND_INTERVAL=3600,
+                               UCAMWEBAUTH_WRITE_BEHIND_BATCH_SIZE=args.n * 2):
+            counter = WriteCounter()
+            with connection.execute_wrapper(counter):
+                per_login = common.bench('%s, logins' % label, login, logins)
+                if enabled:
+                    flush = common.bench('%s, flush' % label, writebehind.flush, [()])
+                    print("%-50s %10.1f us/op" % ('%s, total per login' % label, per_login * 1e6 + flush * 1e6 / args.n))
+            print("%-50s %10d" % ('%s, write queries' % label, counter.writes))
+    os.remove(database.name)
+
+
+if __name__ == '__main__':
+    main()
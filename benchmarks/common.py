@@ -0,0 +1,94 @@
+"""Shared set-up for the benchmark scripts in this directory.
+
+setup() configures a minimal Django project with an in-memory database that trusts the test key used by
+ucamwebauth.tests (kid 901), so that valid WLS responses can be minted locally with make_response().
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+KID = 901
+
+
+def _certificate(key_pem):
+    """Returns a self-signed PEM certificate for the private key key_pem"""
+    from OpenSSL.crypto import FILETYPE_PEM, X509, dump_certificate, load_privatekey
+    key = load_privatekey(FILETYPE_PEM, key_pem)
+    cert = X509()
+    cert.get_subject().CN = 'ucamwebauth benchmark'
+    cert.set_issuer(cert.get_subject())
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return dump_certificate(FILETYPE_PEM, cert).decode()
+
+
+def setup(**overrides):
+    """Configures and sets up Django. overrides are extra (or replacement) settings."""
+    options = dict(
+        DEBUG=False,
+        SECRET_KEY='mock test value',
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        USE_TZ=True,
+        ROOT_URLCONF='ucamwebauth.urls',
+        ALLOWED_HOSTS=['testserver'],
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'django.contrib.messages',
+            'ucamwebauth',
+        ),
+        AUTHENTICATION_BACKENDS=('ucamwebauth.backends.RavenAuthBackend', ),
+        MIDDLEWARE=[
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.middleware.common.CommonMiddleware',
+            'django.middleware.csrf.CsrfViewMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+            'django.contrib.messages.middleware.MessageMiddleware',
+        ],
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates', 'APP_DIRS': True}],
+        UCAMWEBAUTH_LOGIN_URL='https://test.legacy.raven.cam.ac.uk/auth/authenticate.html',
+        UCAMWEBAUTH_CERTS={},
+        UCAMWEBAUTH_TIMEOUT=600,
+    )
+    options.update(overrides)
+    settings.configure(**options)
+    django.setup()
+
+    from django.core.management import call_command
+    from django.test.utils import override_settings, setup_test_environment
+    from ucamwebauth.tests import GOOD_PRIV_KEY_PEM
+
+    setup_test_environment()
+    call_command('migrate', verbosity=0)
+    # The test private key is only available once Django is set up. override_settings() (rather than assigning to
+    # settings) sends setting_changed, so the key registry picks the certificate up.
+    certs = dict(settings.UCAMWEBAUTH_CERTS)
+    certs[KID] = _certificate(GOOD_PRIV_KEY_PEM)
+    override_settings(UCAMWEBAUTH_CERTS=certs).enable()
+
+
+def make_response(**kwargs):
+    """Returns a WLS-Response signed with the test key. kwargs are passed to ucamwebauth.tests.create_wls_response,
+    with a current issue time by default."""
+    from ucamwebauth.tests import create_wls_response
+    kwargs.setdefault('raven_issue', time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()))
+    return create_wls_response(**kwargs)
+
+
+def bench(name, func, args_list):
+    """Calls func once for each tuple of arguments in args_list and prints the mean time per call"""
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    elapsed = time.perf_counter() - start
+    print("%-50s %10.1f us/op  (%d ops)" % (name, elapsed / len(args_list) * 1e6, len(args_list)))
+    return elapsed / len(args_list)
@@ -0,0 +1,150 @@
+"""Load test of the whole login flow: simulated users go through raven_login, a mock WLS (ucamwebauth.mockwls) and
+raven_return over HTTP, concurrently. Reports logins per second and latency percentiles of each step.
+
+Against a running site, whose UCAMWEBAUTH_LOGIN_URL points to a running mock WLS with a trusted key (see
+python -m ucamwebauth.mockwls --help):
+
+    python benchmarks/load_login.py --site http://127.0.0.1:8000 [-n 1000] [-c 8] [--users 100]
+
+Without --site, the script starts a mock WLS and the benchmark project (see common.py, with a temporary SQLite
+database) in threads of its own, so it needs nothing else. The client, the WLS and the site then share a process
+(and the GIL): the absolute numbers are lower than for separate processes, but are comparable between runs.
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+
+import requests
+
+STEPS = ('raven_login', 'wls', 'raven_return', 'total')
+
+
+class LoginError(Exception):
+    pass
+
+
+def start_local_site():
+    """Starts a mock WLS and the benchmark project in background threads
+    @return the URL of the site and the path of its database"""
+    from ucamwebauth.mockwls import MockWLS, serve_in_background
+    wls = MockWLS(kid=902)
+    wls_server = serve_in_background(wls)
+    database = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+    common.setup(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': database.name,
+                               'OPTIONS': {'timeout': 30}}},
+        ALLOWED_HOSTS=['127.0.0.1'],
+        UCAMWEBAUTH_LOGIN_URL='http://127.0.0.1:%d/auth/authenticate.html' % wls_server.server_port,
+        UCAMWEBAUTH_CERTS={902: wls.certificate_pem},
+    )
+
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+
+    class QuietWSGIRequestHandler(WSGIRequestHandler):
+        # Without TCP_NODELAY, responses written in several parts wait for delayed ACKs (~40ms each)
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietWSGIRequestHandler)
+    server.daemon_threads = True
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:%d' % server.server_port, database.name
+
+
+_local = threading.local()
+
+
+def login(site, login_path, principal, next_url):
+    """Logs principal in, following the redirects by hand
+    @return the time taken by each step (see STEPS)"""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        # One session (and connection pool) per thread. Its cookies are cleared for every login.
+        session = _local.session = requests.Session()
+    session.cookies.clear()
+
+    start = time.perf_counter()
+    response = session.get(site + login_path, params={'next': next_url}, allow_redirects=False)
+    if response.status_code != 303:
+        raise LoginError('raven_login returned %d' % response.status_code)
+    login_done = time.perf_counter()
+    response = session.get(response.headers['Location'], headers={'X-Mock-Principal': principal},
+                           allow_redirects=False)
+    if response.status_code != 303:
+        raise LoginError('the WLS returned %d' % response.status_code)
+    wls_done = time.perf_counter()
+    response = session.get(response.headers['Location'], allow_redirects=False)
+    if response.status_code != 302 or not response.headers['Location'].endswith(next_url):
+        raise LoginError('raven_return returned %d' % response.status_code)
+    end = time.perf_counter()
+    return login_done - start, wls_done - login_done, end - wls_done, end - start
+
+
+def percentile(ordered, percent):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--site', help='the URL of the site (default: start one locally)')
+    parser.add_argument('--login-path', default='/accounts/login/raven', help='the path of raven_login')
+    parser.add_argument('-n', type=int, default=1000, help='number of logins')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='number of concurrent users')
+    parser.add_argument('--users', type=int, default=100, help='number of distinct principals')
+    parser.add_argument('--principal-format', default='load%04d', help='principals are this %% the user number')
+    parser.add_argument('--next', default='/after/login', help='the page to return to after logging in')
+    args = parser.parse_args()
+
+    database = None
+    site = args.site
+    if site is None:
+        site, database = start_local_site()
+    site = site.rstrip('/')
+
+    # Warm up (and create the users) before measuring
+    for i in range(min(args.users, args.n)):
+        login(site, args.login_path, args.principal_format % i, args.next)
+
+    timings = []
+    errors = Counter()
+    errors_lock = threading.Lock()
+
+    def run(i):
+        try:
+            timings.append(login(site, args.login_path, args.principal_format % (i % args.users), args.next))
+        except (LoginError, requests.RequestException) as e:
+            with errors_lock:
+                errors[str(e) if isinstance(e, LoginError) else type(e).__name__] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(run, range(args.n)))
+    elapsed = time.perf_counter() - start
+
+    print("%d logins in %.2fs with %d concurrent users: %.1f logins/s, %d errors" %
+          (len(timings), elapsed, args.concurrency, len(timings) / elapsed, sum(errors.values())))
+    for error, number in errors.most_common():
+        print("    %6d  %s" % (number, error))
+    if timings:
+        print("%-14s %10s %10s %10s %10s" % ('step (ms)', 'p50', 'p90', 'p99', 'max'))
+        for index, step in enumerate(STEPS):
+            ordered = sorted(timing[index] for timing in timings)
+            print("%-14s %10.2f %10.2f %10.2f %10.2f" % (step, percentile(ordered, 50) * 1e3,
+                                                         percentile(ordered, 90) * 1e3,
+                                                         percentile(ordered, 99) * 1e3, ordered[-1] * 1e3))
+    if database is not None:
+        os.remove(database)
+
+
+if __name__ == '__main__':
+    main()
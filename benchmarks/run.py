@@ -0,0 +1,206 @@
+"""Benchmark suite for the login path: parsing, signature verification, RavenResponse, RavenAuthBackend.authenticate
+and the full raven_return view through the Django test client.
+
+For each case it reports latency percentiles, the memory allocated per call (tracemalloc) and the number of database
+queries per call. Results can be saved as JSON and compared with a previous run:
+
+    python benchmarks/run.py [-n 2000] [-k verify] [--json before.json]
+    python benchmarks/run.py --json after.json --compare before.json [--threshold 20]
+
+With --compare, the exit status is 1 if the median latency of any case regressed by more than --threshold percent.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from itertools import count, islice
+
+import common
+
+common.setup()
+
+import django  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client, RequestFactory  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from ucamwebauth import MalformedResponseError, RavenResponse  # noqa: E402
+from ucamwebauth.backends import RavenAuthBackend  # noqa: E402
+from ucamwebauth.keys import registry  # noqa: E402
+from ucamwebauth.utils import decode_sig, parse_time, tokenize_response  # noqa: E402
+from ucamwebauth.verifiers import get_verifier  # noqa: E402
+
+# The number of calls measured with tracemalloc and with the queries captured, which slow the calls down
+SAMPLE = 100
+
+
+def _status_410():
+    return common.make_response(raven_status='410', raven_principal='', raven_ptags='', raven_auth='',
+                                raven_sig_input=False, raven_kid='')
+
+
+def _parse_malformed(response_str):
+    try:
+        RavenResponse(response_str=response_str)
+    except MalformedResponseError:
+        pass
+    else:
+        raise AssertionError("the response was not rejected")
+
+
+_new_users = count()
+
+
+def _login_requests(n, principal=None):
+    """Returns n requests with a WLS response for principal or, by default, for a different new user each"""
+    factory = RequestFactory()
+    url = reverse('raven_return')
+    if principal is not None:
+        return [(factory.get(url, {'WLS-Response': common.make_response(raven_principal=principal)}),)] * n
+    return [(factory.get(url, {'WLS-Response': common.make_response(raven_principal='bench-new-%d' % i)}),)
+            for i in islice(_new_users, n)]
+
+
+def _raven_return(client, response_str):
+    response = client.get('/raven_return/', {'WLS-Response': response_str})
+    assert response.status_code == 302, response.status_code
+
+
+def cases(n):
+    """Returns (name, func, args_list) for each benchmark. Each call to func(*args) is one operation. args_list may
+    instead be a function returning a list of a given length, for cases whose arguments cannot be reused."""
+    backend = RavenAuthBackend()
+    response_200 = common.make_response(raven_params='next=/somewhere')
+    ver, tokens, data = tokenize_response(response_200)
+    certificate, signature = registry.get(common.KID), decode_sig(tokens[-1])
+    backend.authenticate(*_login_requests(1, 'bench-existing')[0])
+    client = Client()
+
+    yield 'tokenize_response', tokenize_response, [(response_200,)] * n
+    yield 'parse_time', parse_time, [(tokens[3],)] * n
+    yield 'verify signature', get_verifier().verify, [(certificate, signature, data)] * n
+    yield 'RavenResponse (200)', RavenResponse, [(None, response_200)] * n
+    yield 'RavenResponse (410)', RavenResponse, [(None, _status_410())] * n
+    yield 'RavenResponse (malformed)', _parse_malformed, [(response_200 + '!extra',)] * n
+    yield 'authenticate (new user)', backend.authenticate, _login_requests
+    yield 'authenticate (existing user)', backend.authenticate, _login_requests(n, 'bench-existing')
+    yield 'raven_return (test client)', _raven_return, [(client, common.make_response())] * n
+
+
+def _percentile(ordered, percent):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def measure(func, args_list, n):
+    """Calls func(*args) for each args in args_list (or in args_list(n) if it is callable) and returns the statistics
+    as a dictionary. Latencies are in microseconds and allocations in bytes."""
+    if callable(args_list):
+        timed_args, sampled_args, counted_args = args_list(n), args_list(SAMPLE), args_list(SAMPLE)
+    else:
+        timed_args, sampled_args = args_list, args_list[:SAMPLE]
+        counted_args = sampled_args
+
+    latencies = []
+    clock = time.perf_counter
+    for args in timed_args:
+        start = clock()
+        func(*args)
+        latencies.append(clock() - start)
+    latencies.sort()
+
+    peaks = []
+    retained = 0
+    tracemalloc.start()
+    try:
+        for args in sampled_args:
+            before = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            func(*args)
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained += current - before
+    finally:
+        tracemalloc.stop()
+
+    with CaptureQueriesContext(connection) as queries:
+        for args in counted_args:
+            func(*args)
+
+    return OrderedDict([
+        ('ops', len(latencies)),
+        ('mean_us', sum(latencies) / len(latencies) * 1e6),
+        ('p50_us', _percentile(latencies, 50) * 1e6),
+        ('p90_us', _percentile(latencies, 90) * 1e6),
+        ('p99_us', _percentile(latencies, 99) * 1e6),
+        ('max_us', latencies[-1] * 1e6),
+        # Without tracemalloc.reset_peak (Python < 3.9) the peak is that of the whole sample so far
+        ('peak_alloc_bytes', sum(peaks) / len(peaks)),
+        ('retained_bytes', retained / len(sampled_args)),
+        ('queries', len(queries) / len(counted_args)),
+    ])
+
+
+def compare(results, baseline, threshold):
+    """Prints the change in median latency of every case also in baseline.
+    @return the names of the cases that are more than threshold percent slower"""
+    regressions = []
+    print("\n%-32s %12s %12s %9s" % ('compared with baseline', 'before p50', 'after p50', 'change'))
+    for name, stats in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        change = (stats['p50_us'] - before['p50_us']) / before['p50_us'] * 100
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print("%-32s %10.1fus %10.1fus %+8.1f%%%s" %
+              (name, before['p50_us'], stats['p50_us'], change, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=2000, help='number of timed calls per case')
+    parser.add_argument('-k', dest='filter', default='', help='only run the cases whose name contains this')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='compare with the results saved in this file')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='median latency increase, in percent, reported as a regression (default 20)')
+    args = parser.parse_args()
+
+    global SAMPLE
+    SAMPLE = min(SAMPLE, args.n)
+
+    results = OrderedDict()
+    print("%-32s %9s %9s %9s %11s %11s %8s" % ('case', 'p50 us', 'p90 us', 'p99 us', 'peak B/op', 'kept B/op',
+                                               'queries'))
+    for name, func, args_list in cases(args.n):
+        if args.filter not in name:
+            continue
+        stats = results[name] = measure(func, args_list, args.n)
+        print("%-32s %9.1f %9.1f %9.1f %11.0f %11.0f %8.1f" % (name, stats['p50_us'], stats['p90_us'],
+                                                               stats['p99_us'], stats['peak_alloc_bytes'],
+                                                               stats['retained_bytes'], stats['queries']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(OrderedDict([
+                ('meta', OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+                                      ('python', platform.python_version()), ('django', django.get_version()),
+                                      ('n', args.n)])),
+                ('results', results),
+            ]), f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,7 @@ setup(
     author_email='raven-support@cam.ac.uk',
     packages=find_packages(),
     include_package_data=True,
-    install_requires=['django>=3.2,<5', 'pyOpenSSL', 'requests'],
+    install_requires=['django>=3.2,<5', 'cryptography', 'pyOpenSSL', 'requests'],
     python_requires='>=3.7',
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -1,12 +1,14 @@
 import time
 try:
     from urlparse import parse_qs
-    from urllib import unquote
 except ImportError:
-    from urllib.parse import parse_qs, unquote
-from OpenSSL.crypto import FILETYPE_PEM, load_certificate, verify
-from django.conf import settings
-from ucamwebauth.utils import decode_sig, setting, parse_time, get_return_url
+    from urllib.parse import parse_qs
+from ucamwebauth import metrics
+from ucamwebauth.conf import get_settings
+from ucamwebauth.keys import registry
+from ucamwebauth.replay import get_replay_cache
+from ucamwebauth.verifiers import get_verifier
+from ucamwebauth.utils import decode_sig, parse_time, get_return_url, tokenize_response
 from ucamwebauth.exceptions import (MalformedResponseError, InvalidResponseError, PublicKeyNotFoundError,  # noqa: F401
                                     UserNotAuthorised, OtherStatusCode)
 
@@ -14,9 +16,18 @@ from ucamwebauth.exceptions import (MalformedResponseError, InvalidResponseError
 class RavenResponse(object):
     """Transforms a WLS-Response (http://raven.cam.ac.uk/project/waa2wls-protocol.txt) from the
     University of Cambridge web login service (WLS) a.k.a. Raven (http://raven.cam.ac.uk/) into an object with
-    accessible variables corresponding to the response parameters"""
+    accessible variables corresponding to the response parameters.
 
-    ver = status = msg = issue = ident = url = principal = ptags = auth = sso = life = params = kid = sig = None
+    The fields derived from ptags, sso and params are only split or decoded the first time they are accessed. The
+    object is small (it uses __slots__) and can be pickled, or converted to and from a JSON-serialisable dictionary
+    with as_dict() and from_dict(), e.g. to keep it in the session."""
+
+    __slots__ = ('ver', 'status', 'msg', 'issue', 'ident', 'url', 'principal', 'auth', 'life', 'kid', 'sig',
+                 '_ptags', '_sso', '_params', '_ptags_list', '_sso_list', '_params_dict')
+
+    # The fields that make up the state of a response. The other slots only cache values derived from them.
+    FIELDS = ('ver', 'status', 'msg', 'issue', 'ident', 'url', 'principal', 'auth', 'life', 'kid', 'sig',
+              '_ptags', '_sso', '_params')
 
     STATUS = {200: 'Successful authentication',
               410: 'The user cancelled the authentication request',
@@ -27,18 +38,30 @@ class RavenResponse(object):
               560: 'WAA not authorised',
               570: 'Authentication declined'}
 
-    def __init__(self, response_req=None):
+    def __init__(self, response_req=None, response_str=None, url=None, check_timeout=True, check_replay=True):
         """Creates a RavenResponse object from the response of the Web login service (WLS) of the University of
         Cambridge
         @param response_req The HTTP request that contains the WLS response.
+        @param response_str The WLS response itself, to validate a response without a request. Ignored if
+            response_req is given.
+        @param url The URL the response must have been sent to. Defaults to the return URL for response_req. If
+            neither url nor response_req is given the URL in the response is not checked.
+        @param check_timeout Whether to reject responses issued more than UCAMWEBAUTH_TIMEOUT seconds ago. Only
+            auditing of old responses should disable this.
+        @param check_replay Whether to check (and record) the response in the replay cache, if one is configured
         """
 
-        if response_req is None:
+        if response_req is not None:
+            try:
+                response_str = response_req.GET['WLS-Response']
+            except KeyError:
+                raise MalformedResponseError("no WLS-Response")
+        elif response_str is None:
             raise MalformedResponseError("no request supplied")
-        try:
-            response_str = response_req.GET['WLS-Response']
-        except KeyError:
-            raise MalformedResponseError("no WLS-Response")
+
+        timer = metrics.timer()
+        self.principal = self._ptags = self.life = self.kid = self.sig = None
+        self._ptags_list = self._sso_list = self._params_dict = None
 
         # The WLS sends an authentication response message as follows:  First a 'encoded response string' is formed by
         # concatenating the values of the response fields below, in the order shown, using '!' as a separator character.
@@ -46,28 +69,18 @@ class RavenResponse(object):
         # field value they MUST be replaced by their %-encoded representation
         # before concatenation.
         # Parameters with no relevant value MUST be encoded as the empty string.
-        rawtokens = response_str.split('!')
-        tokens = list(map(unquote, rawtokens))  # return a list for python3 compatibility
 
         # ver: The version of the WLS protocol in use. May be the same as the 'ver' parameter
-        # supplied in the request
-        try:
-            self.ver = int(tokens[0])
-        except ValueError:
-            raise MalformedResponseError("Version number must be an integer, not %s" % tokens[0])
-        if not 4 > self.ver > 0:
-            raise MalformedResponseError("Unsupported version: %d" % self.ver)
+        # supplied in the request. tokenize_response also checks that the number of parameters in the response is
+        # correct for this version.
+        self.ver, tokens, data = tokenize_response(response_str)
+        config = get_settings()
 
         if self.ver == 3:
             versioni = 0
         else:
             versioni = 1
 
-        # Check that the number of parameters in the response is correct
-        if len(tokens) != (14-versioni):
-            raise MalformedResponseError("Wrong number of parameters in response: expected %d, got %d" %
-                                         ((14-versioni), len(tokens)))
-
         # status: A three digit status code indicating the status of the authentication request. The list of possible
         # statuses can be seen in the STATUS dict of the RavenResponse object.
         try:
@@ -94,7 +107,7 @@ class RavenResponse(object):
         # Otherwise allowance must be made for the maximum expected clock skew.
         if self.issue > time.time():
             raise InvalidResponseError("The timestamp on the response is in the future")
-        if self.issue < time.time() - setting('UCAMWEBAUTH_TIMEOUT', 30):
+        if check_timeout and self.issue < time.time() - config.timeout:
             raise InvalidResponseError("Response has timed out - issued %s, now %s" %
                                        (time.asctime(time.gmtime(self.issue)), time.asctime()))
 
@@ -104,13 +117,21 @@ class RavenResponse(object):
         if self.ident == "":
             raise MalformedResponseError("Empty ID")
 
+        # Reject a response that has already been accepted before doing any further work. Responses are only recorded
+        # once they have been fully validated (see below), so forged responses cannot be used to fill the cache.
+        replay_cache = get_replay_cache() if check_replay else None
+        if replay_cache is not None and replay_cache.seen(self.issue, self.ident):
+            raise InvalidResponseError("This response has already been used")
+
         # url: The value of url supplied in the authentication request and used to form the authentication response.
         self.url = tokens[5]
 
         # Check that 'url' represents the resource currently being
         # accessed.  The request has already been checked against
         # ALLOWED_HOSTS by Django.
-        if self.url != get_return_url(response_req):
+        if url is None and response_req is not None:
+            url = get_return_url(response_req)
+        if url is not None and self.url != url:
             raise InvalidResponseError("The URL in the response does not match the URL expected")
 
         # principal: Only present if status == 200, indicates the authenticated identity of the user
@@ -128,7 +149,7 @@ class RavenResponse(object):
         # a matter for local definition by individual WLS operators (see note below). Web application agent (WAA)
         # SHOULD ignore values that they do not recognise.
         if versioni == 0:
-            self.ptags = tokens[7].split(',')
+            self._ptags = tokens[7]
 
         # auth (not-empty only if authentication was successfully established by interaction with the user):
         # This indicates which authentication type was used. v3 only supports 'pwd'
@@ -137,12 +158,12 @@ class RavenResponse(object):
         # sso (not-empty only if 'auth' is empty): Authentication must have been established based on previous
         # successful authentication interaction(s) with the user. This indicates which authentication types were used
         # on these occasions. This value consists of a sequence of text tokens as described below, separated by ','.
-        self.sso = tokens[9-versioni].split(',')
+        self._sso = tokens[9-versioni]
 
         # life (optional): If the user has established an authenticated 'session' with the WLS, this indicates the
         # remaining life (in seconds) of that session. If present, a WAA SHOULD use this to establish an upper limit
         # to the lifetime of any session that it establishes.
-        # TODO https://docs.djangoproject.com/en/dev/topics/http/sessions/#django.contrib.sessions.backends.base.SessionBase.set_expiry  # noqa: E501
+        # raven_return does so (see UCAMWEBAUTH_SESSION_LIFE).
         if tokens[10-versioni] != "":
             try:
                 self.life = int(tokens[10-versioni])
@@ -150,10 +171,7 @@ class RavenResponse(object):
                 raise MalformedResponseError("Life parameter must be an integer, not %s" % tokens[10-versioni])
 
         # params: a copy of the params parameter from the request
-        try:
-            self.params = parse_qs(tokens[11-versioni])
-        except Exception:
-            raise MalformedResponseError("The params field contains wrong characters: %s" % tokens[11-versioni])
+        self._params = tokens[11-versioni]
 
         # REQUIRED to be a copy of the params parameter from the request
         # if self.params != setting('UCAMWEBAUTH_PARAMS', default=''):
@@ -182,21 +200,24 @@ class RavenResponse(object):
 
         # Check that 'kid', corresponds to a key/certificate present in the WAA. Is the only way to check the
         # signature. The WAA has to use the public key/certificate made available by the WLS.
+        timer.lap('parse')
         if (self.sig is not None) or (self.status == 200):
-            try:
-                cert = load_certificate(FILETYPE_PEM, settings.UCAMWEBAUTH_CERTS[self.kid])
-            except Exception:
+            cert = registry.get(self.kid)
+            timer.lap('certificate')
+            if cert is None:
                 raise PublicKeyNotFoundError("The server do not have the public key corresponding to the key the web "
                                              "login service signed the response with")
 
             # Check that the signature matches the data supplied. To check this, the WAA uses the public key identified
-            # by 'kid'.
-            data = '!'.join(rawtokens[0:(12-versioni)])
-            # The data string that was signed in the WLS (everything from the  WLS-Response except 'kid' and 'sig'
+            # by 'kid'. data is the string that was signed in the WLS (everything from the WLS-Response except 'kid'
+            # and 'sig').
             try:
-                verify(cert, self.sig, data.encode(), 'sha1')
+                valid = get_verifier().verify(cert, self.sig, data)
             except Exception:
+                valid = False
+            if not valid:
                 raise InvalidResponseError("The signature for this response is not valid.")
+            timer.lap('verify')
 
         if self.status == 200:
 
@@ -205,8 +226,6 @@ class RavenResponse(object):
             # Conversely, the WAA MUST ensure that the values of 'aauth' and/or 'iact' in its authentication requests
             # correctly reflect its requirement, to prevent the WLS sending it unacceptable responses.
 
-            UCAMWEBAUTH_IACT = setting('UCAMWEBAUTH_IACT', '')
-
             # the authentication was successfully establish by interaction with the user
             if self.auth != "":
                 # auth only supports 'pwd' in current version, therefore we compare it with 'pwd' only
@@ -215,23 +234,73 @@ class RavenResponse(object):
                 if self.auth != "pwd":
                     raise InvalidResponseError("The response used the wrong type of authentication (auth)")
 
-                if UCAMWEBAUTH_IACT == 'no':
+                if config.iact == 'no':
                     # We had required a non-interactive authentication, but didn't get one
                     raise InvalidResponseError("Non-interactive authentication required but not received")
 
             # authentication was established on a previous interaction(s) with the user
             else:
-                if self.sso != [""]:
-                    if self.sso != ["pwd"]:
+                if self._sso != "":
+                    if self._sso != "pwd":
                         raise InvalidResponseError("The response used the wrong type of authentication (sso)")
 
-                    if UCAMWEBAUTH_IACT == 'yes':
+                    if config.iact == 'yes':
                         # We had required an interactive authentication, but didn't get one
                         raise InvalidResponseError("Interactive authentication required but not received")
                 else:
                     # Both auth and sso are empty, which is not allowed
                     raise MalformedResponseError("No authentication types supplied")
 
+            # Record the response so that it cannot be replayed. add() is atomic, so if the same response is being
+            # validated concurrently only one of them succeeds.
+            if replay_cache is not None and not replay_cache.add(self.issue, self.ident):
+                raise InvalidResponseError("This response has already been used")
+
+    @property
+    def ptags(self):
+        """The list of ptags, or None for versions of the protocol that do not have them"""
+        if self._ptags_list is None and self._ptags is not None:
+            self._ptags_list = self._ptags.split(',')
+        return self._ptags_list
+
+    @property
+    def sso(self):
+        if self._sso_list is None:
+            self._sso_list = self._sso.split(',')
+        return self._sso_list
+
+    @property
+    def params(self):
+        """The params field decoded as a query string, i.e. a dictionary of lists"""
+        if self._params_dict is None:
+            try:
+                self._params_dict = parse_qs(self._params)
+            except Exception:
+                raise MalformedResponseError("The params field contains wrong characters: %s" % self._params)
+        return self._params_dict
+
+    def __getstate__(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def __setstate__(self, state):
+        for field in self.FIELDS:
+            setattr(self, field, state.get(field))
+        self._ptags_list = self._sso_list = self._params_dict = None
+
+    def as_dict(self):
+        """Returns the fields of the response as a JSON-serialisable dictionary. The signature is not included."""
+        state = self.__getstate__()
+        del state['sig']
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        """Rebuilds a response from the output of as_dict(). The response is NOT validated again, so state must come
+        from a trusted source (such as the session)."""
+        response = cls.__new__(cls)
+        response.__setstate__(state)
+        return response
+
     def validate(self):
         """Returns True if this represents a successful authentication otherwise returns False."""
         return self.status == 200
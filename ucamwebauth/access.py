@@ -0,0 +1,110 @@
+"""The paths RavenLoginRequiredMiddleware protects (see UCAMWEBAUTH_PROTECTED_PATHS and UCAMWEBAUTH_EXEMPT_PATHS).
+
+Each pattern is either a path prefix ('/staff/') or, if it starts with '^', a regular expression matched against the
+start of the path. Prefixes are compiled into a trie, so finding the longest one that matches a path costs the same
+whatever their number, and the regular expressions of each list into a single one. A path is exempt if an exempt
+regular expression matches it. Otherwise the longest matching prefix, protected or exempt, decides, and paths that no
+prefix matches are protected if a protected regular expression matches them.
+"""
+import re
+import threading
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.urls import NoReverseMatch
+from ucamwebauth.conf import get_settings
+from ucamwebauth.utils import reverse_path_info
+
+# The views of the login flow, which are always exempt
+RAVEN_VIEWS = ('raven_login', 'raven_return', 'raven_logout')
+
+# The key of the rule of a prefix in its trie node. Paths are strings, so it cannot be a character.
+_RULE = None
+
+
+class PathRules(object):
+    """Decides whether a path is protected, see the module documentation.
+    @param protected The protected patterns
+    @param exempt The exempt patterns, which win over protected patterns for the same prefix"""
+
+    def __init__(self, protected=(), exempt=()):
+        self.trie = {}
+        protected_res = self.add_rules(protected, True)
+        # Added last, so that they replace protected prefixes that are the same
+        exempt_res = self.add_rules(exempt, False)
+        self.protected_re = self.compile(protected_res, 'UCAMWEBAUTH_PROTECTED_PATHS')
+        self.exempt_re = self.compile(exempt_res, 'UCAMWEBAUTH_EXEMPT_PATHS')
+
+    def add_rules(self, patterns, protected):
+        """Adds the prefixes of patterns to the trie
+        @return the regular expressions of patterns"""
+        regexes = []
+        for pattern in patterns:
+            if pattern.startswith('^'):
+                regexes.append(pattern)
+                continue
+            node = self.trie
+            for character in pattern:
+                node = node.setdefault(character, {})
+            node[_RULE] = protected
+        return regexes
+
+    def compile(self, regexes, setting):
+        if not regexes:
+            return None
+        try:
+            for regex in regexes:
+                re.compile(regex)
+            return re.compile('|'.join('(?:%s)' % regex for regex in regexes))
+        except re.error as e:
+            raise ImproperlyConfigured("%s has an invalid regular expression %r: %s" % (setting, regex, e))
+
+    def longest_prefix(self, path):
+        """Returns the rule (True for protected) of the longest prefix of path, or None if no prefix matches"""
+        node = self.trie
+        rule = node.get(_RULE)
+        for character in path:
+            node = node.get(character)
+            if node is None:
+                break
+            rule = node.get(_RULE, rule)
+        return rule
+
+    def is_protected(self, path):
+        if self.exempt_re is not None and self.exempt_re.match(path):
+            return False
+        rule = self.longest_prefix(path)
+        if rule is not None:
+            return rule
+        return self.protected_re is not None and self.protected_re.match(path) is not None
+
+
+_path_rules = None
+_path_rules_lock = threading.Lock()
+
+
+def get_path_rules():
+    """Returns the PathRules of the current settings, with the views of RAVEN_VIEWS exempt"""
+    global _path_rules
+    rules = _path_rules
+    if rules is None:
+        with _path_rules_lock:
+            if _path_rules is None:
+                config = get_settings()
+                exempt = list(config.exempt_paths)
+                for name in RAVEN_VIEWS:
+                    try:
+                        # Paths are matched against request.path_info, which does not include the script prefix
+                        exempt.append(reverse_path_info(name))
+                    except NoReverseMatch:
+                        pass
+                _path_rules = PathRules(config.protected_paths, exempt)
+            rules = _path_rules
+    return rules
+
+
+@receiver(setting_changed)
+def reset_path_rules(setting, **kwargs):
+    global _path_rules
+    if setting.startswith('UCAMWEBAUTH_') or setting in ('ROOT_URLCONF', 'FORCE_SCRIPT_NAME'):
+        _path_rules = None
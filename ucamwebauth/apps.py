@@ -0,0 +1,37 @@
+from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_logged_in
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_delete, post_save
+from ucamwebauth import usercache
+from ucamwebauth.conf import get_settings
+from ucamwebauth.keys import registry
+
+
+class UcamWebAuthConfig(AppConfig):
+    name = 'ucamwebauth'
+    verbose_name = 'University of Cambridge Web Authentication'
+    default_auto_field = 'django.db.models.BigAutoField'
+
+    def ready(self):
+        # Validate the UCAMWEBAUTH_* settings now rather than when they are first needed by a request
+        get_settings()
+
+        # Parse the WLS certificates now so that a malformed one is reported at startup rather than in the middle
+        # of a login
+        errors = registry.errors
+        if errors:
+            raise ImproperlyConfigured("UCAMWEBAUTH_CERTS or UCAMWEBAUTH_CERTS_DIR contains invalid certificates: %s" %
+                                       ", ".join("%s (%s)" % (kid, error) for kid, error in errors.items()))
+
+        # Invalidate cached users (see ucamwebauth.usercache) when they or their profile change
+        UserProfile = self.get_model('UserProfile')
+        for signal in (post_save, post_delete):
+            signal.connect(usercache.user_changed, sender=get_user_model(), dispatch_uid='ucamwebauth_user_changed')
+            signal.connect(usercache.profile_changed, sender=UserProfile, dispatch_uid='ucamwebauth_profile_changed')
+
+        # Let UCAMWEBAUTH_WRITE_BEHIND buffer the last_login updates (see ucamwebauth.writebehind), unless the project
+        # disconnected Django's receiver
+        from ucamwebauth import writebehind
+        if user_logged_in.disconnect(dispatch_uid='update_last_login'):
+            user_logged_in.connect(writebehind.update_last_login, dispatch_uid='update_last_login')
@@ -0,0 +1,9 @@
+from django.urls import path
+from ucamwebauth.views import araven_login, araven_logout, araven_return
+
+# The same URLs as ucamwebauth.urls, served by the async views. Use these under ASGI.
+urlpatterns = [
+    path('accounts/login/raven', araven_login, name='raven_login'),
+    path('accounts/logout/raven', araven_logout, name='raven_logout'),
+    path('raven_return/', araven_return, name='raven_return'),
+]
@@ -0,0 +1,287 @@
+"""Attributes of users (display name, institutions, groups...) from a directory, fetched when they log in.
+
+The WLS only tells whether a user is 'current'. To get more, set UCAMWEBAUTH_ATTRIBUTE_PROVIDER, e.g.:
+
+    UCAMWEBAUTH_ATTRIBUTE_PROVIDER = {
+        'BACKEND': 'ucamwebauth.attributes.HTTPAttributeProvider',
+        'OPTIONS': {'url': 'https://directory.example.com/people/{principal}'},
+    }
+
+After authenticating a user, RavenAuthBackend gets their attributes (a dictionary) with get_attributes(), which makes
+them available as request.raven_attributes and user.raven_attributes and sends the attributes_received signal. Views
+can call get_attributes(principal) too: it is cheap once the attributes are cached.
+
+Attributes are kept in an in-process LRU of UCAMWEBAUTH_ATTRIBUTE_MAX_ENTRIES entries. They are fresh for
+UCAMWEBAUTH_ATTRIBUTE_TTL seconds, and then served stale, while they are fetched again in the background, for
+UCAMWEBAUTH_ATTRIBUTE_STALE more seconds. Fetches run in a pool of UCAMWEBAUTH_ATTRIBUTE_WORKERS threads and a caller
+waits at most UCAMWEBAUTH_ATTRIBUTE_BUDGET seconds for one: a slow or failing directory delays a login by that much at
+most, and the login goes on without attributes (None).
+
+While the directory is down or slow, logins should not all wait for it, nor queue fetches that will never end: a
+failed fetch of attributes that are not cached is remembered for UCAMWEBAUTH_ATTRIBUTE_ERROR_TTL seconds, during which
+the attributes are None without a fetch, and no new fetch starts while UCAMWEBAUTH_ATTRIBUTE_MAX_PENDING principals are
+being fetched.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from ucamwebauth import metrics
+from ucamwebauth.conf import get_settings
+from ucamwebauth.utils import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class BaseAttributeProvider(object):
+    """Base class for attribute providers."""
+
+    def get_attributes(self, principal):
+        """Returns the attributes of principal as a dictionary, empty if the directory does not know them
+        @exception Exception if the directory cannot be queried"""
+        raise NotImplementedError
+
+
+class HTTPAttributeProvider(BaseAttributeProvider):
+    """Gets the attributes from a JSON HTTP API. Connections are kept open and reused, up to pool_size at a time.
+    @param url The URL of a principal's attributes, with {principal} in place of the (quoted) principal
+    @param headers Extra request headers, e.g. for authentication
+    @param timeout The connect and read timeout of each request, in seconds
+    @param pool_size The maximum number of connections kept open"""
+
+    def __init__(self, url, headers=None, timeout=2, pool_size=10):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_attributes(self, principal):
+        response = self.session.get(self.url.format(principal=quote(principal, safe='')), timeout=self.timeout)
+        if response.status_code == 404:
+            return {}
+        response.raise_for_status()
+        return response.json()
+
+
+class SQLiteAttributeProvider(BaseAttributeProvider):
+    """Gets the attributes from a table of (principal, JSON attributes) rows in an SQLite database, e.g. to test
+    offline with a local copy of a directory. Each thread has its own connection.
+    @param path The path of the database
+    @param table The table, which set_attributes creates if it does not exist"""
+
+    def __init__(self, path, table='attributes'):
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def get_attributes(self, principal):
+        row = self.connection.execute('SELECT data FROM "%s" WHERE principal = ?' % self.table,
+                                      (principal, )).fetchone()
+        return {} if row is None else json.loads(row[0])
+
+    def set_attributes(self, principal, attributes):
+        """Stores the attributes of principal, replacing any previous ones"""
+        with self.connection as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS "%s" (principal TEXT PRIMARY KEY, data TEXT NOT NULL)' %
+                               self.table)
+            connection.execute('INSERT OR REPLACE INTO "%s" (principal, data) VALUES (?, ?)' % self.table,
+                               (principal, json.dumps(attributes)))
+
+
+class AttributeCache(object):
+    """Caches the attributes returned by provider, see the module documentation."""
+
+    def __init__(self, provider, ttl=300, stale=3600, max_entries=10000, budget=0.5, workers=4, error_ttl=30,
+                 max_pending=100):
+        self.provider = provider
+        self.ttl = ttl
+        self.budget = budget
+        self.workers = workers
+        self.error_ttl = error_ttl
+        self.max_pending = max_pending
+        # principal -> (time fetched, attributes), with None attributes for a failed fetch
+        self._cache = TTLCache(maxsize=max_entries, timeout=ttl + stale)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _fetch(self, principal):
+        try:
+            attributes = self.provider.get_attributes(principal)
+        except Exception as e:
+            logger.warning("Could not get the attributes of %s: %s" % (principal, e))
+            metrics.incr('attributes', 'error')
+            if self.error_ttl:
+                # Stale attributes, if any, are better than none
+                self._cache.add(principal, (time.time(), None), timeout=self.error_ttl)
+            raise
+        self._cache.set(principal, (time.time(), attributes))
+        return attributes
+
+    def _done(self, principal, future):
+        with self._lock:
+            if self._pending.get(principal) is future:
+                del self._pending[principal]
+
+    def fetch(self, principal):
+        """Starts fetching the attributes of principal, unless they are already being fetched
+        @return a concurrent.futures.Future of the attributes, or None if max_pending principals are being fetched"""
+        with self._lock:
+            future = self._pending.get(principal)
+            if future is not None:
+                return future
+            if len(self._pending) >= self.max_pending:
+                metrics.incr('attributes', 'overload')
+                logger.warning("Not getting the attributes of %s: %d fetches are pending" %
+                               (principal, len(self._pending)))
+                return None
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='ucamwebauth-attributes')
+            future = self._pending[principal] = self._executor.submit(self._fetch, principal)
+        # Outside the lock: the callback runs at once if the fetch is already done
+        future.add_done_callback(lambda future: self._done(principal, future))
+        return future
+
+    def _cached(self, principal):
+        """Returns (True, attributes) from the cache, revalidating stale ones in the background, or (False, None)"""
+        entry = self._cache.get(principal)
+        if entry is None:
+            return False, None
+        if entry[1] is None:
+            metrics.incr('attributes', 'failed')
+        elif time.time() - entry[0] >= self.ttl:
+            metrics.incr('attributes', 'stale')
+            self.fetch(principal)
+        else:
+            metrics.incr('attributes', 'hit')
+        return True, entry[1]
+
+    def get(self, principal):
+        """Returns the attributes of principal, or None if they could not be fetched within the time budget"""
+        found, attributes = self._cached(principal)
+        if found:
+            return attributes
+        metrics.incr('attributes', 'miss')
+        future = self.fetch(principal)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=self.budget)
+        except TimeoutError:
+            # The fetch goes on, and the attributes will be cached for the next time
+            metrics.incr('attributes', 'timeout')
+            logger.warning("Timed out getting the attributes of %s" % principal)
+        except Exception:
+            pass
+        return None
+
+    async def aget(self, principal):
+        """The async version of get"""
+        found, attributes = self._cached(principal)
+        if found:
+            return attributes
+        metrics.incr('attributes', 'miss')
+        future = self.fetch(principal)
+        if future is None:
+            return None
+        try:
+            # shield: a timeout must not cancel the fetch, which other callers may be waiting for
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.budget)
+        except asyncio.TimeoutError:
+            metrics.incr('attributes', 'timeout')
+            logger.warning("Timed out getting the attributes of %s" % principal)
+        except Exception:
+            pass
+        return None
+
+    def clear(self):
+        self._cache.clear()
+
+    def close(self):
+        """Shuts the pool of threads down, without waiting for the pending fetches"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+_attribute_cache = None
+_attribute_cache_lock = threading.Lock()
+
+
+def get_attribute_cache():
+    """Returns the AttributeCache for UCAMWEBAUTH_ATTRIBUTE_PROVIDER, or None if it is not set"""
+    global _attribute_cache
+    config = get_settings()
+    if not config.attribute_provider:
+        return None
+    with _attribute_cache_lock:
+        if _attribute_cache is None:
+            try:
+                backend = import_string(config.attribute_provider['BACKEND'])
+            except (ImportError, KeyError, TypeError) as e:
+                raise ImproperlyConfigured("UCAMWEBAUTH_ATTRIBUTE_PROVIDER has an invalid BACKEND: %s" % e)
+            provider = backend(**config.attribute_provider.get('OPTIONS', {}))
+            _attribute_cache = AttributeCache(provider, config.attribute_ttl, config.attribute_stale,
+                                              config.attribute_max_entries, config.attribute_budget,
+                                              config.attribute_workers, config.attribute_error_ttl,
+                                              config.attribute_max_pending)
+        return _attribute_cache
+
+
+def get_attributes(principal):
+    """Returns the attributes of principal (see AttributeCache.get), or None if there is no attribute provider"""
+    cache = get_attribute_cache()
+    return None if cache is None else cache.get(principal)
+
+
+async def aget_attributes(principal):
+    """The async version of get_attributes"""
+    cache = get_attribute_cache()
+    return None if cache is None else await cache.aget(principal)
+
+
+def _reset_attribute_cache():
+    global _attribute_cache, _attribute_cache_lock
+    _attribute_cache = None
+    _attribute_cache_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    # The worker threads of the pool do not exist in a forked child
+    os.register_at_fork(after_in_child=_reset_attribute_cache)
+
+
+@receiver(setting_changed)
+def reset_attribute_cache(setting, **kwargs):
+    global _attribute_cache
+    if setting.startswith('UCAMWEBAUTH_ATTRIBUTE_'):
+        with _attribute_cache_lock:
+            cache, _attribute_cache = _attribute_cache, None
+        if cache is not None:
+            cache.close()
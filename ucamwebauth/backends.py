@@ -1,23 +1,78 @@
 import logging
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import RemoteUserBackend
-from ucamwebauth import RavenResponse
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save
+from ucamwebauth import RavenResponse, metrics
+from ucamwebauth.attributes import get_attribute_cache
 from ucamwebauth.exceptions import UserNotAuthorised, OtherStatusCode
 from ucamwebauth.models import UserProfile
-from ucamwebauth.utils import setting
+from ucamwebauth.principal import RavenPrincipal
+from ucamwebauth.conf import get_settings
+from ucamwebauth.replay import get_replay_cache
+from ucamwebauth.signals import attributes_received
+from ucamwebauth.usercache import ainvalidate_user, get_user_cache, invalidate_user
+from ucamwebauth.writebehind import get_write_behind_buffer
 
 logger = logging.getLogger(__name__)
 
 
-# We inherit the automatic-user-creation code from RemoteUserBackend.
+# We inherit clean_username, configure_user and user_can_authenticate from RemoteUserBackend.
 class RavenAuthBackend(RemoteUserBackend):
     """An authentication backend for django that uses Raven.  To use, add
     'ucamwebauth.backends.RavenAuthBackend' to AUTHENTICATION_BACKENDS
-    in your django settings.py."""
+    in your django settings.py.
+
+    A login by an existing user costs a single query (the user and their profile are fetched together), plus a
+    conditional update if raven_for_life changed. New users and profiles are inserted with ON CONFLICT DO NOTHING
+    semantics, so concurrent first logins by the same user do not fail or need to be retried."""
 
     def authenticate(self, request=None, remote_user=None):
         """Checks a response from the Raven server and sees if it is valid.  If
         it is, returns the User with the same username as the Raven username.
+        The RavenResponse is made available as request.raven_response.
+        @return User object, or None if authentication failed"""
+
+        response = self.check_response(request)
+        timer = metrics.timer()
+        user = self.get_user_for_principal(request, response.principal)
+        timer.lap('user')
+
+        # creates (if necessary) the UserProfile model and update the raven_for_life property from the RavenResponse
+        if user:
+            self.update_profile(user, 'current' not in (response.ptags or ()))
+            timer.lap('profile')
+            if self.add_attributes(request, user, response.principal):
+                timer.lap('attributes')
+
+        return user
+
+    async def aauthenticate(self, request=None, remote_user=None):
+        """The async version of authenticate, for async views (see ucamwebauth.views.araven_return). The user and
+        profile are read and written with the async ORM API on Django 4.1+, and by authenticate in a thread before.
         @return User object, or None if authentication failed"""
+        if not hasattr(QuerySet, 'aget'):
+            return await sync_to_async(self.authenticate)(request, remote_user)
+
+        response = await self.acheck_response(request)
+        timer = metrics.timer()
+        user = await self.aget_user_for_principal(request, response.principal)
+        timer.lap('user')
+
+        if user:
+            await self.aupdate_profile(user, 'current' not in (response.ptags or ()))
+            timer.lap('profile')
+            if await self.aadd_attributes(request, user, response.principal):
+                timer.lap('attributes')
+
+        return user
+
+    def check_response(self, request):
+        """Checks the response from the Raven server in request, which is made available as request.raven_response.
+        @return the RavenResponse
+        @exception Any of the ucamwebauth exceptions if the response is not a valid, successful authentication of a
+            user authorised to access this site"""
 
         # Check that everything is correct, and return
         try:
@@ -26,40 +81,219 @@ class RavenAuthBackend(RemoteUserBackend):
             logger.error("%s: %s" % (type(e).__name__, e))
             raise
 
+        # Keep the validated response so that the view does not need to parse it again
+        request.raven_response = response
+        metrics.incr('status', response.status)
+
         if not response.validate():
             raise OtherStatusCode("The WLS returned status %d: %s" %
                                   (response.status, response.STATUS[response.status]))
 
-        if (response.ver == 3) and (setting('UCAMWEBAUTH_NOT_CURRENT', default=False) is False) and \
-                ('current' not in response.ptags):
+        if (response.ver == 3) and (get_settings().not_current is False) and \
+                ('current' not in (response.ptags or ())):
             logger.error("%s: %s" % ("UserNotAuthorised", "Authentication successful but you are not authorised to "
                                                           "access this site"))
             raise UserNotAuthorised("Authentication successful but you are not authorised to access this site")
 
-        user = super(RavenAuthBackend, self).authenticate(request, response.principal)
+        return response
 
-        # creates (if necessary) the UserProfile model and update the raven_for_life property from the RavenResponse
-        if user:
-            profile = UserProfile.objects.get_or_create(user=user)[0]
-            raven_for_life = 'current' not in response.ptags
-            if profile.raven_for_life != raven_for_life:
-                profile.raven_for_life = raven_for_life
-                profile.save()
+    async def acheck_response(self, request):
+        """The async version of check_response"""
+        replay_cache = get_replay_cache()
+        if replay_cache is not None and replay_cache.sync_only:
+            return await sync_to_async(self.check_response)(request)
+        # Checking the response is CPU bound, and too quick to be worth a thread
+        return self.check_response(request)
 
-        return user
+    def get_user_for_principal(self, request, principal):
+        """Returns the user whose username is principal, with their profile, creating the user if it does not exist
+        and UCAMWEBAUTH_CREATE_USER is True.
+        @return User object, or None if there is no such user or they cannot authenticate"""
+        UserModel = get_user_model()
+        manager = UserModel._default_manager
+        lookup = {UserModel.USERNAME_FIELD: self.clean_username(principal)}
+        try:
+            user = manager.select_related('profile').get(**lookup)
+        except UserModel.DoesNotExist:
+            if not self.create_unknown_user:
+                return None
+            user = UserModel(**lookup)
+            user.set_unusable_password()
+            # If a concurrent login has just created the same user this insert does nothing, and we fetch their row
+            manager.bulk_create([user], ignore_conflicts=True)
+            password = user.password
+            user = manager.select_related('profile').get(**lookup)
+            # Unusable passwords are random, so the password tells whether the row is the one inserted above
+            if user.password == password:
+                # bulk_create() does not send post_save, but receivers may rely on it for new users
+                post_save.send(sender=UserModel, instance=user, created=True, update_fields=None, raw=False,
+                               using=user._state.db)
+                user = self.configure_user(request, user)
+        return user if self.user_can_authenticate(user) else None
+
+    def update_profile(self, user, raven_for_life):
+        """Creates the user's UserProfile if they do not have one, or updates its raven_for_life if it changed."""
+        try:
+            profile = user.profile
+        except UserProfile.DoesNotExist:
+            # ignore_conflicts: a concurrent login may have just created it
+            UserProfile.objects.bulk_create([UserProfile(user=user, raven_for_life=raven_for_life)],
+                                            ignore_conflicts=True)
+            invalidate_user(user.pk)
+            return
+        if profile.raven_for_life != raven_for_life:
+            profile.raven_for_life = raven_for_life
+            buffer = get_write_behind_buffer()
+            if buffer is not None:
+                # The cached user is invalidated when the update is written, see ucamwebauth.writebehind
+                buffer.add_raven_for_life(user.pk, raven_for_life)
+                return
+            # The condition makes concurrent logins update the row once
+            UserProfile.objects.filter(pk=profile.pk, raven_for_life=not raven_for_life) \
+                .update(raven_for_life=raven_for_life)
+            # Neither bulk_create() nor update() send post_save, which would invalidate the cached user
+            invalidate_user(user.pk)
+
+    async def aget_user_for_principal(self, request, principal):
+        """The async version of get_user_for_principal"""
+        UserModel = get_user_model()
+        manager = UserModel._default_manager
+        lookup = {UserModel.USERNAME_FIELD: self.clean_username(principal)}
+        try:
+            user = await manager.select_related('profile').aget(**lookup)
+        except UserModel.DoesNotExist:
+            if not self.create_unknown_user:
+                return None
+            user = UserModel(**lookup)
+            user.set_unusable_password()
+            await manager.abulk_create([user], ignore_conflicts=True)
+            password = user.password
+            user = await manager.select_related('profile').aget(**lookup)
+            if user.password == password:
+                # post_save receivers and configure_user may use the synchronous ORM
+                await sync_to_async(post_save.send)(sender=UserModel, instance=user, created=True,
+                                                    update_fields=None, raw=False, using=user._state.db)
+                user = await sync_to_async(self.configure_user)(request, user)
+        return user if self.user_can_authenticate(user) else None
+
+    async def aupdate_profile(self, user, raven_for_life):
+        """The async version of update_profile"""
+        try:
+            profile = user.profile
+        except UserProfile.DoesNotExist:
+            await UserProfile.objects.abulk_create([UserProfile(user=user, raven_for_life=raven_for_life)],
+                                                   ignore_conflicts=True)
+            await ainvalidate_user(user.pk)
+            return
+        if profile.raven_for_life != raven_for_life:
+            profile.raven_for_life = raven_for_life
+            buffer = get_write_behind_buffer()
+            if buffer is not None:
+                # The cached user is invalidated when the update is written, see ucamwebauth.writebehind
+                buffer.add_raven_for_life(user.pk, raven_for_life)
+                return
+            await UserProfile.objects.filter(pk=profile.pk, raven_for_life=not raven_for_life) \
+                .aupdate(raven_for_life=raven_for_life)
+            await ainvalidate_user(user.pk)
+
+    def add_attributes(self, request, user, principal):
+        """Gets the attributes of principal from UCAMWEBAUTH_ATTRIBUTE_PROVIDER (see ucamwebauth.attributes), makes them
+        available as request.raven_attributes and user.raven_attributes (None if they could not be fetched in time)
+        and sends attributes_received if there are any.
+        @return False if there is no attribute provider"""
+        cache = get_attribute_cache()
+        if cache is None:
+            return False
+        attributes = cache.get(principal)
+        self._set_attributes(request, user, attributes)
+        if attributes is not None:
+            attributes_received.send(sender=self.__class__, request=request, user=user, attributes=attributes)
+        return True
+
+    async def aadd_attributes(self, request, user, principal):
+        """The async version of add_attributes"""
+        cache = get_attribute_cache()
+        if cache is None:
+            return False
+        attributes = await cache.aget(principal)
+        self._set_attributes(request, user, attributes)
+        if attributes is not None:
+            # Receivers may use the synchronous ORM
+            await sync_to_async(attributes_received.send)(sender=self.__class__, request=request, user=user,
+                                                          attributes=attributes)
+        return True
+
+    def _set_attributes(self, request, user, attributes):
+        user.raven_attributes = attributes
+        if request is not None:
+            request.raven_attributes = attributes
+
+    def get_user(self, user_id):
+        """Returns the user with primary key user_id, with their profile. If UCAMWEBAUTH_USER_CACHE_TIMEOUT is set the
+        user is read from the cache (see ucamwebauth.usercache) instead of the database."""
+        user_cache = get_user_cache()
+        if user_cache is None:
+            user = self.load_user(user_id)
+        else:
+            user = user_cache.get(user_id, self.load_user)
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+    def load_user(self, user_id):
+        """Fetches the user with primary key user_id and their profile from the database, or returns None"""
+        UserModel = get_user_model()
+        try:
+            return UserModel._default_manager.select_related('profile').get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
 
     # Backwards compatibility: honour UCAMWEBAUTH_CREATE_USER.
     @property
     def create_unknown_user(self):
-        return setting('UCAMWEBAUTH_CREATE_USER', default=True)
+        return get_settings().create_user
 
-    def configure_user(self, *args, **kwargs):
+    def configure_user(self, request, user, created=True):
         """
         Configure a user after creation and return the updated user.
 
-        We make sure that the new user created has an unusable password.
+        We make sure that the new user created has an unusable password. New users are always saved, so that
+        subclasses can set fields before calling this.
         """
-        user = super(RavenAuthBackend, self).configure_user(*args, **kwargs)
-        user.set_unusable_password()
-        user.save()
+        user = super(RavenAuthBackend, self).configure_user(request, user)
+        if created or user.has_usable_password():
+            if user.has_usable_password():
+                user.set_unusable_password()
+            user.save()
         return user
+
+
+class RavenPrincipalBackend(RavenAuthBackend):
+    """An authentication backend that does not use the database: it returns a RavenPrincipal (see
+    ucamwebauth.principal), which raven_return stores in the session, instead of a User. To use, add
+    'ucamwebauth.backends.RavenPrincipalBackend' to AUTHENTICATION_BACKENDS instead of RavenAuthBackend, and
+    'ucamwebauth.middleware.RavenPrincipalMiddleware' to MIDDLEWARE after AuthenticationMiddleware.
+
+    UCAMWEBAUTH_CREATE_USER does not apply: every user that the WLS authenticates (and UCAMWEBAUTH_NOT_CURRENT allows)
+    is logged in."""
+
+    def authenticate(self, request=None, remote_user=None):
+        """Checks a response from the Raven server, like RavenAuthBackend.authenticate.
+        @return RavenPrincipal object"""
+        response = self.check_response(request)
+        principal = self.get_principal(response)
+        self.add_attributes(request, principal, response.principal)
+        return principal
+
+    async def aauthenticate(self, request=None, remote_user=None):
+        """The async version of authenticate
+        @return RavenPrincipal object"""
+        response = await self.acheck_response(request)
+        principal = self.get_principal(response)
+        await self.aadd_attributes(request, principal, response.principal)
+        return principal
+
+    def get_principal(self, response):
+        return RavenPrincipal(self.clean_username(response.principal), 'current' not in (response.ptags or ()))
+
+    def get_user(self, user_id):
+        # RavenPrincipals are never stored under django.contrib.auth's session keys
+        return None
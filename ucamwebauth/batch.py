@@ -0,0 +1,107 @@
+"""Verification of WLS responses in bulk, without a request, e.g. to re-check captured responses during an audit.
+
+    for result in verify_responses(open('responses.txt'), executor='process'):
+        if not result.valid:
+            print(result.principal, result.reason)
+"""
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+try:
+    from urllib import unquote
+except ImportError:
+    from urllib.parse import unquote
+from ucamwebauth import RavenResponse
+from ucamwebauth.utils import parse_time
+
+VerificationResult = namedtuple('VerificationResult', 'response valid status principal issue ident kid reason')
+VerificationResult.__doc__ = """The outcome of verifying a WLS response. valid is True only for a genuine, successful
+(status 200) authentication. The other fields are filled in on a best-effort basis for responses that failed
+verification, and reason describes why they did."""
+
+EXECUTORS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _unverified_result(response_str, reason):
+    """Returns a failed VerificationResult with whatever fields can be extracted from response_str"""
+    tokens = [unquote(token) for token in response_str.split('!')]
+    fields = {}
+    if len(tokens) in (13, 14):
+        fields['status'] = _int_or_none(tokens[1])
+        try:
+            fields['issue'] = parse_time(tokens[3])
+        except ValueError:
+            pass
+        fields['ident'] = tokens[4] or None
+        fields['principal'] = tokens[6] or None
+        fields['kid'] = _int_or_none(tokens[-2])
+    return VerificationResult(response=response_str, valid=False, status=fields.get('status'),
+                              principal=fields.get('principal'), issue=fields.get('issue'),
+                              ident=fields.get('ident'), kid=fields.get('kid'), reason=reason)
+
+
+def verify_response(response_str, url=None, check_timeout=False):
+    """Verifies a single WLS response with the same checks as a login, except that it is not recorded in (or checked
+    against) the replay cache and, by default, old responses are not rejected. Never raises.
+    @param response_str The WLS response
+    @param url If given, the URL the response must have been sent to
+    @param check_timeout Whether to reject responses issued more than UCAMWEBAUTH_TIMEOUT seconds ago
+    @return a VerificationResult"""
+    response_str = response_str.strip()
+    try:
+        response = RavenResponse(response_str=response_str, url=url, check_timeout=check_timeout, check_replay=False)
+    except Exception as e:
+        return _unverified_result(response_str, "%s: %s" % (type(e).__name__, e))
+    valid = response.validate()
+    return VerificationResult(response=response_str, valid=valid, status=response.status,
+                              principal=response.principal, issue=response.issue, ident=response.ident,
+                              kid=response.kid, reason=None if valid else response.STATUS[response.status])
+
+
+def _verify_chunk(chunk, url, check_timeout):
+    return [verify_response(response_str, url, check_timeout) for response_str in chunk]
+
+
+def verify_responses(responses, url=None, check_timeout=False, executor='thread', workers=None, chunksize=256):
+    """Verifies an iterable of WLS responses, yielding a VerificationResult for each of them in the same order.
+
+    The responses are consumed in chunks of chunksize, and at most two chunks per worker are in flight at a time, so
+    memory use does not depend on the number of responses.
+    @param responses An iterable of WLS response strings (e.g. an open file with one per line)
+    @param url, check_timeout See verify_response
+    @param executor 'thread', 'process' or None to verify in the calling thread. A process pool needs Django settings
+        to be available in the worker processes: either the workers are forked from a configured process, or
+        DJANGO_SETTINGS_MODULE is set.
+    @param workers The number of workers, by default the number of CPUs
+    @param chunksize The number of responses sent to a worker at a time
+    """
+    responses = iter(responses)
+    if executor is None:
+        for response_str in responses:
+            yield verify_response(response_str, url, check_timeout)
+        return
+
+    try:
+        pool_class = EXECUTORS[executor]
+    except KeyError:
+        raise ValueError("executor must be one of %s or None, not %r" % (", ".join(sorted(EXECUTORS)), executor))
+    workers = workers or os.cpu_count() or 1
+    with pool_class(max_workers=workers) as pool:
+        pending = deque()
+        while True:
+            chunk = list(islice(responses, chunksize))
+            if chunk:
+                pending.append(pool.submit(_verify_chunk, chunk, url, check_timeout))
+            if pending and (not chunk or len(pending) >= 2 * workers):
+                for result in pending.popleft().result():
+                    yield result
+            if not chunk and not pending:
+                break
@@ -0,0 +1,158 @@
+"""A validated, read-only snapshot of the UCAMWEBAUTH_* settings.
+
+get_settings() builds it on first use (the application builds it when it is ready, so that invalid values are
+reported at startup) and it is rebuilt whenever one of the settings changes (e.g. with override_settings in tests).
+"""
+from collections import namedtuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.functional import Promise
+
+
+def _string(name, value):
+    # Lazy strings (e.g. reverse_lazy()) are kept lazy: the URLconf may not be loadable yet
+    if not isinstance(value, (str, Promise)):
+        raise ImproperlyConfigured("%s must be a string, not %r" % (name, value))
+    return value
+
+
+def _optional_string(name, value):
+    return value if value is None else _string(name, value)
+
+
+def _boolean(name, value):
+    if not isinstance(value, bool):
+        raise ImproperlyConfigured("%s must be True or False, not %r" % (name, value))
+    return value
+
+
+def _strings(name, value):
+    if not isinstance(value, (list, tuple)) or not all(isinstance(item, str) for item in value):
+        raise ImproperlyConfigured("%s must be a list of strings, not %r" % (name, value))
+    return tuple(value)
+
+
+def _positive_integer(name, value):
+    if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+        raise ImproperlyConfigured("%s must be a positive integer, not %r" % (name, value))
+    return value
+
+
+def _non_negative_integer(name, value):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ImproperlyConfigured("%s must be a non-negative integer, not %r" % (name, value))
+    return value
+
+
+def _positive_number(name, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ImproperlyConfigured("%s must be a positive number, not %r" % (name, value))
+    return value
+
+
+def _optional_positive_integer(name, value):
+    return value if value is None else _positive_integer(name, value)
+
+
+def _choice(*choices):
+    def validate(name, value):
+        if value not in choices:
+            raise ImproperlyConfigured("%s must be one of %s, not %r" %
+                                       (name, ", ".join(repr(choice) for choice in choices), value))
+        return value
+    return validate
+
+
+def _backend(name, value):
+    if value is not None and (not isinstance(value, dict) or 'BACKEND' not in value):
+        raise ImproperlyConfigured("%s must be None or a dictionary with a 'BACKEND' key, not %r" % (name, value))
+    return value
+
+
+def _is_error_response(value):
+    return value is None or (isinstance(value, (list, tuple)) and len(value) == 2 and
+                             isinstance(value[0], int) and isinstance(value[1], str))
+
+
+def _error_responses(name, value):
+    if not isinstance(value, dict) or not all(isinstance(key, str) and _is_error_response(response)
+                                              for key, response in value.items()):
+        raise ImproperlyConfigured("%s must be a dictionary mapping exception classes (dotted paths) to (status, "
+                                   "template) pairs or None, not %r" % (name, value))
+    return value
+
+
+# (attribute, setting, default, validator)
+OPTIONS = (
+    ('login_url', 'UCAMWEBAUTH_LOGIN_URL', None, _optional_string),
+    ('logout_url', 'UCAMWEBAUTH_LOGOUT_URL', None, _optional_string),
+    ('return_url', 'UCAMWEBAUTH_RETURN_URL', None, _optional_string),
+    ('logout_redirect', 'UCAMWEBAUTH_LOGOUT_REDIRECT', '/', _string),
+    ('redirect_after_login', 'UCAMWEBAUTH_REDIRECT_AFTER_LOGIN', '/', _string),
+    ('not_current', 'UCAMWEBAUTH_NOT_CURRENT', False, _boolean),
+    ('timeout', 'UCAMWEBAUTH_TIMEOUT', 30, _positive_integer),
+    ('create_user', 'UCAMWEBAUTH_CREATE_USER', True, _boolean),
+    ('desc', 'UCAMWEBAUTH_DESC', '', _string),
+    ('iact', 'UCAMWEBAUTH_IACT', '', _choice('', 'yes', 'no')),
+    ('msg', 'UCAMWEBAUTH_MSG', '', _string),
+    ('fail', 'UCAMWEBAUTH_FAIL', '', _choice('', 'yes', 'no')),
+    ('replay_cache', 'UCAMWEBAUTH_REPLAY_CACHE', None, _backend),
+    ('user_cache_timeout', 'UCAMWEBAUTH_USER_CACHE_TIMEOUT', None, _optional_positive_integer),
+    ('user_cache_max_entries', 'UCAMWEBAUTH_USER_CACHE_MAX_ENTRIES', 1000, _positive_integer),
+    ('user_cache_alias', 'UCAMWEBAUTH_USER_CACHE_ALIAS', None, _optional_string),
+    ('metrics', 'UCAMWEBAUTH_METRICS', False, _boolean),
+    ('metrics_hooks', 'UCAMWEBAUTH_METRICS_HOOKS', (), _strings),
+    ('error_responses', 'UCAMWEBAUTH_ERROR_RESPONSES', {}, _error_responses),
+    ('static_error_pages', 'UCAMWEBAUTH_STATIC_ERROR_PAGES', False, _boolean),
+    ('certs_dir', 'UCAMWEBAUTH_CERTS_DIR', None, _optional_string),
+    ('certs_dir_interval', 'UCAMWEBAUTH_CERTS_DIR_INTERVAL', 60, _positive_integer),
+    ('session_life', 'UCAMWEBAUTH_SESSION_LIFE', True, _boolean),
+    ('session_life_min', 'UCAMWEBAUTH_SESSION_LIFE_MIN', None, _optional_positive_integer),
+    ('session_life_max', 'UCAMWEBAUTH_SESSION_LIFE_MAX', None, _optional_positive_integer),
+    ('verifier', 'UCAMWEBAUTH_VERIFIER', 'ucamwebauth.verifiers.PyOpenSSLVerifier', _string),
+    ('gate_max_length', 'UCAMWEBAUTH_GATE_MAX_LENGTH', 4096, _positive_integer),
+    ('attribute_provider', 'UCAMWEBAUTH_ATTRIBUTE_PROVIDER', None, _backend),
+    ('attribute_ttl', 'UCAMWEBAUTH_ATTRIBUTE_TTL', 300, _positive_integer),
+    ('attribute_stale', 'UCAMWEBAUTH_ATTRIBUTE_STALE', 3600, _non_negative_integer),
+    ('attribute_max_entries', 'UCAMWEBAUTH_ATTRIBUTE_MAX_ENTRIES', 10000, _positive_integer),
+    ('attribute_budget', 'UCAMWEBAUTH_ATTRIBUTE_BUDGET', 0.5, _positive_number),
+    ('attribute_workers', 'UCAMWEBAUTH_ATTRIBUTE_WORKERS', 4, _positive_integer),
+    ('attribute_error_ttl', 'UCAMWEBAUTH_ATTRIBUTE_ERROR_TTL', 30, _non_negative_integer),
+    ('attribute_max_pending', 'UCAMWEBAUTH_ATTRIBUTE_MAX_PENDING', 100, _positive_integer),
+    ('protected_paths', 'UCAMWEBAUTH_PROTECTED_PATHS', (), _strings),
+    ('exempt_paths', 'UCAMWEBAUTH_EXEMPT_PATHS', (), _strings),
+    ('protected_require_current', 'UCAMWEBAUTH_PROTECTED_REQUIRE_CURRENT', False, _boolean),
+    ('write_behind', 'UCAMWEBAUTH_WRITE_BEHIND', False, _boolean),
+    ('write_behind_interval', 'UCAMWEBAUTH_WRITE_BEHIND_INTERVAL', 5, _positive_number),
+    ('write_behind_batch_size', 'UCAMWEBAUTH_WRITE_BEHIND_BATCH_SIZE', 500, _positive_integer),
+    ('write_behind_max_pending', 'UCAMWEBAUTH_WRITE_BEHIND_MAX_PENDING', 10000, _positive_integer),
+)
+
+RavenSettings = namedtuple('RavenSettings', [option[0] for option in OPTIONS])
+RavenSettings.__doc__ = "The UCAMWEBAUTH_* settings, validated. See OPTIONS for the setting behind each attribute."
+
+_settings = None
+
+
+def load_settings():
+    """Builds a RavenSettings from the current Django settings.
+    @exception ImproperlyConfigured if any of the settings has an invalid value"""
+    return RavenSettings(*(validate(name, getattr(settings, name, default))
+                           for attribute, name, default, validate in OPTIONS))
+
+
+def get_settings():
+    """Returns the RavenSettings for the current Django settings"""
+    global _settings
+    if _settings is None:
+        _settings = load_settings()
+    return _settings
+
+
+@receiver(setting_changed)
+def reload_settings(setting, **kwargs):
+    global _settings
+    if setting.startswith('UCAMWEBAUTH_'):
+        _settings = None
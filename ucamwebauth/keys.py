@@ -0,0 +1,209 @@
+import logging
+import os
+import re
+import threading
+import time
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from ucamwebauth.conf import get_settings
+from ucamwebauth.verifiers import get_verifier
+
+logger = logging.getLogger(__name__)
+
+# The names of the certificate files in UCAMWEBAUTH_CERTS_DIR: the kid, optionally prefixed with 'pubkey' as in the
+# files published by the WLS (e.g. pubkey2.crt), and the extension .crt or .pem
+CERT_FILE_RE = re.compile(r'^(?:pubkey)?(\d+)\.(?:crt|pem)$')
+
+
+class KeyRegistry(object):
+    """A kid -> key map of the WLS public keys in UCAMWEBAUTH_CERTS and UCAMWEBAUTH_CERTS_DIR, loaded by the verifier
+    (see ucamwebauth.verifiers) that will use them.
+
+    Every certificate is parsed once, the first time a key is needed (or when the application is ready), instead of
+    on every response. The map is never modified once built, only replaced, so lookups do not need to take the lock
+    and the parsed certificates can be shared by workers forked after it was built (e.g. gunicorn --preload).
+
+    If UCAMWEBAUTH_CERTS_DIR is set, a lookup made more than UCAMWEBAUTH_CERTS_DIR_INTERVAL seconds after the
+    directory was last scanned starts a rescan in a background thread, and carries on with the current map. A rescan
+    only parses the files whose modification time, inode or size changed, so new keys are picked up and removed ones
+    retired without a restart. A kid in UCAMWEBAUTH_CERTS takes precedence over a file for the same kid.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = None
+        self._errors = {}
+        self._settings_keys = self._settings_errors = None
+        # file name -> ((mtime, inode, size), kid, key or None, exception or None)
+        self._files = {}
+        self._next_scan = None
+        self._scan_lock = threading.Lock()
+        self._scan_thread = None
+
+    def _build(self):
+        """Parses every certificate in UCAMWEBAUTH_CERTS.
+        @return a (keys, errors) tuple of dictionaries indexed by kid"""
+        certs = getattr(settings, 'UCAMWEBAUTH_CERTS', None) or {}
+        keys = {}
+        errors = {}
+        if not hasattr(certs, 'items'):
+            errors[None] = TypeError("UCAMWEBAUTH_CERTS must be a dictionary, not %s" % type(certs).__name__)
+            return keys, errors
+        verifier = get_verifier()
+        for kid, pem in certs.items():
+            try:
+                keys[kid] = verifier.load_key(pem)
+            except Exception as e:
+                logger.error("Malformed certificate for kid %s in UCAMWEBAUTH_CERTS: %s" % (kid, e))
+                errors[kid] = e
+        return keys, errors
+
+    def _scan(self, directory):
+        """Updates self._files from the certificate files in directory. Must be called with the lock held.
+        @return None, or the exception if the directory could not be read, in which case self._files is unchanged"""
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logger.error("Cannot read UCAMWEBAUTH_CERTS_DIR %s: %s" % (directory, e))
+            return e
+        verifier = get_verifier()
+        files = {}
+        for entry in entries:
+            match = CERT_FILE_RE.match(entry.name)
+            if match is None:
+                continue
+            signature = None
+            try:
+                stat = entry.stat()
+                signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+                previous = self._files.get(entry.name)
+                if previous is not None and previous[0] == signature:
+                    # Unchanged since the last scan (including files that could not be parsed)
+                    files[entry.name] = previous
+                    continue
+                with open(entry.path) as f:
+                    pem = f.read()
+                files[entry.name] = (signature, int(match.group(1)), verifier.load_key(pem), None)
+            except Exception as e:
+                logger.error("Malformed certificate %s in UCAMWEBAUTH_CERTS_DIR: %s" % (entry.path, e))
+                files[entry.name] = (signature, int(match.group(1)), None, e)
+        self._files = files
+        return None
+
+    def _combine(self):
+        """Builds the map from the UCAMWEBAUTH_CERTS keys and the files in UCAMWEBAUTH_CERTS_DIR. Must be called with
+        the lock held."""
+        config = get_settings()
+        keys = {}
+        errors = {}
+        if config.certs_dir is not None:
+            error = self._scan(config.certs_dir)
+            if error is not None:
+                errors[config.certs_dir] = error
+            for name, (signature, kid, key, error) in sorted(self._files.items()):
+                if error is not None:
+                    errors[os.path.join(config.certs_dir, name)] = error
+                    continue
+                if kid in keys:
+                    logger.warning("Several files in UCAMWEBAUTH_CERTS_DIR for kid %s, using %s" % (kid, name))
+                keys[kid] = key
+            self._next_scan = time.monotonic() + config.certs_dir_interval
+        keys.update(self._settings_keys)
+        errors.update(self._settings_errors)
+        self._keys, self._errors = keys, errors
+
+    def load(self):
+        """Builds the map if it has not been built yet and returns it"""
+        with self._lock:
+            if self._keys is None:
+                self._settings_keys, self._settings_errors = self._build()
+                self._combine()
+            return self._keys
+
+    def rescan(self):
+        """Rescans UCAMWEBAUTH_CERTS_DIR now and replaces the map with the result"""
+        with self._lock:
+            if self._settings_keys is None:
+                self._settings_keys, self._settings_errors = self._build()
+            self._combine()
+
+    def _schedule_rescan(self):
+        config = get_settings()
+        if self._keys is not None and config.certs_dir is not None:
+            self._next_scan = time.monotonic() + config.certs_dir_interval
+
+    def _background_rescan(self):
+        try:
+            self.rescan()
+        except Exception:
+            logger.exception("Could not rescan UCAMWEBAUTH_CERTS_DIR")
+        finally:
+            # Even if the rescan failed, so that rescans go on
+            self._schedule_rescan()
+
+    def _rescan_in_background(self):
+        with self._scan_lock:
+            if self._scan_thread is not None and self._scan_thread.is_alive():
+                # It may be past rescheduling already
+                self._schedule_rescan()
+                return
+            try:
+                self._scan_thread = threading.Thread(target=self._background_rescan, name='ucamwebauth-certs-rescan',
+                                                     daemon=True)
+                self._scan_thread.start()
+            except Exception:
+                self._schedule_rescan()
+                raise
+
+    def get(self, kid):
+        """Returns the key identified by kid, or None if there is no (valid) certificate for it"""
+        keys = self._keys
+        if keys is None:
+            keys = self.load()
+        elif self._next_scan is not None and time.monotonic() >= self._next_scan:
+            # Do not start another rescan before this one updates _next_scan
+            self._next_scan = None
+            self._rescan_in_background()
+        try:
+            return keys.get(kid)
+        except TypeError:
+            return None
+
+    @property
+    def errors(self):
+        """A dictionary of the kids (or, for UCAMWEBAUTH_CERTS_DIR, the files) whose certificate could not be parsed
+        and the corresponding exception"""
+        self.load()
+        return self._errors
+
+    def clear(self):
+        """Discards the map. It will be rebuilt from the current settings the next time it is used."""
+        with self._lock:
+            self._keys = None
+            self._errors = {}
+            self._settings_keys = self._settings_errors = None
+            self._files = {}
+            self._next_scan = None
+
+    def _reset_lock(self):
+        # A lock held by another thread at fork time would never be released in the child, and the thread that held
+        # it does not exist there
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._scan_thread = None
+        if self._keys is not None and get_settings().certs_dir is not None:
+            self._next_scan = 0
+
+
+registry = KeyRegistry()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry._reset_lock)
+
+
+@receiver(setting_changed)
+def reload_keys(setting, **kwargs):
+    if setting in ('UCAMWEBAUTH_CERTS', 'UCAMWEBAUTH_CERTS_DIR', 'UCAMWEBAUTH_CERTS_DIR_INTERVAL',
+                   'UCAMWEBAUTH_VERIFIER'):
+        registry.clear()
@@ -0,0 +1,128 @@
+import csv
+import gzip
+import hashlib
+import json
+import re
+import sys
+import time
+from collections import deque
+from datetime import datetime, timezone
+try:
+    from urllib import unquote_plus
+except ImportError:
+    from urllib.parse import unquote_plus
+from django.core.management.base import BaseCommand, CommandError
+from ucamwebauth.batch import verify_responses
+from ucamwebauth.utils import TTLCache
+
+# A WLS-Response query parameter, anywhere in a log line (e.g. in the request line of a combined format access log)
+WLS_RESPONSE_RE = re.compile(r'[?&]WLS-Response=([^&\s"\'#]+)')
+
+FIELDS = ('source', 'line', 'principal', 'issue', 'kid', 'verdict', 'reason')
+
+
+class Command(BaseCommand):
+    help = ("Extracts the WLS-Response parameters from web server access logs (optionally gzipped) and verifies them, "
+            "writing a report with a row per distinct response. The logs are streamed, so memory use does not depend "
+            "on their size.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('logs', nargs='+', help="Log files to read ('-' for the standard input). Files ending in "
+                                                    ".gz are decompressed.")
+        parser.add_argument('--output', '-o', default='-', help="The report file (default: the standard output).")
+        parser.add_argument('--format', dest='report_format', choices=('csv', 'jsonl'), default='csv',
+                            help="The report format.")
+        parser.add_argument('--invalid-only', action='store_true', help="Only report responses that failed "
+                                                                        "verification.")
+        parser.add_argument('--url', default=None, help="Also check that the responses were sent to this URL.")
+        parser.add_argument('--check-timeout', action='store_true',
+                            help="Reject responses issued more than UCAMWEBAUTH_TIMEOUT seconds ago (not useful for "
+                                 "old logs).")
+        parser.add_argument('--executor', choices=('thread', 'process', 'none'), default='process',
+                            help="How responses are verified in parallel (default: a process pool).")
+        parser.add_argument('--workers', type=int, default=None, help="The number of workers (default: the number "
+                                                                      "of CPUs).")
+        parser.add_argument('--chunksize', type=int, default=256, help="Responses sent to a worker at a time.")
+        parser.add_argument('--dedupe-size', type=int, default=100000,
+                            help="The number of distinct responses remembered to skip duplicates. A duplicate seen "
+                                 "after this many other responses is reported again.")
+
+    def handle(self, logs, output, report_format, invalid_only, url, check_timeout, executor, workers, chunksize,
+               dedupe_size, verbosity, **options):
+        if dedupe_size <= 0 or chunksize <= 0 or (workers is not None and workers <= 0):
+            raise CommandError("--dedupe-size, --chunksize and --workers must be positive integers")
+        self.stats = dict.fromkeys(('lines', 'bytes', 'found', 'duplicates', 'valid', 'invalid'), 0)
+        self.seen = TTLCache(maxsize=dedupe_size)
+        # The (source, line) of the responses being verified: verify_responses returns results in order, and only
+        # reads a bounded number of responses ahead, so this stays small
+        self.locations = deque()
+
+        start = time.perf_counter()
+        out = self.stdout if output == '-' else open(output, 'w', newline='')
+        try:
+            write = self.get_writer(out, report_format)
+            results = verify_responses(self.extract(logs), url=url, check_timeout=check_timeout,
+                                       executor=None if executor == 'none' else executor, workers=workers,
+                                       chunksize=chunksize)
+            for result in results:
+                source, line = self.locations.popleft()
+                self.stats['valid' if result.valid else 'invalid'] += 1
+                if invalid_only and result.valid:
+                    continue
+                write({'source': source, 'line': line, 'principal': result.principal,
+                       'issue': format_issue(result.issue), 'kid': result.kid,
+                       'verdict': 'valid' if result.valid else 'invalid', 'reason': result.reason})
+        finally:
+            if out is not self.stdout:
+                out.close()
+
+        if verbosity >= 1:
+            elapsed = max(time.perf_counter() - start, 1e-6)
+            stats = self.stats
+            self.stderr.write("%d lines (%.1f MB) read, %d responses found (%d duplicates skipped), %d valid, "
+                              "%d invalid, in %.1fs: %.0f lines/s, %.1f MB/s, %.0f responses/s" %
+                              (stats['lines'], stats['bytes'] / 1e6, stats['found'], stats['duplicates'],
+                               stats['valid'], stats['invalid'], elapsed, stats['lines'] / elapsed,
+                               stats['bytes'] / 1e6 / elapsed, (stats['valid'] + stats['invalid']) / elapsed))
+
+    def get_writer(self, out, report_format):
+        if report_format == 'jsonl':
+            return lambda row: out.write(json.dumps(row) + '\n')
+        writer = csv.DictWriter(out, FIELDS)
+        writer.writeheader()
+        return writer.writerow
+
+    def extract(self, logs):
+        """Yields the distinct WLS responses in logs, in order, recording where each was first found"""
+        stats = self.stats
+        for source in logs:
+            with self.open_log(source) as f:
+                for number, line in enumerate(f, 1):
+                    stats['lines'] += 1
+                    stats['bytes'] += len(line)
+                    for match in WLS_RESPONSE_RE.finditer(line):
+                        stats['found'] += 1
+                        # Query strings encode spaces as '+'
+                        response_str = unquote_plus(match.group(1))
+                        # Remember a digest, not the response, to bound the memory used by long responses
+                        if not self.seen.add(hashlib.sha1(response_str.encode()).digest(), True):
+                            stats['duplicates'] += 1
+                            continue
+                        self.locations.append((source, number))
+                        yield response_str
+
+    def open_log(self, source):
+        try:
+            if source == '-':
+                return open(sys.stdin.fileno(), errors='replace', closefd=False)
+            if source.endswith('.gz'):
+                return gzip.open(source, 'rt', errors='replace')
+            return open(source, errors='replace')
+        except OSError as e:
+            raise CommandError("Cannot read %s: %s" % (source, e))
+
+
+def format_issue(issue):
+    if issue is None:
+        return None
+    return datetime.fromtimestamp(issue, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -0,0 +1,74 @@
+import time
+from importlib import import_module
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from ucamwebauth.backends import RavenAuthBackend
+from ucamwebauth.principal import PRINCIPAL_SESSION_KEY
+
+
+class Command(BaseCommand):
+    help = ("Deletes the expired sessions of users logged in with Raven (by RavenAuthBackend, RavenPrincipalBackend or "
+            "any other subclass of RavenAuthBackend in AUTHENTICATION_BACKENDS), in batches so that the session table is "
+            "never locked for long. Only works with database-backed session engines.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='The number of expired sessions examined, and at most deleted, per batch.')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to wait between batches, to limit the load on the database.')
+        parser.add_argument('--dry-run', action='store_true', help='Count the sessions without deleting them.')
+
+    def handle(self, batch_size, pause, dry_run, verbosity, **options):
+        if batch_size <= 0:
+            raise CommandError("--batch-size must be a positive integer")
+        engine = import_module(settings.SESSION_ENGINE)
+        try:
+            model = engine.SessionStore.get_model_class()
+        except AttributeError:
+            raise CommandError("Session engine '%s' does not store sessions in the database" %
+                               settings.SESSION_ENGINE)
+
+        self.backends = self.get_raven_backends()
+        store = engine.SessionStore()
+        now = timezone.now()
+        expired = model.objects.filter(expire_date__lt=now).order_by('session_key')
+        deleted = examined = 0
+        last_key = None
+        while True:
+            batch = expired if last_key is None else expired.filter(session_key__gt=last_key)
+            sessions = list(batch.values_list('session_key', 'session_data')[:batch_size])
+            if not sessions:
+                break
+            last_key = sessions[-1][0]
+            examined += len(sessions)
+            keys = [key for key, data in sessions if self.is_raven_session(store, data)]
+            if keys and not dry_run:
+                model.objects.filter(session_key__in=keys, expire_date__lt=now).delete()
+            deleted += len(keys)
+            if verbosity >= 2:
+                self.stdout.write("Examined %d expired sessions, %d of them Raven sessions" % (examined, deleted))
+            if pause and len(sessions) == batch_size:
+                time.sleep(pause)
+
+        if verbosity >= 1:
+            self.stdout.write("%s %d expired Raven sessions (of %d expired sessions)" %
+                              ('Found' if dry_run else 'Deleted', deleted, examined))
+
+    def get_raven_backends(self):
+        """Returns the paths of the backends of AUTHENTICATION_BACKENDS that are RavenAuthBackend or a subclass"""
+        backends = set()
+        for path in settings.AUTHENTICATION_BACKENDS:
+            try:
+                backend = import_string(path)
+            except ImportError:
+                continue
+            if isinstance(backend, type) and issubclass(backend, RavenAuthBackend):
+                backends.add(path)
+        return backends
+
+    def is_raven_session(self, store, session_data):
+        # decode() returns an empty dictionary for data that cannot be decoded
+        data = store.decode(session_data)
+        return data.get('_auth_user_backend') in self.backends or PRINCIPAL_SESSION_KEY in data
@@ -0,0 +1,123 @@
+import sys
+from itertools import islice
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.signals import post_save
+from ucamwebauth.backends import RavenAuthBackend
+from ucamwebauth.models import UserProfile
+from ucamwebauth.usercache import invalidate_user
+
+
+class Command(BaseCommand):
+    help = ("Creates the users and profiles of a list of Raven principals ahead of their first login, and updates the "
+            "raven_for_life of their profiles, in batches. Each line of the input is a principal, optionally followed "
+            "by a comma and their ptags as in a WLS response: users whose ptags do not include 'current' are Raven for "
+            "life. The profiles of principals without ptags are created but not updated. New users are sent "
+            "post_save and configured with RavenAuthBackend.configure_user, as on their first login.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('principals', nargs='?', default='-',
+                            help="The file of principals (default: the standard input).")
+        parser.add_argument('--batch-size', type=int, default=1000, help="The number of principals per batch.")
+        parser.add_argument('--no-create', action='store_true',
+                            help="Only update the profiles of existing users, do not create users.")
+        parser.add_argument('--dry-run', action='store_true', help="Count the changes without making them.")
+
+    def handle(self, principals, batch_size, no_create, dry_run, verbosity, **options):
+        if batch_size <= 0:
+            raise CommandError("--batch-size must be a positive integer")
+        self.backend = RavenAuthBackend()
+        self.totals = dict.fromkeys(('principals', 'users', 'profiles', 'updated'), 0)
+        try:
+            f = open(sys.stdin.fileno(), closefd=False) if principals == '-' else open(principals)
+        except OSError as e:
+            raise CommandError("Cannot read %s: %s" % (principals, e))
+        with f:
+            rows = self.parse(f)
+            while True:
+                batch = dict(islice(rows, batch_size))
+                if not batch:
+                    break
+                with transaction.atomic():
+                    self.provision(batch, not no_create, dry_run)
+                    if dry_run:
+                        transaction.set_rollback(True)
+                if verbosity >= 2:
+                    self.stdout.write("%(principals)d principals processed" % self.totals)
+
+        if verbosity >= 1:
+            self.stdout.write("%s %d users and %d profiles, updated raven_for_life of %d profiles (%d principals)" %
+                              (('Would create' if dry_run else 'Created',) +
+                               tuple(self.totals[key] for key in ('users', 'profiles', 'updated', 'principals'))))
+
+    def parse(self, lines):
+        """Yields a (username, raven_for_life or None) pair for each line"""
+        for line in lines:
+            principal, comma, ptags = line.strip().partition(',')
+            if not principal.strip():
+                continue
+            raven_for_life = None
+            if comma:
+                raven_for_life = 'current' not in [ptag.strip() for ptag in ptags.split(',')]
+            yield self.backend.clean_username(principal.strip()), raven_for_life
+
+    def provision(self, batch, create, dry_run):
+        """Creates the missing users and profiles of a batch of usernames and updates raven_for_life where it
+        differs, with a bounded number of queries whatever the size of the batch."""
+        UserModel = get_user_model()
+        manager = UserModel._default_manager
+        lookup = '%s__in' % UserModel.USERNAME_FIELD
+        self.totals['principals'] += len(batch)
+
+        users = {user.get_username(): user for user in manager.filter(**{lookup: list(batch)})}
+        if create:
+            missing = [username for username in batch if username not in users]
+            new_users = []
+            for username in missing:
+                user = UserModel(**{UserModel.USERNAME_FIELD: username})
+                user.set_unusable_password()
+                new_users.append(user)
+            # ignore_conflicts: users may log in, and be created by RavenAuthBackend, at the same time
+            manager.bulk_create(new_users, ignore_conflicts=True)
+            if missing:
+                passwords = {user.get_username(): user.password for user in new_users}
+                for user in manager.filter(**{lookup: missing}):
+                    # Unusable passwords are random, so the password tells whether the row is the one inserted above
+                    # (as in RavenAuthBackend.get_user_for_principal)
+                    if user.password == passwords[user.get_username()]:
+                        self.totals['users'] += 1
+                        if not dry_run:
+                            # bulk_create() does not send post_save, but receivers may rely on it for new users
+                            post_save.send(sender=UserModel, instance=user, created=True, update_fields=None,
+                                           raw=False, using=user._state.db)
+                            user = self.backend.configure_user(None, user)
+                    users[user.get_username()] = user
+
+        profiles = dict(UserProfile.objects.filter(user__in=[user.pk for user in users.values()])
+                        .values_list('user_id', 'raven_for_life'))
+        new_profiles = []
+        updates = {True: [], False: []}
+        for username, user in users.items():
+            raven_for_life = batch.get(username)
+            if user.pk not in profiles:
+                new_profiles.append(UserProfile(user_id=user.pk, raven_for_life=bool(raven_for_life)))
+            elif raven_for_life is not None and profiles[user.pk] != raven_for_life:
+                updates[raven_for_life].append(user.pk)
+        UserProfile.objects.bulk_create(new_profiles, ignore_conflicts=True)
+        if new_profiles:
+            inserted = {profile.user_id: profile.raven_for_life for profile in new_profiles}
+            # The insert skips the profiles created meanwhile by concurrent logins: those with another raven_for_life
+            # are not ours, and those with the same one are the profiles the command would have created
+            self.totals['profiles'] += sum(1 for user_id, raven_for_life in UserProfile.objects.filter(
+                user__in=list(inserted)).values_list('user_id', 'raven_for_life') if inserted[user_id] == raven_for_life)
+        for raven_for_life, user_ids in updates.items():
+            if user_ids:
+                UserProfile.objects.filter(user__in=user_ids).update(raven_for_life=raven_for_life)
+                self.totals['updated'] += len(user_ids)
+
+        if not dry_run:
+            # Neither bulk_create() nor update() send post_save, which would invalidate the cached users
+            for user_ids in [[profile.user_id for profile in new_profiles]] + list(updates.values()):
+                for user_id in user_ids:
+                    invalidate_user(user_id)
@@ -0,0 +1,180 @@
+"""Optional instrumentation of the login pipeline.
+
+When UCAMWEBAUTH_METRICS is True, every login records:
+
+- timings, named 'phase' and labelled with the phase: 'parse' (RavenResponse, up to the signature check),
+  'certificate' (looking up the key), 'verify' (RSA verification), 'user' (fetching or creating the user), 'profile'
+  (creating or updating the profile), 'attributes' (getting the user's attributes, see ucamwebauth.attributes), 'login'
+  (django.contrib.auth.login) and 'total' (the whole raven_return view).
+  A phase that raises is not timed.
+- counters named 'status', labelled with the WLS status code of every parsed response, and 'outcome', labelled
+  'success', 'rejected' (no user was authenticated) or the class name of the exception that failed the login.
+- a counter named 'gate', labelled with the class name of the exception, for every response rejected by
+  ucamwebauth.middleware.RavenReturnGateMiddleware (such responses never reach the view).
+- a counter named 'attributes', labelled 'hit', 'stale', 'miss', 'timeout', 'error', 'failed' (a recent error is
+  cached) or 'overload' (too many pending fetches), for the lookups of the attribute cache (see
+  ucamwebauth.attributes).
+- a counter named 'write_behind', labelled 'last_login' or 'raven_for_life' with the number of users updated by each
+  batch of write-behind updates, 'error', or 'dropped' with the number of updates dropped (see
+  ucamwebauth.writebehind).
+
+Each metric is a call hook(kind, name, label, value) to each of the callables named in UCAMWEBAUTH_METRICS_HOOKS, where
+kind is 'timing' (value in seconds) or 'counter', and is also sent as the ucamwebauth.signals.metric_recorded signal.
+PrometheusCollector and StatsdHook are hooks that expose metrics in the Prometheus text format and send them to statsd.
+
+When UCAMWEBAUTH_METRICS is False, the instrumented code only pays for a settings lookup and a no-op call per phase.
+"""
+import logging
+import socket
+import threading
+import time
+from itertools import groupby
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from ucamwebauth.conf import get_settings
+from ucamwebauth.signals import metric_recorded
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseTimer(object):
+    """Times consecutive phases: each lap records the time since the timer was created or since the previous lap."""
+
+    __slots__ = ('last', )
+
+    def __init__(self):
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        record('timing', 'phase', phase, now - self.last)
+        self.last = now
+
+
+class _NullTimer(object):
+
+    __slots__ = ()
+
+    def lap(self, phase):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def timer():
+    """Returns a PhaseTimer, or a timer that does nothing if metrics are disabled"""
+    return PhaseTimer() if get_settings().metrics else NULL_TIMER
+
+
+def incr(name, label, value=1):
+    """Increments the counter name for label, if metrics are enabled"""
+    if get_settings().metrics:
+        record('counter', name, label, value)
+
+
+_hooks = None
+
+
+def get_hooks():
+    """Returns the callables named in UCAMWEBAUTH_METRICS_HOOKS"""
+    global _hooks
+    if _hooks is None:
+        _hooks = [import_string(path) for path in get_settings().metrics_hooks]
+    return _hooks
+
+
+def record(kind, name, label, value):
+    """Passes a metric to the hooks and the metric_recorded signal. Errors in them are logged, not raised, so that
+    they cannot break logins."""
+    for hook in get_hooks():
+        try:
+            hook(kind, name, label, value)
+        except Exception:
+            logger.exception("Metrics hook %r failed", hook)
+    if metric_recorded.receivers:
+        responses = metric_recorded.send_robust(sender=None, kind=kind, name=name, label=label, value=value)
+        for receiver_, response in responses:
+            if isinstance(response, Exception):
+                logger.error("metric_recorded receiver %r failed: %s", receiver_, response)
+
+
+@receiver(setting_changed)
+def reset_hooks(setting, **kwargs):
+    global _hooks
+    if setting == 'UCAMWEBAUTH_METRICS_HOOKS':
+        _hooks = None
+
+
+class PrometheusCollector(object):
+    """A hook that aggregates metrics in memory, in this process. render() returns them in the Prometheus text
+    exposition format: timings as summaries (ucamwebauth_phase_seconds_sum and _count) and counters as
+    ucamwebauth_<name>_total."""
+
+    def __init__(self, prefix='ucamwebauth'):
+        self.prefix = prefix
+        self._timings = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, kind, name, label, value):
+        with self._lock:
+            if kind == 'timing':
+                total = self._timings.setdefault((name, str(label)), [0.0, 0])
+                total[0] += value
+                total[1] += 1
+            else:
+                key = (name, str(label))
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def clear(self):
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+
+    def render(self):
+        with self._lock:
+            timings = sorted(self._timings.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        for name, items in groupby(timings, key=lambda item: item[0][0]):
+            metric = '%s_%s_seconds' % (self.prefix, name)
+            lines.append('# TYPE %s summary' % metric)
+            for (name, label), (total, count) in items:
+                lines.append('%s_sum%s %r' % (metric, _labels(name, label), total))
+                lines.append('%s_count%s %d' % (metric, _labels(name, label), count))
+        for name, items in groupby(counters, key=lambda item: item[0][0]):
+            metric = '%s_%s_total' % (self.prefix, name)
+            lines.append('# TYPE %s counter' % metric)
+            for (name, label), value in items:
+                lines.append('%s%s %d' % (metric, _labels(name, label), value))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(name, label):
+    return '{%s="%s"}' % (name, label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+# A collector that can be named in UCAMWEBAUTH_METRICS_HOOKS ('ucamwebauth.metrics.collector') and rendered by a view
+collector = PrometheusCollector()
+
+
+def format_statsd(kind, name, label, value, prefix='ucamwebauth'):
+    """Returns a metric as a statsd line, e.g. 'ucamwebauth.phase.verify:0.123|ms' or 'ucamwebauth.status.200:1|c'"""
+    if kind == 'timing':
+        return '%s.%s.%s:%.3f|ms' % (prefix, name, label, value * 1000)
+    return '%s.%s.%s:%d|c' % (prefix, name, label, value)
+
+
+class StatsdHook(object):
+    """A hook that sends each metric to a statsd server in a UDP datagram. To use it, create one in your project, e.g.
+    statsd = StatsdHook('statsd.example.com'), and name it in UCAMWEBAUTH_METRICS_HOOKS."""
+
+    def __init__(self, host='localhost', port=8125, prefix='ucamwebauth'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, kind, name, label, value):
+        self._socket.sendto(format_statsd(kind, name, label, value, self.prefix).encode(), self.address)
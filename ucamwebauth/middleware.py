@@ -1,25 +1,283 @@
+import time
+from asgiref.sync import sync_to_async
 from django.contrib import messages
-from django.http import HttpResponseServerError, HttpResponseForbidden
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.views import redirect_to_login
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.template.loader import get_template
+from django.urls import NoReverseMatch, get_urlconf, reverse
 from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+from django.utils.module_loading import import_string
 
-from ucamwebauth import MalformedResponseError, InvalidResponseError, PublicKeyNotFoundError, UserNotAuthorised, \
-    OtherStatusCode
+from ucamwebauth import metrics
+from ucamwebauth.access import get_path_rules
+from ucamwebauth.conf import get_settings
+from ucamwebauth.exceptions import InvalidResponseError, MalformedResponseError, PublicKeyNotFoundError, \
+    UserNotAuthorised
+from ucamwebauth.keys import registry
+from ucamwebauth.principal import get_principal
+from ucamwebauth.utils import parse_time, reverse_path_info, tokenize_response
+
+# The response to each exception (and its subclasses) unless UCAMWEBAUTH_ERROR_RESPONSES overrides it
+DEFAULT_ERROR_RESPONSES = {
+    'ucamwebauth.exceptions.MalformedResponseError': (500, 'ucamwebauth_500.html'),
+    'ucamwebauth.exceptions.InvalidResponseError': (500, 'ucamwebauth_500.html'),
+    'ucamwebauth.exceptions.OtherStatusCode': (500, 'ucamwebauth_500.html'),
+    'ucamwebauth.exceptions.PublicKeyNotFoundError': (500, 'ucamwebauth_500.html'),
+    'ucamwebauth.exceptions.UserNotAuthorised': (403, 'ucamwebauth_403.html'),
+}
+
+
+class ErrorPage(object):
+    """Renders the response to an exception. The template is only looked up once and, if static is True, only rendered
+    once, without the request: the page is then the same for everyone and does not show the exception message."""
+
+    def __init__(self, status, template_name, static=False):
+        self.status = status
+        self.template_name = template_name
+        self.static = static
+        self._template = None
+        self._body = None
+
+    @property
+    def template(self):
+        if self._template is None:
+            self._template = get_template(self.template_name)
+        return self._template
+
+    def __call__(self, request, exception):
+        if self.static:
+            if self._body is None:
+                self._body = self.template.render({}).encode()
+            return HttpResponse(self._body, status=self.status)
+        messages.error(request, str(exception))
+        return HttpResponse(self.template.render({}, request), status=self.status)
+
+
+_error_pages = None
+_pages_by_class = {}
+_static_pages = {}
+
+
+def get_error_page(exception_class):
+    """Returns the ErrorPage for exception_class, from the first of its classes (in method resolution order) that
+    DEFAULT_ERROR_RESPONSES or UCAMWEBAUTH_ERROR_RESPONSES map to a response, or None if there is none."""
+    global _error_pages
+    try:
+        return _pages_by_class[exception_class]
+    except KeyError:
+        pass
+    if _error_pages is None:
+        config = get_settings()
+        responses = dict(DEFAULT_ERROR_RESPONSES, **config.error_responses)
+        error_pages = {}
+        for path, response in responses.items():
+            if response is None:
+                continue
+            try:
+                klass = import_string(path)
+            except ImportError as e:
+                raise ImproperlyConfigured("UCAMWEBAUTH_ERROR_RESPONSES has an invalid exception class: %s" % e)
+            error_pages[klass] = ErrorPage(response[0], response[1], config.static_error_pages)
+        _error_pages = error_pages
+    page = next((_error_pages[klass] for klass in exception_class.__mro__ if klass in _error_pages), None)
+    _pages_by_class[exception_class] = page
+    return page
+
+
+def get_static_error_page(exception_class):
+    """Like get_error_page, but always returns a static ErrorPage (or None)"""
+    try:
+        return _static_pages[exception_class]
+    except KeyError:
+        pass
+    page = get_error_page(exception_class)
+    if page is not None and not page.static:
+        page = ErrorPage(page.status, page.template_name, static=True)
+    _static_pages[exception_class] = page
+    return page
+
+
+@receiver(setting_changed)
+def reset_error_pages(setting, **kwargs):
+    global _error_pages
+    if setting.startswith('UCAMWEBAUTH_') or setting == 'TEMPLATES':
+        _error_pages = None
+        _pages_by_class.clear()
+        _static_pages.clear()
 
 
 class DefaultErrorBehaviour(MiddlewareMixin):
     """ A middleware that catches django-ucamwebauth exceptions and show HTTP 500 or HTTP 403 error messages,
     depending of the error. Furthermore, it uses templates that can be rewritten by a developer.
+
+    The status and template for each exception (including its subclasses) can be changed with
+    UCAMWEBAUTH_ERROR_RESPONSES, see get_error_page.
+
+    It is both sync and async capable: under ASGI the request is passed straight to the async views without a thread
+    switch. Django always calls process_exception synchronously, so only failed logins are handed to a thread.
     """
     def process_exception(self, request, exception):
-        if exception.__class__ == MalformedResponseError or \
-                exception.__class__ == InvalidResponseError or \
-                exception.__class__ == OtherStatusCode or \
-                exception.__class__ == PublicKeyNotFoundError:
-            template = get_template("ucamwebauth_500.html")
-            messages.error(request, str(exception))
-            return HttpResponseServerError(template.render({}, request))
-        elif exception.__class__ == UserNotAuthorised:
-            template = get_template("ucamwebauth_403.html")
-            messages.error(request, str(exception))
-            return HttpResponseForbidden(template.render({}, request))
+        page = get_error_page(type(exception))
+        if page is not None:
+            return page(request, exception)
+
+
+class RavenPrincipalMiddleware(MiddlewareMixin):
+    """ A middleware that sets request.user to the RavenPrincipal stored in the session by RavenPrincipalBackend logins
+    (see ucamwebauth.principal), if there is one. It must come after AuthenticationMiddleware, whose user is used
+    otherwise. Like it, the session is only read when request.user is first used.
+    """
+
+    def process_request(self, request):
+        fallback = getattr(request, 'user', None)
+        request.user = SimpleLazyObject(lambda: get_principal(request) or fallback or AnonymousUser())
+
+
+def precheck_response(response_str):
+    """Applies the checks of RavenResponse that need neither the signature verification nor any I/O: the length of the
+    response (at most UCAMWEBAUTH_GATE_MAX_LENGTH characters), the version and number of fields, the issue time and,
+    for successful authentications, whether the key that signed the response is known. A response that passes may
+    still be rejected by RavenResponse.
+    @exception MalformedResponseError, InvalidResponseError or PublicKeyNotFoundError, as RavenResponse would raise"""
+    config = get_settings()
+    if len(response_str) > config.gate_max_length:
+        raise MalformedResponseError("The WLS response is too long (%d characters)" % len(response_str))
+    ver, tokens, data = tokenize_response(response_str)
+    try:
+        issue = parse_time(tokens[3])
+    except ValueError:
+        raise MalformedResponseError("Issue time is not a valid time, got %s" % tokens[3])
+    now = time.time()
+    if issue > now:
+        raise InvalidResponseError("The timestamp on the response is in the future")
+    if issue < now - config.timeout:
+        raise InvalidResponseError("Response has timed out")
+    if tokens[1] == '200':
+        # The same checks, and exceptions, as RavenResponse
+        kid = None
+        if tokens[-2] != '':
+            try:
+                kid = int(tokens[-2])
+            except ValueError:
+                raise MalformedResponseError("kid parameter must be an integer, not %s" % tokens[-2])
+        if tokens[-1] == '':
+            raise InvalidResponseError("Signature must be present if status is 200")
+        if kid is None:
+            raise InvalidResponseError("kid must be present if signature is present")
+        if registry.get(kid) is None:
+            raise PublicKeyNotFoundError("The server do not have the public key corresponding to the key the web "
+                                         "login service signed the response with")
+
+
+# The path of raven_return (see reverse_path_info) per URLconf, or None if it has none
+_return_paths = {}
+
+
+def get_return_path():
+    urlconf = get_urlconf()
+    try:
+        return _return_paths[urlconf]
+    except KeyError:
+        pass
+    try:
+        path = reverse_path_info('raven_return')
+    except NoReverseMatch:
+        path = None
+    _return_paths[urlconf] = path
+    return path
+
+
+@receiver(setting_changed)
+def reset_return_paths(setting, **kwargs):
+    if setting in ('ROOT_URLCONF', 'FORCE_SCRIPT_NAME'):
+        _return_paths.clear()
+
+
+class RavenReturnGateMiddleware(MiddlewareMixin):
+    """ A middleware that rejects implausible WLS responses (see precheck_response) before the rest of the middleware
+    stack runs, e.g. to shed a flood of forged or replayed logins without reading sessions or using the database. It
+    must come first in MIDDLEWARE.
+
+    Only requests for raven_return with a WLS-Response query parameter are checked. Rejected requests get the error
+    page of the exception (see get_error_page) rendered statically, since the messages framework has not run yet, and
+    are counted in the 'gate' metric, labelled with the exception.
+
+    The checks do no I/O, so under ASGI they run in the event loop instead of a thread.
+    """
+    def process_request(self, request):
+        if 'WLS-Response' not in request.META.get('QUERY_STRING', '') or request.path_info != get_return_path():
+            return None
+        response_str = request.GET.get('WLS-Response')
+        if response_str is None:
+            return None
+        try:
+            precheck_response(response_str)
+        except (MalformedResponseError, InvalidResponseError, PublicKeyNotFoundError) as e:
+            metrics.incr('gate', type(e).__name__)
+            page = get_static_error_page(type(e))
+            if page is None:
+                return HttpResponseBadRequest()
+            return page(request, e)
+        return None
+
+    async def __acall__(self, request):
+        response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+
+class RavenLoginRequiredMiddleware(MiddlewareMixin):
+    """ A middleware that requires users to log in to see the paths of UCAMWEBAUTH_PROTECTED_PATHS, except those of
+    UCAMWEBAUTH_EXEMPT_PATHS (see ucamwebauth.access for how they are matched). Anonymous users are redirected to
+    raven_login, which brings them back to the page they asked for. With UCAMWEBAUTH_PROTECTED_REQUIRE_CURRENT, users
+    who are not current members of the University (whose profile is Raven for life, or who have no profile) get the
+    error page of UserNotAuthorised instead. It must come after AuthenticationMiddleware (and
+    RavenPrincipalMiddleware, if used).
+
+    The patterns are compiled once. Under ASGI, paths are matched in the event loop, and only requests for protected
+    paths are handed to a thread, to get the user.
+    """
+    def __init__(self, get_response):
+        super(RavenLoginRequiredMiddleware, self).__init__(get_response)
+        # Compile the patterns at startup, rather than on the first request
+        get_path_rules()
+
+    def process_request(self, request):
+        if not get_path_rules().is_protected(request.path_info):
+            return None
+        return self.check_user(request)
+
+    def check_user(self, request):
+        user = request.user
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path(), reverse('raven_login'))
+        if get_settings().protected_require_current and raven_for_life(user) is not False:
+            exception = UserNotAuthorised("Only current members of the University can see this page")
+            # The message can only be shown if MessageMiddleware came first
+            page = (get_error_page if hasattr(request, '_messages') else get_static_error_page)(UserNotAuthorised)
+            if page is None:
+                return HttpResponseForbidden()
+            return page(request, exception)
+        return None
+
+    async def __acall__(self, request):
+        response = None
+        if get_path_rules().is_protected(request.path_info):
+            response = await sync_to_async(self.check_user)(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+
+def raven_for_life(user):
+    """Returns the raven_for_life of the profile of user, or None if they have no profile"""
+    try:
+        return user.profile.raven_for_life
+    except (AttributeError, ObjectDoesNotExist):
+        return None
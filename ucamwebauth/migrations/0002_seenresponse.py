@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ucamwebauth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeenResponse',
+            fields=[
+                ('key', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('expires', models.BigIntegerField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,231 @@
+"""A stand-in for the University's web login service (WLS), to test and load-test the login flow offline.
+
+MockWLS builds signed WLS responses with a private key of its own (generated, or loaded from a PEM file) whose
+certificate is trusted by the site under test, e.g. through UCAMWEBAUTH_CERTS_DIR. make_server() wraps it in an HTTP
+server that answers the authentication requests raven_login redirects to (set UCAMWEBAUTH_LOGIN_URL to its URL) with a
+redirect to the return URL, as the WLS does once the user has logged in, without asking for any credentials:
+
+    python -m ucamwebauth.mockwls --port 8081 --certs-dir /tmp/wls-certs --principal test0001
+
+The principal and status of a response can be chosen per request with the X-Mock-Principal and X-Mock-Status headers,
+or with the userid and cancel fields of a POST, as for the form of the test WLS (test.legacy.raven.cam.ac.uk).
+Everything else in the response (ptags, auth or sso, life, and the skew of the issue time) is set for the whole server.
+Only for testing: it authenticates anyone as anyone.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from base64 import b64encode
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+# The status codes the WLS may return, see ucamwebauth.RavenResponse.STATUS
+STATUSES = (200, 410, 510, 520, 530, 540, 560, 570)
+
+
+def escape(value):
+    """%-encodes the characters of a field that would break a WLS response"""
+    return value.replace('%', '%25').replace('!', '%21')
+
+
+class MockWLS(object):
+    """Signs WLS responses with an RSA key, like the WLS.
+    @param key_pem The private key (PEM), or None to generate one
+    @param kid The key id of the key, sent with every signature
+    @param principal The principal authenticated when a request does not name one
+    @param ptags, auth, sso, life The fields of successful responses. auth should be '' when sso is set.
+    @param skew Seconds added to the issue time of every response, to simulate a WLS whose clock is wrong (negative
+        values make responses look old)
+    """
+
+    def __init__(self, key_pem=None, kid=901, principal='test0001', ptags='current', auth='pwd', sso='', life=36000,
+                 skew=0):
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.primitives.serialization import load_pem_private_key
+        if key_pem is None:
+            self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        else:
+            self.key = load_pem_private_key(key_pem.encode() if isinstance(key_pem, str) else key_pem, password=None)
+        self.kid = kid
+        self.principal = principal
+        self.ptags = ptags
+        self.auth = auth
+        self.sso = sso
+        self.life = life
+        self.skew = skew
+        self._ids = count(1)
+        self._prefix = '%d-%d' % (time.time(), os.getpid())
+
+    @property
+    def certificate_pem(self):
+        """A self-signed certificate for the key, to trust in UCAMWEBAUTH_CERTS or UCAMWEBAUTH_CERTS_DIR"""
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.serialization import Encoding
+        from cryptography.x509.oid import NameOID
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'ucamwebauth mock WLS key %d' % self.kid)])
+        now = datetime.now(timezone.utc)
+        certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+            .public_key(self.key.public_key()).serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=3650)) \
+            .sign(self.key, hashes.SHA256())
+        return certificate.public_bytes(Encoding.PEM).decode()
+
+    def write_certificate(self, directory):
+        """Writes the certificate to directory as pubkey<kid>.crt, the name UCAMWEBAUTH_CERTS_DIR expects
+        @return the path of the file"""
+        path = os.path.join(directory, 'pubkey%d.crt' % self.kid)
+        with open(path, 'w') as f:
+            f.write(self.certificate_pem)
+        return path
+
+    def sign(self, data):
+        from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+        from cryptography.hazmat.primitives.hashes import SHA1
+        signature = b64encode(self.key.sign(data.encode(), PKCS1v15(), SHA1())).decode()
+        return signature.replace('+', '-').replace('/', '.').replace('=', '_')
+
+    def response(self, url, status=200, principal=None, params='', msg='', ver=3, issue=None):
+        """Returns a WLS response for an authentication request
+        @param url The return URL of the request
+        @param status The status code. Only successful (200) responses name a principal and are signed.
+        @param principal The authenticated principal, by default self.principal
+        @param params, ver The params and ver of the request
+        @param msg The message sent with the status
+        @param issue The issue time in seconds since the epoch, by default now (plus self.skew)"""
+        if issue is None:
+            issue = time.time() + self.skew
+        fields = [str(ver), str(status), msg, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(issue)),
+                  '%s-%d' % (self._prefix, next(self._ids)), url]
+        if status == 200:
+            fields += [principal or self.principal, self.ptags, self.auth, self.sso,
+                       '' if self.life is None else str(self.life)]
+        else:
+            fields += ['', '', '', '', '']
+        if ver != 3:
+            # ptags were added in version 3
+            del fields[7]
+        fields.append(params)
+        data = '!'.join(escape(field) for field in fields)
+        if status != 200:
+            return data + '!!'
+        return '%s!%d!%s' % (data, self.kid, self.sign(data))
+
+    def redirect(self, query, status=None, principal=None):
+        """Returns the URL the WLS would redirect to for an authentication request with the (parsed) query string
+        query, or None if the request has no return URL"""
+        url = query.get('url', [None])[0]
+        if not url:
+            return None
+        try:
+            ver = int(query.get('ver', ['3'])[0])
+        except ValueError:
+            ver = 3
+        if status is None:
+            status = 200
+        response = self.response(url, status=status, principal=principal, params=query.get('params', [''])[0],
+                                 ver=ver)
+        return '%s%s%s' % (url, '&' if '?' in url else '?', urlencode({'WLS-Response': response}))
+
+
+class WLSRequestHandler(BaseHTTPRequestHandler):
+    """Answers authentication requests (GET with the request in the query string, or POST with it in the body) with a
+    303 redirect to the return URL with a response from self.server.wls."""
+
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        status = self.headers.get('X-Mock-Status')
+        try:
+            status = int(status) if status else None
+        except ValueError:
+            self.send_error(400, "X-Mock-Status must be a status code")
+            return
+        self.respond(parse_qs(urlsplit(self.path).query), status, self.headers.get('X-Mock-Principal'))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        query = parse_qs(self.rfile.read(length).decode())
+        status = 410 if 'cancel' in query else None
+        self.respond(query, status, query.get('userid', [None])[0])
+
+    def respond(self, query, status, principal):
+        if status is not None and status not in STATUSES:
+            self.send_error(400, "Unknown status %d" % status)
+            return
+        location = self.server.wls.redirect(query, status, principal)
+        if location is None:
+            self.send_error(400, "No return URL (url) in the authentication request")
+            return
+        self.send_response(303)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(WLSRequestHandler, self).log_message(format, *args)
+
+
+def make_server(wls, host='127.0.0.1', port=0, verbose=False):
+    """Returns a (not yet started) threading HTTP server for wls. Port 0 picks a free port: see server.server_port."""
+    server = ThreadingHTTPServer((host, port), WLSRequestHandler)
+    server.daemon_threads = True
+    server.wls = wls
+    server.verbose = verbose
+    return server
+
+
+def serve_in_background(wls, host='127.0.0.1', port=0):
+    """Starts a server for wls in a daemon thread, e.g. in tests
+    @return the server, which should be shut down with server.shutdown() and server.server_close()"""
+    server = make_server(wls, host, port)
+    threading.Thread(target=server.serve_forever, name='ucamwebauth-mockwls', daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ucamwebauth.mockwls', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--key', help="The private key (PEM file). A new key is generated if not given.")
+    parser.add_argument('--kid', type=int, default=901)
+    parser.add_argument('--certs-dir', help="Write the certificate of the key to this directory, as pubkey<kid>.crt. "
+                                            "Otherwise it is printed.")
+    parser.add_argument('--principal', default='test0001')
+    parser.add_argument('--ptags', default='current')
+    parser.add_argument('--sso', default='', help="Simulate single sign-on with these authentication types (e.g. "
+                                                  "pwd) instead of an interactive login.")
+    parser.add_argument('--life', type=int, default=36000)
+    parser.add_argument('--skew', type=int, default=0, help="Seconds added to the issue time of the responses.")
+    parser.add_argument('--verbose', '-v', action='store_true', help="Log every request.")
+    args = parser.parse_args(argv)
+
+    key_pem = None
+    if args.key:
+        with open(args.key) as f:
+            key_pem = f.read()
+    wls = MockWLS(key_pem, kid=args.kid, principal=args.principal, ptags=args.ptags, auth='' if args.sso else 'pwd',
+                  sso=args.sso, life=args.life, skew=args.skew)
+    if args.certs_dir:
+        sys.stderr.write("Certificate written to %s\n" % wls.write_certificate(args.certs_dir))
+    else:
+        sys.stderr.write("Add this certificate to UCAMWEBAUTH_CERTS as kid %d:\n%s" % (args.kid, wls.certificate_pem))
+    server = make_server(wls, args.host, args.port, args.verbose)
+    sys.stderr.write("Mock WLS listening on http://%s:%d/ (set UCAMWEBAUTH_LOGIN_URL to this URL)\n" %
+                     (args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,3 +14,16 @@ class UserProfile(models.Model):
 
     def __str__(self):
         return str(self.user)
+
+
+class SeenResponse(models.Model):
+    """
+    A successful WLS response that has already been accepted, used by ucamwebauth.replay.DatabaseReplayCache to
+    reject replays. key is a hash of the response's (issue, ident) pair and expires is the time (in seconds since the
+    epoch) after which the response would be rejected as timed out, so the row can be deleted.
+    """
+    key = models.CharField(max_length=40, primary_key=True)
+    expires = models.BigIntegerField(db_index=True)
+
+    def __str__(self):
+        return self.key
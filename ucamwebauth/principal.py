@@ -0,0 +1,121 @@
+"""Database-free authentication, for sites that only need to know who the user is.
+
+ucamwebauth.backends.RavenPrincipalBackend returns a RavenPrincipal instead of a User: an in-memory user built from
+the WLS response, which raven_return stores in the session (under PRINCIPAL_SESSION_KEY, as [principal, raven_for_life])
+instead of logging in a User. ucamwebauth.middleware.RavenPrincipalMiddleware, placed after AuthenticationMiddleware,
+rebuilds it from the session on every request, so neither logins nor page views read or write the auth tables.
+"""
+from django.contrib.auth import SESSION_KEY
+from django.contrib.auth.models import EmptyManager, Group, Permission
+from django.middleware.csrf import rotate_token
+
+PRINCIPAL_SESSION_KEY = '_ucamwebauth_principal'
+
+
+class RavenPrincipal(object):
+    """An authenticated user that is not stored in the database. Like AnonymousUser, it has no primary key, groups or
+    permissions, and cannot be saved. user.profile.raven_for_life works as for a User with a UserProfile."""
+
+    id = None
+    pk = None
+    is_active = True
+    is_staff = False
+    is_superuser = False
+    _groups = EmptyManager(Group)
+    _user_permissions = EmptyManager(Permission)
+
+    def __init__(self, principal, raven_for_life=False):
+        self.username = principal
+        self.raven_for_life = raven_for_life
+
+    def __str__(self):
+        return self.username
+
+    def __repr__(self):
+        return '<RavenPrincipal: %s>' % self.username
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and other.username == self.username
+
+    def __hash__(self):
+        return hash(self.username)
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def profile(self):
+        return self
+
+    @property
+    def groups(self):
+        return self._groups
+
+    @property
+    def user_permissions(self):
+        return self._user_permissions
+
+    def get_username(self):
+        return self.username
+
+    def get_user_permissions(self, obj=None):
+        return set()
+
+    def get_group_permissions(self, obj=None):
+        return set()
+
+    def get_all_permissions(self, obj=None):
+        return set()
+
+    def has_perm(self, perm, obj=None):
+        return False
+
+    def has_perms(self, perm_list, obj=None):
+        return not perm_list
+
+    def has_module_perms(self, module):
+        return False
+
+    def save(self, *args, **kwargs):
+        raise NotImplementedError("RavenPrincipal is not stored in the database")
+
+    def delete(self, *args, **kwargs):
+        raise NotImplementedError("RavenPrincipal is not stored in the database")
+
+    def to_session(self):
+        return [self.username, self.raven_for_life]
+
+    @classmethod
+    def from_session(cls, data):
+        return cls(data[0], data[1])
+
+
+def login_principal(request, principal):
+    """Stores principal in the session, like django.contrib.auth.login does for a User. The session key is cycled, and
+    the session flushed if it belonged to someone else. user_logged_in is not sent: its receivers (such as the one
+    that updates User.last_login) expect a User."""
+    session = request.session
+    data = session.get(PRINCIPAL_SESSION_KEY)
+    if SESSION_KEY in session or (data is not None and data[0] != principal.username):
+        session.flush()
+    else:
+        session.cycle_key()
+    session[PRINCIPAL_SESSION_KEY] = principal.to_session()
+    rotate_token(request)
+    request.user = principal
+
+
+def get_principal(request):
+    """Returns the RavenPrincipal stored in the session, or None"""
+    data = request.session.get(PRINCIPAL_SESSION_KEY)
+    if data is None:
+        return None
+    try:
+        return RavenPrincipal.from_session(data)
+    except (TypeError, IndexError, KeyError):
+        return None
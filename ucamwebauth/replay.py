@@ -0,0 +1,160 @@
+"""Replay protection for WLS responses.
+
+'ident' combined with 'issue' uniquely identifies a response, so a successful response whose (issue, ident) pair has
+already been seen is a replay. A pair only needs to be remembered for UCAMWEBAUTH_TIMEOUT seconds after its issue
+time: after that the response is rejected as timed out anyway.
+
+Replay protection is disabled by default. To enable it set UCAMWEBAUTH_REPLAY_CACHE, e.g.:
+
+    UCAMWEBAUTH_REPLAY_CACHE = {
+        'BACKEND': 'ucamwebauth.replay.CacheReplayCache',
+        'OPTIONS': {'alias': 'default'},
+    }
+"""
+import hashlib
+import threading
+import time
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from ucamwebauth.conf import get_settings
+from ucamwebauth.utils import TTLCache
+
+
+class BaseReplayCache(object):
+    """Base class for replay cache backends."""
+
+    # Whether seen() and add() must not be called from an async context, e.g. because they use the ORM
+    sync_only = False
+
+    def __init__(self, timeout):
+        """@param timeout  Number of seconds after its issue time that a response is accepted for"""
+        self.timeout = timeout
+
+    def make_key(self, issue, ident):
+        return hashlib.sha1(("%d!%s" % (issue, ident)).encode()).hexdigest()
+
+    def expiry(self, issue):
+        """Returns the time (in seconds since the epoch) after which a response issued at issue is too old to be
+        accepted, and so no longer needs to be remembered"""
+        return int(issue) + self.timeout + 1
+
+    def seen(self, issue, ident):
+        """Returns True if the response identified by (issue, ident) has already been recorded"""
+        raise NotImplementedError
+
+    def add(self, issue, ident):
+        """Atomically records the response identified by (issue, ident).
+        @return False if it had already been recorded, True otherwise"""
+        raise NotImplementedError
+
+
+class LocMemReplayCache(BaseReplayCache):
+    """Remembers responses in a bounded, in-process LRU. Each process (worker) has its own, so this only protects
+    against replays within a single process unless there is only one."""
+
+    def __init__(self, timeout, max_entries=10000):
+        super(LocMemReplayCache, self).__init__(timeout)
+        self._cache = TTLCache(maxsize=max_entries)
+
+    def seen(self, issue, ident):
+        return self.make_key(issue, ident) in self._cache
+
+    def add(self, issue, ident):
+        return self._cache.add(self.make_key(issue, ident), True, self.expiry(issue) - time.time())
+
+
+class CacheReplayCache(BaseReplayCache):
+    """Remembers responses using Django's cache framework, so that several processes or nodes can share them.
+    Atomicity of add() relies on the cache backend's add() (e.g. memcached or redis)."""
+
+    # Cache backends do blocking I/O, or use the ORM (DatabaseCache)
+    sync_only = True
+
+    def __init__(self, timeout, alias='default', key_prefix='ucamwebauth:replay:'):
+        super(CacheReplayCache, self).__init__(timeout)
+        self.alias = alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def seen(self, issue, ident):
+        return self.cache.get(self.key_prefix + self.make_key(issue, ident)) is not None
+
+    def add(self, issue, ident):
+        timeout = max(1, int(self.expiry(issue) - time.time()))
+        return self.cache.add(self.key_prefix + self.make_key(issue, ident), 1, timeout)
+
+
+class DatabaseReplayCache(BaseReplayCache):
+    """Remembers responses in the SeenResponse table. Expired rows are purged in bulk, at most once every
+    purge_interval seconds (defaults to the timeout) per process."""
+
+    sync_only = True
+
+    def __init__(self, timeout, purge_interval=None):
+        super(DatabaseReplayCache, self).__init__(timeout)
+        self.purge_interval = timeout if purge_interval is None else purge_interval
+        self._next_purge = 0
+        self._lock = threading.Lock()
+
+    def seen(self, issue, ident):
+        from ucamwebauth.models import SeenResponse
+        return SeenResponse.objects.filter(key=self.make_key(issue, ident)).exists()
+
+    def add(self, issue, ident):
+        from ucamwebauth.models import SeenResponse
+        self.maybe_purge()
+        try:
+            with transaction.atomic():
+                SeenResponse.objects.create(key=self.make_key(issue, ident), expires=self.expiry(issue))
+        except IntegrityError:
+            return False
+        return True
+
+    def purge(self):
+        """Deletes every expired row.
+        @return the number of rows deleted"""
+        from ucamwebauth.models import SeenResponse
+        return SeenResponse.objects.filter(expires__lt=time.time()).delete()[0]
+
+    def maybe_purge(self):
+        now = time.time()
+        with self._lock:
+            if now < self._next_purge:
+                return
+            self._next_purge = now + self.purge_interval
+        self.purge()
+
+
+_replay_cache = None
+_replay_cache_lock = threading.Lock()
+
+
+def get_replay_cache():
+    """Returns the replay cache configured in UCAMWEBAUTH_REPLAY_CACHE, or None if replay protection is disabled"""
+    global _replay_cache
+    config = get_settings().replay_cache
+    if not config:
+        return None
+    with _replay_cache_lock:
+        if _replay_cache is None:
+            try:
+                backend = import_string(config['BACKEND'])
+            except (ImportError, KeyError, TypeError) as e:
+                raise ImproperlyConfigured("UCAMWEBAUTH_REPLAY_CACHE has an invalid BACKEND: %s" % e)
+            _replay_cache = backend(get_settings().timeout, **config.get('OPTIONS', {}))
+        return _replay_cache
+
+
+@receiver(setting_changed)
+def reset_replay_cache(setting, **kwargs):
+    global _replay_cache
+    if setting in ('UCAMWEBAUTH_REPLAY_CACHE', 'UCAMWEBAUTH_TIMEOUT'):
+        with _replay_cache_lock:
+            _replay_cache = None
@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+# Sent for every metric recorded while UCAMWEBAUTH_METRICS is True (see ucamwebauth.metrics), with the arguments
+# kind ('timing' or 'counter'), name, label and value.
+metric_recorded = Signal()
+
+# Sent by RavenAuthBackend (and RavenPrincipalBackend) when the attributes of a user who has just been authenticated
+# were obtained from UCAMWEBAUTH_ATTRIBUTE_PROVIDER (see ucamwebauth.attributes), with the arguments request, user and
+# attributes. Receivers can, e.g., copy them to the user's model.
+attributes_received = Signal()
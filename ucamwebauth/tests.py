@@ -1,8 +1,27 @@
+import calendar
+import csv
+import gzip
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
 from base64 import b64encode
 from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.apps import apps
 from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.utils import timezone
 
-from ucamwebauth.models import UserProfile
+from ucamwebauth.models import SeenResponse, UserProfile
 
 try:
     from urlparse import urlparse, parse_qs
@@ -10,20 +29,42 @@ try:
 except ImportError:
     from urllib.parse import urlparse, parse_qs, unquote, urlencode
 import sys
-from OpenSSL.crypto import load_privatekey, FILETYPE_PEM, sign
+from OpenSSL.crypto import load_certificate, load_privatekey, FILETYPE_PEM, sign
 import requests
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, RequestFactory, modify_settings, override_settings
 from django.test.client import Client
+from django.http import HttpResponse
+from django.template.loader import get_template
 try:
-    from django.urls import reverse
+    from django.urls import reverse, reverse_lazy, set_script_prefix
 except ImportError:
-    from django.core.urlresolvers import reverse
-from django.contrib.auth.models import User
+    from django.core.urlresolvers import reverse, reverse_lazy, set_script_prefix
+from django.contrib.auth.models import AnonymousUser, User
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save
 from ucamwebauth import InvalidResponseError, MalformedResponseError, UserNotAuthorised, RavenResponse, \
     PublicKeyNotFoundError
 from ucamwebauth.exceptions import OtherStatusCode
-from ucamwebauth.utils import get_next_from_wls_response, get_return_url
-from ucamwebauth.backends import RavenAuthBackend
+from ucamwebauth import metrics, utils, writebehind
+from ucamwebauth.utils import decode_sig, get_login_urls, get_next_from_wls_response, get_return_url, parse_time, \
+    reverse_path_info, tokenize_response
+from ucamwebauth.access import PathRules, get_path_rules
+from ucamwebauth.attributes import AttributeCache, BaseAttributeProvider, SQLiteAttributeProvider, \
+    get_attribute_cache, get_attributes
+from ucamwebauth.backends import RavenAuthBackend, RavenPrincipalBackend
+from ucamwebauth.batch import verify_response, verify_responses
+from ucamwebauth.conf import get_settings, load_settings
+from ucamwebauth.keys import registry
+from ucamwebauth.middleware import RavenLoginRequiredMiddleware, RavenPrincipalMiddleware, \
+    RavenReturnGateMiddleware, get_error_page, precheck_response
+from ucamwebauth.mockwls import MockWLS, serve_in_background
+from ucamwebauth.principal import PRINCIPAL_SESSION_KEY, RavenPrincipal
+from ucamwebauth.replay import DatabaseReplayCache, LocMemReplayCache
+from ucamwebauth.signals import attributes_received, metric_recorded
+from ucamwebauth.usercache import get_user_cache
+from ucamwebauth.verifiers import BaseVerifier, CryptographyVerifier, PyOpenSSLVerifier, ShadowVerifier, \
+    get_verifier
+from ucamwebauth.writebehind import WriteBehindBuffer, get_write_behind_buffer
 
 RAVEN_TEST_USER = 'test0001'
 RAVEN_TEST_PWD = 'testing_not_secret'
@@ -70,7 +111,7 @@ def wls_response_escape(x):
 
 
 def create_wls_response(raven_ver='3', raven_status='200', raven_msg='',
-                        raven_issue=datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'),
+                        raven_issue=None,
                         raven_id='1347296083-8278-2',
                         raven_url=None,
                         raven_principal=RAVEN_TEST_USER, raven_ptags='current',
@@ -80,6 +121,8 @@ def create_wls_response(raven_ver='3', raven_status='200', raven_msg='',
     """Creates a valid WLS Response as the Raven test server would
     using keys from https://raven.cam.ac.uk/project/keys/demo_server/
     """
+    if raven_issue is None:
+        raven_issue = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
     if raven_url is None:
         raven_url = (
             get_return_url(RequestFactory().get(reverse('raven_return'))))
@@ -92,6 +135,9 @@ def create_wls_response(raven_ver='3', raven_status='200', raven_msg='',
                          raven_issue, raven_id, raven_url,
                          raven_principal, raven_ptags, raven_auth,
                          raven_sso, raven_life, raven_params]
+    if raven_ver in ('1', '2'):
+        # ptags were added in version 3
+        del wls_response_data[7]
 
     data = '!'.join(wls_response_data)
     raven_sig = b64encode(sign(raven_pkey, data.encode(), 'sha1'))
@@ -462,3 +508,1551 @@ class RavenTestCase(TestCase):
             self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_ptags='')})
             profile = UserProfile.objects.get(user__username='test0001')
             self.assertTrue(profile.raven_for_life)
+
+
+class KeyRegistryTestCase(TestCase):
+
+    def test_certificates_parsed_once(self):
+        registry.clear()
+        with mock.patch('OpenSSL.crypto.load_certificate', wraps=load_certificate) as load:
+            for _ in range(3):
+                RavenResponse(RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()}))
+        self.assertEqual(load.call_count, len(settings.UCAMWEBAUTH_CERTS))
+
+    def test_rebuilt_on_setting_changed(self):
+        self.assertIsNotNone(registry.get(901))
+        with self.settings(UCAMWEBAUTH_CERTS={900: settings.UCAMWEBAUTH_CERTS[900]}):
+            self.assertIsNone(registry.get(901))
+            with self.assertRaises(PublicKeyNotFoundError):
+                RavenResponse(RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()}))
+        self.assertIsNotNone(registry.get(901))
+
+    def test_malformed_certificate_reported_at_startup(self):
+        with self.settings(UCAMWEBAUTH_CERTS={901: settings.UCAMWEBAUTH_CERTS[901], 902: 'not a certificate'}):
+            self.assertEqual(list(registry.errors), [902])
+            self.assertIsNotNone(registry.get(901))
+            self.assertIsNone(registry.get(902))
+            with self.assertRaises(ImproperlyConfigured):
+                apps.get_app_config('ucamwebauth').ready()
+
+
+class ReplayCacheTestCase(TestCase):
+
+    BACKENDS = ['ucamwebauth.replay.LocMemReplayCache', 'ucamwebauth.replay.CacheReplayCache',
+                'ucamwebauth.replay.DatabaseReplayCache']
+
+    def get_response(self, raw):
+        return RavenResponse(RequestFactory().get(reverse('raven_return'), {'WLS-Response': raw}))
+
+    def test_replay_rejected(self):
+        for backend in self.BACKENDS:
+            with self.settings(UCAMWEBAUTH_REPLAY_CACHE={'BACKEND': backend}):
+                raw = create_wls_response(raven_id=backend)
+                self.get_response(raw)
+                with self.assertRaises(InvalidResponseError) as excep:
+                    self.get_response(raw)
+                self.assertEqual(str(excep.exception), "This response has already been used")
+                # A different response is still accepted
+                self.get_response(create_wls_response(raven_id=backend + '-2'))
+
+    def test_disabled_by_default(self):
+        raw = create_wls_response()
+        self.get_response(raw)
+        self.get_response(raw)
+
+    def test_invalid_response_not_recorded(self):
+        with self.settings(UCAMWEBAUTH_REPLAY_CACHE={'BACKEND': 'ucamwebauth.replay.LocMemReplayCache'}):
+            issue = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+            with self.assertRaises(InvalidResponseError):
+                self.get_response(create_wls_response(raven_issue=issue, raven_key_pem=BAD_PRIV_KEY_PEM))
+            self.get_response(create_wls_response(raven_issue=issue))
+
+    def test_locmem_bounded(self):
+        cache = LocMemReplayCache(timeout=60, max_entries=10)
+        now = int(time.time())
+        for i in range(100):
+            self.assertTrue(cache.add(now, str(i)))
+        self.assertEqual(len(cache._cache), 10)
+        self.assertTrue(cache.seen(now, '99'))
+        self.assertFalse(cache.seen(now, '0'))
+
+    def test_database_purge(self):
+        cache = DatabaseReplayCache(timeout=60)
+        now = int(time.time())
+        self.assertTrue(cache.add(now - 3600, 'old'))
+        self.assertTrue(cache.add(now, 'new'))
+        self.assertFalse(cache.add(now, 'new'))
+        self.assertEqual(cache.purge(), 1)
+        self.assertEqual(list(SeenResponse.objects.values_list('key', flat=True)), [cache.make_key(now, 'new')])
+
+
+class BatchVerificationTestCase(TestCase):
+
+    def get_responses(self):
+        old = (datetime.utcnow() + timedelta(hours=-1)).strftime('%Y%m%dT%H%M%SZ')
+        return [
+            create_wls_response(raven_issue=old),
+            create_wls_response(raven_key_pem=BAD_PRIV_KEY_PEM),
+            'not a response',
+            create_wls_response(raven_status='410', raven_principal='', raven_ptags='', raven_auth=''),
+        ]
+
+    def check_results(self, results):
+        self.assertEqual([r.valid for r in results], [True, False, False, False])
+        self.assertEqual(results[0].principal, RAVEN_TEST_USER)
+        self.assertEqual(results[0].kid, 901)
+        self.assertIsNone(results[0].reason)
+        self.assertEqual(results[1].principal, RAVEN_TEST_USER)
+        self.assertEqual(results[1].kid, 901)
+        self.assertEqual(results[1].reason, 'InvalidResponseError: The signature for this response is not valid.')
+        self.assertEqual(results[2].reason, 'MalformedResponseError: Version number must be an integer, not not a '
+                                            'response')
+        self.assertEqual(results[3].status, 410)
+        self.assertEqual(results[3].reason, 'The user cancelled the authentication request')
+
+    def test_verify_responses(self):
+        for executor in (None, 'thread', 'process'):
+            self.check_results(list(verify_responses(self.get_responses(), executor=executor, workers=2,
+                                                     chunksize=1)))
+
+    def test_check_timeout_and_url(self):
+        result = verify_response(self.get_responses()[0], check_timeout=True)
+        self.assertFalse(result.valid)
+        self.assertTrue(result.reason.startswith('InvalidResponseError: Response has timed out'))
+        result = verify_response(create_wls_response(), url='http://elsewhere.example')
+        self.assertEqual(result.reason, 'InvalidResponseError: The URL in the response does not match the URL '
+                                        'expected')
+
+    def test_order_preserved(self):
+        responses = [create_wls_response(raven_principal='user%d' % i) for i in range(50)]
+        results = verify_responses(iter(responses), workers=3, chunksize=4)
+        self.assertEqual([r.principal for r in results], ['user%d' % i for i in range(50)])
+
+
+class RavenReturnTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def test_response_parsed_once(self):
+        raw = create_wls_response(raven_params='next=/local/redirect')
+        with mock.patch('ucamwebauth.views.get_next_from_wls_response') as get_next, \
+                mock.patch('ucamwebauth.parse_qs', wraps=parse_qs) as parse:
+            response = self.client.get(reverse('raven_return'), {'WLS-Response': raw})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, '/local/redirect')
+        get_next.assert_not_called()
+        self.assertEqual(parse.call_count, 1)
+
+    def test_raven_response_on_request(self):
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        user = RavenAuthBackend().authenticate(request)
+        self.assertEqual(user.username, RAVEN_TEST_USER)
+        self.assertEqual(request.raven_response.principal, RAVEN_TEST_USER)
+
+
+class ParserTestCase(TestCase):
+
+    def test_parse_time(self):
+        strptime = lambda t: calendar.timegm(time.strptime(t, "%Y%m%dT%H%M%SZ"))  # noqa: E731
+        for t in ['20110729T123456Z', '20240229T000000Z', '19691231T235959Z', '20231231T235961Z', '20110729t123456z',
+                  '2011729T123456Z', '20110729T1234Z', '2011072９T123456Z']:
+            self.assertEqual(parse_time(t), strptime(t))
+        for t in ['20230229T000000Z', '20231301T000000Z', '20230100T000000Z', '00000101T000000Z', '20231231T240000Z',
+                  '20231231T236000Z', '20231231T235962Z', '20110729T123456', 'error']:
+            self.assertRaises(ValueError, strptime, t)
+            self.assertRaises(ValueError, parse_time, t)
+
+    def test_tokenize_response(self):
+        raw = create_wls_response(raven_msg='50%!')
+        ver, tokens, data = tokenize_response(raw)
+        self.assertEqual(ver, 3)
+        self.assertEqual(tokens, [unquote(token) for token in raw.split('!')])
+        self.assertEqual(tokens[2], '50%!')
+        self.assertEqual(data, '!'.join(raw.split('!')[:12]).encode())
+        ver, tokens, data = tokenize_response('2!200!!20110729T123456Z!1!url!user!pwd!!!!1!sig')
+        self.assertEqual(ver, 2)
+        self.assertEqual(data, b'2!200!!20110729T123456Z!1!url!user!pwd!!!')
+
+    def test_tokenize_response_errors(self):
+        for raw, message in [('x!200', "Version number must be an integer, not x"),
+                             ('5!200', "Unsupported version: 5"),
+                             ('3!200!!', "Wrong number of parameters in response: expected 14, got 4"),
+                             ('1!200!!', "Wrong number of parameters in response: expected 13, got 4")]:
+            with self.assertRaises(MalformedResponseError) as excep:
+                tokenize_response(raw)
+            self.assertEqual(str(excep.exception), message)
+
+
+class RavenResponseRepresentationTestCase(TestCase):
+
+    def get_response(self, **kwargs):
+        return RavenResponse(RequestFactory().get(reverse('raven_return'),
+                                                  {'WLS-Response': create_wls_response(**kwargs)}))
+
+    def test_slots(self):
+        response = self.get_response()
+        self.assertFalse(hasattr(response, '__dict__'))
+
+    def test_lazy_fields(self):
+        with mock.patch('ucamwebauth.parse_qs', wraps=parse_qs) as parse:
+            response = self.get_response(raven_params='next=/a&b=c', raven_ptags='current,staff')
+            parse.assert_not_called()
+            self.assertEqual(response.params, {'next': ['/a'], 'b': ['c']})
+            self.assertIs(response.params, response.params)
+            self.assertEqual(parse.call_count, 1)
+        self.assertEqual(response.ptags, ['current', 'staff'])
+        self.assertEqual(response.sso, [''])
+
+    def test_pickle(self):
+        response = self.get_response(raven_params='next=/a', raven_ptags='current')
+        self.assertTrue(response.params)
+        copy = pickle.loads(pickle.dumps(response))
+        for field in RavenResponse.FIELDS + ('params', 'ptags', 'sso'):
+            self.assertEqual(getattr(copy, field), getattr(response, field))
+
+    def test_as_dict(self):
+        response = self.get_response(raven_params='next=/a', raven_ptags='current')
+        copy = RavenResponse.from_dict(json.loads(json.dumps(response.as_dict())))
+        self.assertIsNone(copy.sig)
+        for field in ('principal', 'issue', 'ident', 'kid', 'life', 'params', 'ptags', 'sso'):
+            self.assertEqual(getattr(copy, field), getattr(response, field))
+        self.assertTrue(copy.validate())
+
+
+class SettingsTestCase(TestCase):
+
+    def test_defaults(self):
+        with self.settings():
+            del settings.UCAMWEBAUTH_TIMEOUT
+            config = load_settings()
+        self.assertEqual(config.timeout, 30)
+        self.assertEqual(config.iact, '')
+        self.assertTrue(config.create_user)
+        self.assertFalse(config.not_current)
+        self.assertEqual(config.login_url, settings.UCAMWEBAUTH_LOGIN_URL)
+
+    def test_snapshot_rebuilt_on_setting_changed(self):
+        config = get_settings()
+        self.assertIs(get_settings(), config)
+        with self.settings(UCAMWEBAUTH_CREATE_USER=False):
+            self.assertFalse(get_settings().create_user)
+        self.assertIs(get_settings().create_user, True)
+        self.assertTrue(RavenAuthBackend().create_unknown_user)
+
+    def test_invalid_settings(self):
+        for name, value in [('UCAMWEBAUTH_IACT', 'maybe'), ('UCAMWEBAUTH_TIMEOUT', '30'), ('UCAMWEBAUTH_TIMEOUT', 0),
+                            ('UCAMWEBAUTH_CREATE_USER', 'yes'), ('UCAMWEBAUTH_NOT_CURRENT', 1),
+                            ('UCAMWEBAUTH_LOGIN_URL', 42), ('UCAMWEBAUTH_REPLAY_CACHE', {'OPTIONS': {}})]:
+            with self.settings(**{name: value}):
+                with self.assertRaises(ImproperlyConfigured) as excep:
+                    apps.get_app_config('ucamwebauth').ready()
+                self.assertIn(name, str(excep.exception))
+
+    def test_lazy_strings(self):
+        with self.settings(UCAMWEBAUTH_REDIRECT_AFTER_LOGIN=reverse_lazy('raven_login'),
+                           UCAMWEBAUTH_LOGOUT_REDIRECT=reverse_lazy('raven_return')):
+            apps.get_app_config('ucamwebauth').ready()
+            response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+            self.assertEqual(response.url, reverse('raven_login'))
+            response = self.client.get(reverse('raven_logout'))
+            self.assertEqual(response.url, reverse('raven_return'))
+
+    def test_iact(self):
+        with self.settings(UCAMWEBAUTH_IACT='no'):
+            with self.assertRaises(InvalidResponseError) as excep:
+                RavenResponse(RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()}))
+        self.assertEqual(str(excep.exception), "Non-interactive authentication required but not received")
+
+
+class BackendQueriesTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def authenticate(self, **kwargs):
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response(**kwargs)})
+        return RavenAuthBackend().authenticate(request)
+
+    def test_new_user(self):
+        # Insert, fetch, save by configure_user and profile insert
+        with self.assertNumQueries(5):
+            user = self.authenticate(raven_principal=RAVEN_NEW_USER)
+        self.assertEqual(user.username, RAVEN_NEW_USER)
+        self.assertFalse(user.has_usable_password())
+        self.assertFalse(UserProfile.objects.get(user=user).raven_for_life)
+
+    def test_version_2(self):
+        user = self.authenticate(raven_ver='2', raven_principal=RAVEN_NEW_USER)
+        self.assertEqual(user.username, RAVEN_NEW_USER)
+        self.assertTrue(UserProfile.objects.get(user=user).raven_for_life)
+
+    def test_configure_user_in_subclass(self):
+        class ConfiguringRavenAuthBackend(RavenAuthBackend):
+            def configure_user(self, request, user, created=True):
+                user.first_name = 'Configured'
+                return super(ConfiguringRavenAuthBackend, self).configure_user(request, user, created)
+
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response(
+            raven_principal=RAVEN_NEW_USER)})
+        user = ConfiguringRavenAuthBackend().authenticate(request)
+        self.assertEqual(user.first_name, 'Configured')
+        self.assertEqual(User.objects.get(username=RAVEN_NEW_USER).first_name, 'Configured')
+        self.assertFalse(User.objects.get(username=RAVEN_NEW_USER).has_usable_password())
+
+    def test_existing_user(self):
+        self.authenticate()
+        with self.assertNumQueries(1):
+            user = self.authenticate()
+        self.assertEqual(user.username, RAVEN_TEST_USER)
+        self.assertFalse(user.profile.raven_for_life)
+
+    def test_status_changed(self):
+        self.authenticate()
+        with self.settings(UCAMWEBAUTH_NOT_CURRENT=True):
+            with self.assertNumQueries(2):
+                user = self.authenticate(raven_ptags='')
+        self.assertTrue(user.profile.raven_for_life)
+        self.assertTrue(UserProfile.objects.get(user=user).raven_for_life)
+
+    def test_existing_user_without_profile(self):
+        with self.assertNumQueries(2):
+            user = self.authenticate()
+        self.assertTrue(UserProfile.objects.filter(user=user).exists())
+
+    def test_unknown_user_not_created(self):
+        with self.settings(UCAMWEBAUTH_CREATE_USER=False):
+            with self.assertNumQueries(1):
+                self.assertIsNone(self.authenticate(raven_principal=RAVEN_NEW_USER))
+
+    def test_user_created_concurrently(self):
+        # Simulate another login creating the user between our lookup and our insert
+        existing = User.objects.create(username=RAVEN_NEW_USER, password='!concurrent')
+        get = QuerySet.get
+        missed = []
+
+        def miss_once(queryset, *args, **kwargs):
+            if not missed:
+                missed.append(True)
+                raise User.DoesNotExist
+            return get(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'get', miss_once), \
+                mock.patch.object(RavenAuthBackend, 'configure_user') as configure_user:
+            user = self.authenticate(raven_principal=RAVEN_NEW_USER)
+        self.assertEqual(user.pk, existing.pk)
+        self.assertEqual(user.password, '!concurrent')
+        configure_user.assert_not_called()
+        self.assertEqual(User.objects.filter(username=RAVEN_NEW_USER).count(), 1)
+
+
+@override_settings(UCAMWEBAUTH_USER_CACHE_TIMEOUT=60)
+class UserCacheTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.backend = RavenAuthBackend()
+        self.user = User.objects.get(username=RAVEN_TEST_USER)
+        UserProfile.objects.create(user=self.user)
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            user = self.backend.get_user(self.user.pk)
+            self.assertFalse(user.profile.raven_for_life)
+        with self.assertNumQueries(0):
+            cached = self.backend.get_user(self.user.pk)
+            self.assertFalse(cached.profile.raven_for_life)
+        self.assertEqual(cached, user)
+        self.assertIsNot(cached, user)
+
+    def test_disabled(self):
+        with self.settings(UCAMWEBAUTH_USER_CACHE_TIMEOUT=None):
+            self.backend.get_user(self.user.pk)
+            with self.assertNumQueries(1):
+                self.backend.get_user(self.user.pk)
+
+    def test_invalidated_on_save(self):
+        self.backend.get_user(self.user.pk)
+        self.user.first_name = 'Changed'
+        self.user.save()
+        self.assertEqual(self.backend.get_user(self.user.pk).first_name, 'Changed')
+        UserProfile.objects.filter(user=self.user).get().delete()
+        with self.assertRaises(UserProfile.DoesNotExist):
+            self.backend.get_user(self.user.pk).profile
+
+    def test_invalidated_on_login(self):
+        self.backend.get_user(self.user.pk)
+        with self.settings(UCAMWEBAUTH_NOT_CURRENT=True):
+            self.backend.authenticate(RequestFactory().get(reverse('raven_return'), {
+                'WLS-Response': create_wls_response(raven_ptags='')}))
+        self.assertTrue(self.backend.get_user(self.user.pk).profile.raven_for_life)
+
+    def test_shared_cache(self):
+        with self.settings(UCAMWEBAUTH_USER_CACHE_ALIAS='default'):
+            self.backend.get_user(self.user.pk)
+            get_user_cache()._local.clear()
+            with self.assertNumQueries(0):
+                self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+            self.user.save()
+            with self.assertNumQueries(1):
+                self.backend.get_user(self.user.pk)
+
+
+@override_settings(ROOT_URLCONF='ucamwebauth.async_urls')
+class AsyncViewsTestCase(TestCase):
+    fixtures = ['users.json']
+
+    async def test_login(self):
+        response = await self.async_client.get(reverse('raven_return'), {
+            'WLS-Response': create_wls_response(raven_params='next=/local/redirect')})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, '/local/redirect')
+        user = await sync_to_async(User.objects.select_related('profile').get)(username=RAVEN_TEST_USER)
+        self.assertFalse(user.profile.raven_for_life)
+        session = await sync_to_async(lambda: dict(self.async_client.session))()
+        self.assertEqual(session['_auth_user_id'], str(user.pk))
+
+    async def test_aauthenticate_new_user(self):
+        request = RequestFactory().get(reverse('raven_return'), {
+            'WLS-Response': create_wls_response(raven_principal=RAVEN_NEW_USER, raven_ptags='')})
+        with self.settings(UCAMWEBAUTH_NOT_CURRENT=True):
+            user = await RavenAuthBackend().aauthenticate(request)
+        self.assertEqual(user.username, RAVEN_NEW_USER)
+        self.assertFalse(user.has_usable_password())
+        profile = await sync_to_async(UserProfile.objects.get)(user=user)
+        self.assertTrue(profile.raven_for_life)
+
+    async def test_aauthenticate_database_replay_cache(self):
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        with self.settings(UCAMWEBAUTH_REPLAY_CACHE={'BACKEND': 'ucamwebauth.replay.DatabaseReplayCache'}):
+            user = await RavenAuthBackend().aauthenticate(request)
+            with self.assertRaises(InvalidResponseError):
+                await RavenAuthBackend().aauthenticate(request)
+        self.assertEqual(user.username, RAVEN_TEST_USER)
+
+    async def test_aauthenticate_database_cache(self):
+        # Both the replay cache and the shared user cache use the ORM through DatabaseCache
+        await sync_to_async(call_command)('createcachetable', 'ucamwebauth_cache', verbosity=0)
+        request = RequestFactory().get(reverse('raven_return'), {
+            'WLS-Response': create_wls_response(raven_ptags='')})
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                               'LOCATION': 'ucamwebauth_cache'}},
+                           UCAMWEBAUTH_REPLAY_CACHE={'BACKEND': 'ucamwebauth.replay.CacheReplayCache'},
+                           UCAMWEBAUTH_USER_CACHE_TIMEOUT=60, UCAMWEBAUTH_USER_CACHE_ALIAS='default',
+                           UCAMWEBAUTH_NOT_CURRENT=True):
+            await sync_to_async(UserProfile.objects.create)(user_id=1, raven_for_life=False)
+            user = await RavenAuthBackend().aauthenticate(request)
+            with self.assertRaises(InvalidResponseError):
+                await RavenAuthBackend().aauthenticate(request)
+        self.assertTrue(user.profile.raven_for_life)
+
+    async def test_login_and_logout_views(self):
+        response = await self.async_client.get(reverse('raven_login'), {'next': '/foo'})
+        self.assertEqual(response.status_code, 303)
+        self.assertTrue(response.url.startswith(settings.UCAMWEBAUTH_LOGIN_URL))
+        await self.async_client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        response = await self.async_client.get(reverse('raven_logout'))
+        self.assertEqual(response.status_code, 302)
+        session = await sync_to_async(lambda: dict(self.async_client.session))()
+        self.assertNotIn('_auth_user_id', session)
+
+    @modify_settings(MIDDLEWARE={'append': 'ucamwebauth.middleware.DefaultErrorBehaviour'})
+    async def test_error_template(self):
+        response = await self.async_client.get(reverse('raven_return'), {
+            'WLS-Response': create_wls_response(raven_ver='4')})
+        self.assertContains(response, 'Unsupported version: 4', status_code=500)
+
+
+class LoginURLsTestCase(TestCase):
+
+    def setUp(self):
+        utils._login_urls.clear()
+
+    def test_cached_per_host(self):
+        factory = RequestFactory()
+        with mock.patch('ucamwebauth.utils.reverse', wraps=reverse) as reversed_:
+            urls = get_login_urls(factory.get('/'))
+            self.assertIs(get_login_urls(factory.get('/other')), urls)
+            self.assertEqual(reversed_.call_count, 1)
+            with self.settings(ALLOWED_HOSTS=['other.example']):
+                other = get_login_urls(factory.get('/', HTTP_HOST='other.example', secure=True))
+            self.assertEqual(reversed_.call_count, 2)
+        self.assertEqual(urls.return_url, 'http://testserver/raven_return/')
+        self.assertEqual(other.return_url, 'https://other.example/raven_return/')
+        self.assertEqual(get_return_url(factory.get('/')), urls.return_url)
+
+    def test_login_redirect(self):
+        response = self.client.get(reverse('raven_login'), {'next': '/a?b=c'})
+        location = urlparse(response['Location'])
+        self.assertEqual(location.query.split('&')[-2:], ['params=next%3D%252Fa%253Fb%253Dc', 'fail='])
+        query = parse_qs(location.query, keep_blank_values=True)
+        self.assertEqual(query['url'], ['http://testserver/raven_return/'])
+        self.assertEqual(query['ver'], ['3'])
+        self.assertEqual(query['desc'], [''])
+
+    def test_settings_change(self):
+        get_login_urls(RequestFactory().get('/'))
+        with self.settings(UCAMWEBAUTH_DESC='My site', UCAMWEBAUTH_RETURN_URL='https://example.com/return'):
+            response = self.client.get(reverse('raven_login'))
+            query = parse_qs(urlparse(response['Location']).query)
+            self.assertEqual(query['desc'], ['My site'])
+            self.assertEqual(query['url'], ['https://example.com/return'])
+        urls = get_login_urls(RequestFactory().get('/'))
+        self.assertEqual(urls.return_url, 'http://testserver/raven_return/')
+
+
+recorded_metrics = []
+
+
+def record_metric(kind, name, label, value):
+    recorded_metrics.append((kind, name, label, value))
+
+
+def failing_metrics_hook(kind, name, label, value):
+    raise RuntimeError("hook failed")
+
+
+@override_settings(UCAMWEBAUTH_METRICS=True, UCAMWEBAUTH_METRICS_HOOKS=['ucamwebauth.tests.record_metric'])
+class MetricsTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        del recorded_metrics[:]
+
+    def login(self, **kwargs):
+        return self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(**kwargs)})
+
+    def counters(self):
+        return [(name, label) for kind, name, label, value in recorded_metrics if kind == 'counter']
+
+    def test_successful_login(self):
+        self.assertEqual(self.login().status_code, 302)
+        phases = [label for kind, name, label, value in recorded_metrics if kind == 'timing']
+        self.assertEqual(phases, ['parse', 'certificate', 'verify', 'user', 'profile', 'login', 'total'])
+        self.assertTrue(all(value >= 0 for kind, name, label, value in recorded_metrics))
+        self.assertEqual(self.counters(), [('status', 200), ('outcome', 'success')])
+
+    def test_failed_logins(self):
+        with self.assertRaises(OtherStatusCode):
+            self.login(raven_status='410', raven_principal='', raven_ptags='', raven_auth='', raven_sig_input=False,
+                       raven_kid='')
+        with self.assertRaises(InvalidResponseError):
+            self.login(raven_issue=(datetime.utcnow() + timedelta(hours=1)).strftime('%Y%m%dT%H%M%SZ'))
+        with self.assertRaises(MalformedResponseError):
+            self.client.get(reverse('raven_return'))
+        self.assertEqual(self.counters(), [('status', 410), ('outcome', 'OtherStatusCode'),
+                                           ('outcome', 'InvalidResponseError'), ('outcome', 'MalformedResponseError')])
+
+    def test_signal(self):
+        received = []
+
+        def receiver(sender, kind, name, label, value, **kwargs):
+            received.append((kind, name, label))
+
+        metric_recorded.connect(receiver)
+        try:
+            with self.settings(UCAMWEBAUTH_METRICS_HOOKS=['ucamwebauth.tests.failing_metrics_hook']):
+                self.assertEqual(self.login().status_code, 302)
+        finally:
+            metric_recorded.disconnect(receiver)
+        self.assertIn(('counter', 'outcome', 'success'), received)
+        self.assertEqual(recorded_metrics, [])
+
+    def test_disabled(self):
+        with self.settings(UCAMWEBAUTH_METRICS=False):
+            self.assertIs(metrics.timer(), metrics.NULL_TIMER)
+            self.assertEqual(self.login().status_code, 302)
+        self.assertEqual(recorded_metrics, [])
+
+    def test_formatters(self):
+        collector = metrics.PrometheusCollector()
+        collector('timing', 'phase', 'verify', 0.25)
+        collector('timing', 'phase', 'verify', 0.5)
+        collector('counter', 'status', 200, 1)
+        collector('counter', 'outcome', 'success', 1)
+        self.assertEqual(collector.render(), '\n'.join([
+            '# TYPE ucamwebauth_phase_seconds summary',
+            'ucamwebauth_phase_seconds_sum{phase="verify"} 0.75',
+            'ucamwebauth_phase_seconds_count{phase="verify"} 2',
+            '# TYPE ucamwebauth_outcome_total counter',
+            'ucamwebauth_outcome_total{outcome="success"} 1',
+            '# TYPE ucamwebauth_status_total counter',
+            'ucamwebauth_status_total{status="200"} 1',
+        ]) + '\n')
+        self.assertEqual(metrics.format_statsd('timing', 'phase', 'verify', 0.00125), 'ucamwebauth.phase.verify:1.250|ms')
+        self.assertEqual(metrics.format_statsd('counter', 'status', 410, 1), 'ucamwebauth.status.410:1|c')
+
+
+class ExpiredResponseError(InvalidResponseError):
+    pass
+
+
+@modify_settings(MIDDLEWARE={'append': 'ucamwebauth.middleware.DefaultErrorBehaviour'})
+class ErrorPagesTestCase(TestCase):
+
+    def get_invalid_version(self):
+        return self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_ver='4')})
+
+    def test_table(self):
+        self.assertEqual(get_error_page(MalformedResponseError).status, 500)
+        self.assertEqual(get_error_page(UserNotAuthorised).status, 403)
+        self.assertIs(get_error_page(ExpiredResponseError), get_error_page(InvalidResponseError))
+        self.assertIsNone(get_error_page(ValueError))
+
+    def test_settings(self):
+        with self.settings(UCAMWEBAUTH_ERROR_RESPONSES={
+                'ucamwebauth.tests.ExpiredResponseError': (400, 'ucamwebauth_403.html'),
+                'ucamwebauth.exceptions.UserNotAuthorised': None}):
+            self.assertEqual(get_error_page(ExpiredResponseError).status, 400)
+            self.assertEqual(get_error_page(ExpiredResponseError).template_name, 'ucamwebauth_403.html')
+            self.assertEqual(get_error_page(InvalidResponseError).status, 500)
+            self.assertIsNone(get_error_page(UserNotAuthorised))
+        self.assertEqual(get_error_page(ExpiredResponseError).status, 500)
+        with self.assertRaises(ImproperlyConfigured):
+            with self.settings(UCAMWEBAUTH_ERROR_RESPONSES={'ucamwebauth.tests.Missing': (400, 'x.html')}):
+                get_error_page(ValueError)
+        with self.assertRaises(ImproperlyConfigured):
+            with self.settings(UCAMWEBAUTH_ERROR_RESPONSES={'ucamwebauth.tests.ExpiredResponseError': 400}):
+                load_settings()
+
+    def test_template_cached(self):
+        with mock.patch('ucamwebauth.middleware.get_template', wraps=get_template) as get_template_:
+            for message in ('Unsupported version: 4', 'Unsupported version: 4'):
+                self.assertContains(self.get_invalid_version(), message, status_code=500)
+        self.assertEqual(get_template_.call_count, 1)
+
+    def test_static_pages(self):
+        with self.settings(UCAMWEBAUTH_STATIC_ERROR_PAGES=True):
+            with mock.patch('ucamwebauth.middleware.messages') as messages_:
+                first = self.get_invalid_version()
+                second = self.get_invalid_version()
+        self.assertEqual(first.status_code, 500)
+        self.assertNotContains(first, 'Unsupported version', status_code=500)
+        self.assertEqual(first.content, second.content)
+        messages_.error.assert_not_called()
+
+
+class VerifiersTestCase(TestCase):
+
+    def setUp(self):
+        ver, tokens, self.data = tokenize_response(create_wls_response())
+        self.signature = decode_sig(tokens[-1])
+        self.pem = settings.UCAMWEBAUTH_CERTS[901]
+
+    def test_verifiers(self):
+        for verifier in (PyOpenSSLVerifier(), CryptographyVerifier(), ShadowVerifier()):
+            key = verifier.load_key(self.pem)
+            self.assertTrue(verifier.verify(key, self.signature, self.data))
+            self.assertFalse(verifier.verify(key, self.signature, self.data + b'!'))
+            self.assertFalse(verifier.verify(key, self.signature[:-1], self.data))
+
+    def test_setting(self):
+        for path in ('ucamwebauth.verifiers.CryptographyVerifier', 'ucamwebauth.verifiers.ShadowVerifier'):
+            with self.settings(UCAMWEBAUTH_VERIFIER=path):
+                self.assertEqual(type(get_verifier()).__name__, path.rsplit('.', 1)[1])
+                response = RavenResponse(response_str=create_wls_response())
+                self.assertEqual(response.principal, RAVEN_TEST_USER)
+        self.assertIsInstance(get_verifier(), PyOpenSSLVerifier)
+        with self.assertRaises(ImproperlyConfigured):
+            with self.settings(UCAMWEBAUTH_VERIFIER='ucamwebauth.verifiers.Missing'):
+                get_verifier()
+
+    def test_shadow(self):
+        shadow = mock.Mock(spec=BaseVerifier)
+        shadow.verify.return_value = False
+        verifier = ShadowVerifier(shadow=shadow)
+        key = verifier.load_key(self.pem)
+        self.assertTrue(verifier.verify(key, self.signature, self.data))
+        shadow.verify.side_effect = ValueError
+        self.assertTrue(verifier.verify(key, self.signature, self.data))
+        stats = verifier.stats()
+        self.assertEqual((stats['calls'], stats['mismatches']), (2, 2))
+        self.assertGreater(stats['primary_mean'], 0)
+        verifier = ShadowVerifier()
+        verifier.verify(verifier.load_key(self.pem), self.signature, self.data)
+        self.assertEqual(verifier.stats()['mismatches'], 0)
+
+
+class CertsDirTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.pem = settings.UCAMWEBAUTH_CERTS[901]
+        self.other_pem = settings.UCAMWEBAUTH_CERTS[900]
+        self.write('pubkey901.crt')
+        self.write('README')
+        override = override_settings(UCAMWEBAUTH_CERTS={}, UCAMWEBAUTH_CERTS_DIR=self.directory)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def write(self, name, pem=None):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(self.pem if pem is None else pem)
+
+    def test_keys_loaded(self):
+        self.assertIsNotNone(registry.get(901))
+        self.assertEqual(registry.errors, {})
+        response = RavenResponse(response_str=create_wls_response())
+        self.assertEqual(response.principal, RAVEN_TEST_USER)
+
+    def test_rescan(self):
+        registry.load()
+        self.write('902.pem')
+        self.assertIsNone(registry.get(902))
+        with mock.patch('OpenSSL.crypto.load_certificate', wraps=load_certificate) as load:
+            registry.rescan()
+        # Only the new file is parsed
+        self.assertEqual(load.call_count, 1)
+        self.assertIsNotNone(registry.get(902))
+        os.remove(os.path.join(self.directory, 'pubkey901.crt'))
+        registry.rescan()
+        self.assertIsNone(registry.get(901))
+
+    def test_settings_take_precedence(self):
+        with self.settings(UCAMWEBAUTH_CERTS={901: self.other_pem}):
+            with self.assertRaises(InvalidResponseError):
+                RavenResponse(response_str=create_wls_response())
+
+    def test_malformed_file(self):
+        self.write('903.pem', 'not a certificate')
+        self.assertEqual(list(registry.errors), [os.path.join(self.directory, '903.pem')])
+        self.assertIsNone(registry.get(903))
+        self.assertIsNotNone(registry.get(901))
+
+    def test_background_rescan(self):
+        registry.load()
+        self.write('902.pem')
+        with mock.patch('ucamwebauth.keys.time.monotonic', return_value=time.monotonic() + 3600):
+            # The lookup does not wait for the rescan
+            self.assertIsNone(registry.get(902))
+        registry._scan_thread.join()
+        self.assertIsNotNone(registry.get(902))
+
+    def test_failed_rescan_rescheduled(self):
+        registry.load()
+        with mock.patch.object(registry, '_combine', side_effect=OSError('disk error')), \
+                mock.patch('ucamwebauth.keys.time.monotonic', return_value=time.monotonic() + 3600), \
+                self.assertLogs('ucamwebauth.keys', 'ERROR'):
+            registry.get(901)
+            registry._scan_thread.join()
+        self.assertIsNotNone(registry._next_scan)
+
+    def test_rescan_rescheduled_while_running(self):
+        registry.load()
+        registry._scan_thread = running = threading.Thread(target=threading.Event().wait, args=(5, ))
+        running.daemon = True
+        running.start()
+        with mock.patch('ucamwebauth.keys.time.monotonic', return_value=time.monotonic() + 3600):
+            registry.get(901)
+        self.assertIs(registry._scan_thread, running)
+        self.assertIsNotNone(registry._next_scan)
+
+
+class SessionLifeTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def login(self, **kwargs):
+        client = Client()
+        client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(**kwargs)})
+        return client.session.get_expiry_age()
+
+    def test_life(self):
+        self.assertEqual(self.login(raven_life='3600'), 3600)
+        self.assertEqual(self.login(raven_life='0'), 1)
+        self.assertEqual(self.login(raven_life=''), settings.SESSION_COOKIE_AGE)
+        self.assertEqual(self.login(raven_life=str(settings.SESSION_COOKIE_AGE * 2)), settings.SESSION_COOKIE_AGE)
+
+    def test_bounds(self):
+        with self.settings(UCAMWEBAUTH_SESSION_LIFE_MIN=600, UCAMWEBAUTH_SESSION_LIFE_MAX=7200):
+            self.assertEqual(self.login(raven_life='60'), 600)
+            self.assertEqual(self.login(raven_life='36000'), 7200)
+            self.assertEqual(self.login(raven_life=''), 7200)
+
+    def test_disabled(self):
+        with self.settings(UCAMWEBAUTH_SESSION_LIFE=False):
+            self.assertEqual(self.login(raven_life='3600'), settings.SESSION_COOKIE_AGE)
+
+    def test_expire_at_browser_close(self):
+        with self.settings(SESSION_EXPIRE_AT_BROWSER_CLOSE=True):
+            client = Client()
+            client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_life='3600')})
+            self.assertTrue(client.session.get_expire_at_browser_close())
+            self.assertEqual(client.cookies[settings.SESSION_COOKIE_NAME]['expires'], '')
+
+
+class SubclassedRavenAuthBackend(RavenAuthBackend):
+    pass
+
+
+class ClearRavenSessionsTestCase(TestCase):
+
+    def create_session(self, backend, expired):
+        store = SessionStore()
+        store['_auth_user_id'] = '1'
+        store['_auth_user_backend'] = backend
+        store.create()
+        if expired:
+            Session.objects.filter(session_key=store.session_key).update(
+                expire_date=timezone.now() - timedelta(days=1))
+        return store.session_key
+
+    def test_command(self):
+        expired = [self.create_session('ucamwebauth.backends.RavenAuthBackend', True) for _ in range(5)]
+        kept = [self.create_session('ucamwebauth.backends.RavenAuthBackend', False),
+                self.create_session('django.contrib.auth.backends.ModelBackend', True)]
+        out = StringIO()
+        call_command('clearravensessions', batch_size=2, dry_run=True, stdout=out)
+        self.assertIn('Found 5 expired Raven sessions (of 6 expired sessions)', out.getvalue())
+        self.assertEqual(Session.objects.count(), 7)
+        call_command('clearravensessions', batch_size=2, stdout=out)
+        self.assertEqual(set(Session.objects.values_list('session_key', flat=True)), set(kept))
+        self.assertFalse(Session.objects.filter(session_key__in=expired).exists())
+
+    @override_settings(AUTHENTICATION_BACKENDS=['ucamwebauth.tests.SubclassedRavenAuthBackend',
+                                                'django.contrib.auth.backends.ModelBackend'])
+    def test_subclassed_backend(self):
+        self.create_session('ucamwebauth.tests.SubclassedRavenAuthBackend', True)
+        kept = self.create_session('django.contrib.auth.backends.ModelBackend', True)
+        call_command('clearravensessions', stdout=StringIO())
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), [kept])
+
+    def test_session_engine(self):
+        with self.settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies'):
+            with self.assertRaises(CommandError):
+                call_command('clearravensessions')
+
+
+@override_settings(AUTHENTICATION_BACKENDS=['ucamwebauth.backends.RavenPrincipalBackend'],
+                   SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+@modify_settings(MIDDLEWARE={'append': 'ucamwebauth.middleware.RavenPrincipalMiddleware'})
+class RavenPrincipalTestCase(TestCase):
+
+    def test_login(self):
+        with self.settings(UCAMWEBAUTH_NOT_CURRENT=True), self.assertNumQueries(0):
+            response = self.client.get(reverse('raven_return'), {
+                'WLS-Response': create_wls_response(raven_principal=RAVEN_NEW_USER, raven_ptags='')})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.session[PRINCIPAL_SESSION_KEY], [RAVEN_NEW_USER, True])
+        self.assertNotIn('_auth_user_id', self.client.session)
+        self.assertFalse(User.objects.filter(username=RAVEN_NEW_USER).exists())
+
+    def test_version_2(self):
+        # Responses before version 3 have no ptags, so whether users are current is unknown
+        response = self.client.get(reverse('raven_return'), {
+            'WLS-Response': create_wls_response(raven_ver='2', raven_principal=RAVEN_NEW_USER)})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.session[PRINCIPAL_SESSION_KEY], [RAVEN_NEW_USER, True])
+
+    def test_middleware(self):
+        self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        request = RequestFactory().get('/')
+        request.session = self.client.session
+        request.user = None
+        with self.assertNumQueries(0):
+            RavenPrincipalMiddleware(lambda request: None).process_request(request)
+            self.assertTrue(request.user.is_authenticated)
+            self.assertEqual(request.user.get_username(), RAVEN_TEST_USER)
+            self.assertFalse(request.user.profile.raven_for_life)
+            self.assertFalse(request.user.has_perm('auth.add_user'))
+
+        request = RequestFactory().get('/')
+        request.session = self.client_class().session
+        request.user = None
+        RavenPrincipalMiddleware(lambda request: None).process_request(request)
+        self.assertFalse(request.user.is_authenticated)
+
+    def test_principal(self):
+        principal = RavenPrincipal('test0001', True)
+        self.assertEqual(RavenPrincipal.from_session(principal.to_session()), principal)
+        self.assertTrue(principal.is_authenticated)
+        self.assertFalse(principal.is_anonymous)
+        self.assertIsNone(principal.pk)
+        self.assertEqual(principal.get_all_permissions(), set())
+        with self.assertRaises(NotImplementedError):
+            principal.save()
+
+    def test_login_flushes_other_user(self):
+        session = self.client.session
+        session['_auth_user_id'] = '1'
+        session['_auth_user_backend'] = 'ucamwebauth.backends.RavenAuthBackend'
+        session['other'] = 'value'
+        session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        session = self.client.session
+        self.assertEqual(session[PRINCIPAL_SESSION_KEY], [RAVEN_TEST_USER, False])
+        self.assertNotIn('_auth_user_id', session)
+        self.assertNotIn('other', session)
+
+    def test_logout(self):
+        self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        self.client.get(reverse('raven_logout'))
+        self.assertNotIn(PRINCIPAL_SESSION_KEY, self.client.session)
+
+    async def test_aauthenticate(self):
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        principal = await RavenPrincipalBackend().aauthenticate(request)
+        self.assertEqual(principal, RavenPrincipal(RAVEN_TEST_USER))
+
+    def test_clearravensessions(self):
+        with self.settings(SESSION_ENGINE='django.contrib.sessions.backends.db'):
+            store = SessionStore()
+            store[PRINCIPAL_SESSION_KEY] = [RAVEN_TEST_USER, False]
+            store.create()
+            Session.objects.update(expire_date=timezone.now() - timedelta(days=1))
+            call_command('clearravensessions', stdout=StringIO())
+            self.assertFalse(Session.objects.exists())
+
+
+class AuditWLSResponsesTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.valid = create_wls_response()
+        self.forged = self.valid.replace('!%s!' % RAVEN_TEST_USER, '!%s!' % RAVEN_NEW_USER)
+
+    def write_log(self, name, responses, opener=open):
+        path = os.path.join(self.directory, name)
+        with opener(path, 'wt') as f:
+            for response in responses:
+                f.write('127.0.0.1 - - [01/Jan/2022:00:00:00 +0000] "GET /raven_return/?%s HTTP/1.1" 302 0\n' %
+                        urlencode({'WLS-Response': response}))
+            f.write('127.0.0.1 - - [01/Jan/2022:00:00:01 +0000] "GET / HTTP/1.1" 200 42\n')
+        return path
+
+    def audit(self, *args, **options):
+        out = StringIO()
+        err = StringIO()
+        call_command('auditwlsresponses', *args, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv(self):
+        plain = self.write_log('access.log', [self.valid, self.forged, self.valid])
+        compressed = self.write_log('access.log.1.gz', [self.valid, 'not!a!response'], gzip.open)
+        out, err = self.audit(plain, compressed, executor='none')
+        rows = list(csv.DictReader(StringIO(out)))
+        self.assertEqual([(row['source'], row['line'], row['principal'], row['verdict']) for row in rows], [
+            (plain, '1', RAVEN_TEST_USER, 'valid'),
+            (plain, '2', RAVEN_NEW_USER, 'invalid'),
+            (compressed, '2', '', 'invalid')])
+        self.assertEqual(rows[0]['kid'], '901')
+        self.assertEqual(rows[0]['reason'], '')
+        self.assertIn('InvalidResponseError', rows[1]['reason'])
+        self.assertIn('7 lines', err)
+        self.assertIn('5 responses found (2 duplicates skipped), 1 valid, 2 invalid', err)
+
+    def test_jsonl_in_threads(self):
+        log = self.write_log('access.log', [self.forged, self.valid])
+        output = os.path.join(self.directory, 'report.jsonl')
+        self.audit(log, output=output, report_format='jsonl', invalid_only=True, executor='thread', workers=2,
+                   chunksize=1)
+        with open(output) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['principal'], RAVEN_NEW_USER)
+        self.assertEqual(rows[0]['verdict'], 'invalid')
+
+    def test_plus_encoded_spaces(self):
+        response = create_wls_response(raven_msg='Welcome back', raven_params='next=/a b')
+        log = self.write_log('access.log', [response])
+        with open(log) as f:
+            self.assertIn('Welcome+back', f.read())
+        out, err = self.audit(log, executor='none')
+        self.assertEqual([row['verdict'] for row in csv.DictReader(StringIO(out))], ['valid'])
+
+    def test_dedupe_size(self):
+        log = self.write_log('access.log', [self.valid, self.forged, self.valid])
+        out, err = self.audit(log, executor='none', dedupe_size=1)
+        self.assertEqual(len(list(csv.DictReader(StringIO(out)))), 3)
+
+    def test_missing_log(self):
+        with self.assertRaises(CommandError):
+            self.audit(os.path.join(self.directory, 'missing.log'), executor='none')
+
+
+class ProvisionRavenUsersTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def provision(self, lines, **options):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        out = StringIO()
+        call_command('provisionravenusers', path, stdout=out, **options)
+        return out.getvalue()
+
+    def test_provision(self):
+        UserProfile.objects.create(user=User.objects.get(username=RAVEN_TEST_USER), raven_for_life=False)
+        principals = ['%s,' % RAVEN_TEST_USER, 'abc12,current', 'abc13,current,other', 'abc14,', 'abc15', '']
+        # The same number of queries for any batch size (including the savepoint of the batch's transaction), plus the
+        # save of each new user by configure_user
+        with self.assertNumQueries(9 + 4):
+            out = self.provision(principals)
+        self.assertIn('Created 4 users and 4 profiles, updated raven_for_life of 1 profiles (5 principals)', out)
+        self.assertEqual(dict(UserProfile.objects.values_list('user__username', 'raven_for_life')), {
+            RAVEN_TEST_USER: True, 'abc12': False, 'abc13': False, 'abc14': True, 'abc15': False})
+        self.assertFalse(any(user.has_usable_password() for user in User.objects.all()))
+
+        out = self.provision(['abc12,', 'abc15,', 'abc16,'], no_create=True, batch_size=2)
+        self.assertIn('Created 0 users and 0 profiles, updated raven_for_life of 2 profiles (3 principals)', out)
+        self.assertFalse(User.objects.filter(username='abc16').exists())
+        self.assertTrue(UserProfile.objects.get(user__username='abc15').raven_for_life)
+
+    def test_users_created_concurrently(self):
+        # Simulate logins creating abc12 between the lookup of the batch and its insert
+        bulk_create = QuerySet.bulk_create
+
+        def login_first(queryset, objs, *args, **kwargs):
+            if queryset.model is User:
+                User.objects.create(username='abc12', password='!concurrent')
+            return bulk_create(queryset, objs, *args, **kwargs)
+
+        created = []
+
+        def receiver(sender, instance, **kwargs):
+            if kwargs['created']:
+                created.append(instance.username)
+        post_save.connect(receiver, sender=User)
+        self.addCleanup(post_save.disconnect, receiver, sender=User)
+        with mock.patch.object(QuerySet, 'bulk_create', login_first), \
+                mock.patch.object(RavenAuthBackend, 'configure_user', side_effect=lambda request, user: user) \
+                as configure_user:
+            out = self.provision(['abc12,current', 'abc13,current'])
+        self.assertIn('Created 1 users and 2 profiles', out)
+        self.assertEqual(User.objects.get(username='abc12').password, '!concurrent')
+        # abc12 by the concurrent login's save()
+        self.assertEqual(created, ['abc12', 'abc13'])
+        self.assertEqual([call.args[1].username for call in configure_user.call_args_list], ['abc13'])
+
+    def test_profile_created_concurrently(self):
+        # Simulate a first login creating the profile between the lookup of the batch and its insert
+        bulk_create = QuerySet.bulk_create
+
+        def login_first(queryset, objs, *args, **kwargs):
+            if queryset.model is UserProfile:
+                UserProfile.objects.create(user=User.objects.get(username=RAVEN_TEST_USER), raven_for_life=True)
+            return bulk_create(queryset, objs, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'bulk_create', login_first):
+            out = self.provision(['%s,current' % RAVEN_TEST_USER, 'abc12,current'])
+        self.assertIn('Created 1 users and 1 profiles', out)
+        self.assertTrue(UserProfile.objects.get(user__username=RAVEN_TEST_USER).raven_for_life)
+
+    def test_first_login_after_provisioning(self):
+        self.provision(['%s,current' % RAVEN_NEW_USER])
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response(
+            raven_principal=RAVEN_NEW_USER)})
+        with self.assertNumQueries(1):
+            user = RavenAuthBackend().authenticate(request)
+        self.assertEqual(user.username, RAVEN_NEW_USER)
+
+    def test_dry_run(self):
+        out = self.provision(['abc12,', RAVEN_TEST_USER], dry_run=True)
+        self.assertIn('Would create 1 users and 2 profiles', out)
+        self.assertEqual(User.objects.count(), 1)
+        self.assertFalse(UserProfile.objects.exists())
+
+
+@modify_settings(MIDDLEWARE={'prepend': 'ucamwebauth.middleware.RavenReturnGateMiddleware',
+                             'append': 'ucamwebauth.middleware.DefaultErrorBehaviour'})
+class RavenReturnGateTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def test_precheck_response(self):
+        precheck_response(create_wls_response())
+        precheck_response(create_wls_response(raven_status='410', raven_principal='', raven_ptags='', raven_auth='',
+                                              raven_kid='', raven_sig_input=False))
+        with self.settings(UCAMWEBAUTH_GATE_MAX_LENGTH=100):
+            self.assertRaises(MalformedResponseError, precheck_response, create_wls_response())
+        self.assertRaises(MalformedResponseError, precheck_response, '3!200!!')
+        self.assertRaises(MalformedResponseError, precheck_response, create_wls_response(raven_ver='4'))
+        self.assertRaises(MalformedResponseError, precheck_response, create_wls_response(raven_issue='yesterday'))
+        self.assertRaises(InvalidResponseError, precheck_response, create_wls_response(
+            raven_issue=(datetime.utcnow() + timedelta(hours=1)).strftime('%Y%m%dT%H%M%SZ')))
+        self.assertRaises(InvalidResponseError, precheck_response, create_wls_response(
+            raven_issue=(datetime.utcnow() - timedelta(hours=1)).strftime('%Y%m%dT%H%M%SZ')))
+        self.assertRaises(PublicKeyNotFoundError, precheck_response, create_wls_response(raven_kid='999'))
+
+    def test_same_exceptions_as_raven_response(self):
+        for kwargs in ({'raven_kid': ''}, {'raven_sig_input': False}, {'raven_kid': 'x'}, {'raven_kid': '999'}):
+            response_str = create_wls_response(**kwargs)
+            with self.assertRaises(Exception) as expected:
+                RavenResponse(RequestFactory().get(reverse('raven_return'), {'WLS-Response': response_str}))
+            self.assertRaises(type(expected.exception), precheck_response, response_str)
+
+    def test_other_paths_not_gated(self):
+        middleware = RavenReturnGateMiddleware(lambda request: HttpResponse('view'))
+        request = RequestFactory().get('/other/', {'WLS-Response': create_wls_response(raven_kid='999')})
+        self.assertEqual(middleware(request).content, b'view')
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_kid='999')})
+        self.assertEqual(middleware(request).status_code, 500)
+
+    @override_settings(FORCE_SCRIPT_NAME='/prefix/')
+    def test_script_prefix(self):
+        set_script_prefix('/prefix/')
+        self.addCleanup(set_script_prefix, '/')
+        middleware = RavenReturnGateMiddleware(lambda request: HttpResponse('view'))
+        request = RequestFactory().get(reverse_path_info('raven_return'),
+                                       {'WLS-Response': create_wls_response(raven_kid='999')})
+        self.assertEqual(middleware(request).status_code, 500)
+
+    def test_rejected_before_session(self):
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('raven_return'), {
+                'WLS-Response': create_wls_response(raven_kid='999')})
+        self.assertEqual(response.status_code, 500)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_plausible_response(self):
+        response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('_auth_user_id', self.client.session)
+
+        # A forged signature is only detected by RavenResponse, after the middleware stack
+        forged = create_wls_response().replace('!%s!' % RAVEN_TEST_USER, '!%s!' % RAVEN_NEW_USER)
+        response = self.client.get(reverse('raven_return'), {'WLS-Response': forged})
+        self.assertEqual(response.status_code, 500)
+
+    def test_metrics(self):
+        recorded = []
+        with self.settings(UCAMWEBAUTH_METRICS=True):
+            with mock.patch.object(metrics, 'record', side_effect=lambda *args: recorded.append(args)):
+                self.client.get(reverse('raven_return'), {'WLS-Response': '5!200'})
+        self.assertEqual(recorded, [('counter', 'gate', 'MalformedResponseError', 1)])
+
+    async def test_async(self):
+        async def get_response(request):
+            return HttpResponse('view')
+        middleware = RavenReturnGateMiddleware(get_response)
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': '3!200'})
+        response = await middleware(request)
+        self.assertEqual(response.status_code, 500)
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        response = await middleware(request)
+        self.assertEqual(response.content, b'view')
+
+
+class MockWLSTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.wls = MockWLS(GOOD_PRIV_KEY_PEM, kid=901)
+        self.url = get_return_url(RequestFactory().get(reverse('raven_return')))
+
+    def test_response(self):
+        response = RavenResponse(response_str=self.wls.response(self.url, principal=RAVEN_NEW_USER, params='a=b!c%d'),
+                                 url=self.url)
+        self.assertTrue(response.validate())
+        self.assertEqual(response.principal, RAVEN_NEW_USER)
+        self.assertEqual(response.ptags, ['current'])
+        self.assertEqual(response.kid, 901)
+        self.assertEqual(response.params, {'a': ['b!c%d']})
+
+    def test_scenarios(self):
+        self.wls.auth, self.wls.sso = '', 'pwd'
+        self.assertEqual(RavenResponse(response_str=self.wls.response(self.url), url=self.url).sso, ['pwd'])
+        self.assertEqual(RavenResponse(response_str=self.wls.response(self.url, ver=2), url=self.url).ver, 2)
+        response = RavenResponse(response_str=self.wls.response(self.url, status=410), url=self.url)
+        self.assertFalse(response.validate())
+        self.assertIsNone(response.principal)
+        self.wls.skew = 3600
+        with self.assertRaises(InvalidResponseError):
+            RavenResponse(response_str=self.wls.response(self.url), url=self.url)
+        self.wls.skew = -3600
+        with self.assertRaises(InvalidResponseError):
+            RavenResponse(response_str=self.wls.response(self.url), url=self.url)
+
+    def test_generated_key(self):
+        wls = MockWLS(kid=905)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.assertEqual(wls.write_certificate(directory), os.path.join(directory, 'pubkey905.crt'))
+        with self.settings(UCAMWEBAUTH_CERTS_DIR=directory):
+            self.assertTrue(RavenResponse(response_str=wls.response(self.url), url=self.url).validate())
+
+    def test_server(self):
+        server = serve_in_background(self.wls)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        wls_url = 'http://127.0.0.1:%d/auth/authenticate.html' % server.server_port
+
+        with self.settings(UCAMWEBAUTH_LOGIN_URL=wls_url):
+            response = self.client.get(reverse('raven_login'), {'next': '/after/login'})
+        response = requests.get(response.url, headers={'X-Mock-Principal': RAVEN_NEW_USER}, allow_redirects=False)
+        self.assertEqual(response.status_code, 303)
+        response = self.client.get(response.headers['Location'])
+        self.assertEqual(response.url, '/after/login')
+        self.assertEqual(User.objects.get(pk=self.client.session['_auth_user_id']).username, RAVEN_NEW_USER)
+
+        response = requests.post(wls_url, {'url': self.url, 'ver': '3', 'cancel': 'Cancel'}, allow_redirects=False)
+        response_str = parse_qs(urlparse(response.headers['Location']).query)['WLS-Response'][0]
+        self.assertEqual(RavenResponse(response_str=response_str, url=self.url).status, 410)
+        self.assertEqual(requests.get(wls_url, allow_redirects=False).status_code, 400)
+        self.assertEqual(requests.get(wls_url, {'url': self.url}, headers={'X-Mock-Status': '999'},
+                                      allow_redirects=False).status_code, 400)
+
+
+class FakeAttributeProvider(BaseAttributeProvider):
+    """Returns {'principal': principal}, once release is set, and counts the calls"""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def get_attributes(self, principal):
+        self.calls += 1
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        return {'principal': principal}
+
+
+class AttributesTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.provider = SQLiteAttributeProvider(os.path.join(directory, 'attributes.sqlite3'))
+        self.provider.set_attributes(RAVEN_TEST_USER, {'displayName': 'Test User', 'groups': ['101888']})
+        self.settings_override = self.settings(UCAMWEBAUTH_ATTRIBUTE_PROVIDER={
+            'BACKEND': 'ucamwebauth.attributes.SQLiteAttributeProvider', 'OPTIONS': {'path': self.provider.path}})
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_sqlite_provider(self):
+        self.assertEqual(self.provider.get_attributes(RAVEN_TEST_USER)['displayName'], 'Test User')
+        self.assertEqual(self.provider.get_attributes(RAVEN_NEW_USER), {})
+
+    def test_login(self):
+        received = []
+
+        def receiver(sender, request, user, attributes, **kwargs):
+            received.append((user.username, attributes))
+        attributes_received.connect(receiver)
+        self.addCleanup(attributes_received.disconnect, receiver)
+
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        user = RavenAuthBackend().authenticate(request)
+        self.assertEqual(user.raven_attributes['displayName'], 'Test User')
+        self.assertEqual(request.raven_attributes, user.raven_attributes)
+        self.assertEqual(received, [(RAVEN_TEST_USER, user.raven_attributes)])
+        self.assertEqual(get_attributes(RAVEN_TEST_USER), user.raven_attributes)
+
+    def test_principal_login(self):
+        request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        principal = RavenPrincipalBackend().authenticate(request)
+        self.assertEqual(principal.raven_attributes['groups'], ['101888'])
+
+    def test_no_provider(self):
+        with self.settings(UCAMWEBAUTH_ATTRIBUTE_PROVIDER=None):
+            self.assertIsNone(get_attribute_cache())
+            request = RequestFactory().get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+            user = RavenAuthBackend().authenticate(request)
+            self.assertFalse(hasattr(user, 'raven_attributes'))
+
+    def test_invalid_backend(self):
+        with self.settings(UCAMWEBAUTH_ATTRIBUTE_PROVIDER={'BACKEND': 'ucamwebauth.attributes.Missing'}):
+            with self.assertRaises(ImproperlyConfigured):
+                get_attribute_cache()
+
+    def test_stale_while_revalidate(self):
+        provider = FakeAttributeProvider()
+        cache = AttributeCache(provider, ttl=60, stale=60)
+        self.assertEqual(cache.get('a'), {'principal': 'a'})
+        self.assertEqual(cache.get('a'), {'principal': 'a'})
+        self.assertEqual(provider.calls, 1)
+        with mock.patch('ucamwebauth.attributes.time.time', return_value=time.time() + 90):
+            provider.release.clear()
+            # Stale: returned at once while they are fetched again
+            self.assertEqual(cache.get('a'), {'principal': 'a'})
+            future = cache.fetch('a')
+            provider.release.set()
+            future.result()
+        self.assertEqual(provider.calls, 2)
+        with mock.patch('ucamwebauth.attributes.time.time', return_value=time.time() + 300):
+            # Expired
+            self.assertEqual(cache.get('a'), {'principal': 'a'})
+        self.assertEqual(provider.calls, 3)
+
+    def test_budget(self):
+        provider = FakeAttributeProvider()
+        provider.release.clear()
+        cache = AttributeCache(provider, budget=0.01)
+        self.assertIsNone(cache.get('a'))
+        # The fetch went on, and is shared by the next callers
+        future = cache.fetch('a')
+        provider.release.set()
+        self.assertEqual(future.result(), {'principal': 'a'})
+        self.assertEqual(provider.calls, 1)
+        self.assertEqual(cache.get('a'), {'principal': 'a'})
+
+    def test_error(self):
+        provider = FakeAttributeProvider(error=ValueError('down'))
+        cache = AttributeCache(provider, error_ttl=30)
+        with self.assertLogs('ucamwebauth.attributes', 'WARNING'):
+            self.assertIsNone(cache.get('a'))
+        # The failure is cached
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(provider.calls, 1)
+        with mock.patch('ucamwebauth.attributes.time.time', return_value=time.time() + 31), \
+                self.assertLogs('ucamwebauth.attributes', 'WARNING'):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(provider.calls, 2)
+
+    def test_error_keeps_stale_attributes(self):
+        provider = FakeAttributeProvider()
+        cache = AttributeCache(provider, ttl=60, stale=60)
+        cache.get('a')
+        provider.error = ValueError('down')
+        with mock.patch('ucamwebauth.attributes.time.time', return_value=time.time() + 90), \
+                self.assertLogs('ucamwebauth.attributes', 'WARNING'):
+            self.assertEqual(cache.get('a'), {'principal': 'a'})
+            self.assertRaises(ValueError, cache.fetch('a').result)
+            self.assertEqual(cache.get('a'), {'principal': 'a'})
+
+    def test_max_pending(self):
+        provider = FakeAttributeProvider()
+        provider.release.clear()
+        self.addCleanup(provider.release.set)
+        cache = AttributeCache(provider, budget=0.01, max_pending=1)
+        self.assertIsNone(cache.get('a'))
+        with self.assertLogs('ucamwebauth.attributes', 'WARNING'):
+            self.assertIsNone(cache.fetch('b'))
+            self.assertIsNone(cache.get('b'))
+        # Already pending
+        self.assertIsNotNone(cache.fetch('a'))
+        self.assertEqual(provider.calls, 1)
+
+    def test_settings_change_closes_cache(self):
+        cache = get_attribute_cache()
+        cache.get(RAVEN_TEST_USER)
+        executor = cache._executor
+        with self.settings(UCAMWEBAUTH_ATTRIBUTE_BUDGET=1):
+            self.assertIsNot(get_attribute_cache(), cache)
+        self.assertIsNone(cache._executor)
+        self.assertRaises(RuntimeError, executor.submit, print)
+
+    async def test_aget(self):
+        provider = FakeAttributeProvider()
+        cache = AttributeCache(provider, budget=0.01)
+        self.assertEqual(await cache.aget('a'), {'principal': 'a'})
+        provider.release.clear()
+        self.assertIsNone(await cache.aget('b'))
+        provider.release.set()
+        cache.fetch('b').result()
+        self.assertEqual(await cache.aget('b'), {'principal': 'b'})
+
+
+@override_settings(UCAMWEBAUTH_PROTECTED_PATHS=['/staff/', '^/[a-z]+/private/'],
+                   UCAMWEBAUTH_EXEMPT_PATHS=['/staff/public/', r'^/staff/.*\.css$'])
+class RavenLoginRequiredTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.middleware = RavenLoginRequiredMiddleware(lambda request: HttpResponse('view'))
+
+    def get(self, path, user=None):
+        request = RequestFactory().get(path, {'a': 'b'})
+        request.user = user or AnonymousUser()
+        return self.middleware(request)
+
+    def test_rules(self):
+        rules = PathRules(['/staff/', '/staff/public/secret', '^/[a-z]+/private/'], ['/staff/public/', '^/blog/'])
+        self.assertTrue(rules.is_protected('/staff/'))
+        self.assertTrue(rules.is_protected('/staff/list'))
+        self.assertFalse(rules.is_protected('/staff'))
+        self.assertFalse(rules.is_protected('/staff/public/index'))
+        self.assertTrue(rules.is_protected('/staff/public/secrets'))
+        self.assertTrue(rules.is_protected('/docs/private/1'))
+        self.assertFalse(rules.is_protected('/blog/private/1'))
+        self.assertFalse(rules.is_protected('/'))
+        self.assertTrue(PathRules(['/']).is_protected('/anything'))
+        with self.assertRaises(ImproperlyConfigured):
+            PathRules(['^/(unclosed'])
+
+    def test_raven_views_exempt(self):
+        with self.settings(UCAMWEBAUTH_PROTECTED_PATHS=['/']):
+            self.assertTrue(get_path_rules().is_protected('/anything'))
+            self.assertFalse(get_path_rules().is_protected(reverse('raven_login')))
+            self.assertFalse(get_path_rules().is_protected(reverse('raven_return')))
+
+    def test_raven_views_exempt_with_script_prefix(self):
+        set_script_prefix('/app/')
+        self.addCleanup(set_script_prefix, '/')
+        with self.settings(UCAMWEBAUTH_PROTECTED_PATHS=['/'], FORCE_SCRIPT_NAME='/app'):
+            self.assertTrue(get_path_rules().is_protected('/anything'))
+            self.assertFalse(get_path_rules().is_protected('/accounts/login/raven'))
+            self.assertFalse(get_path_rules().is_protected('/raven_return/'))
+            with modify_settings(MIDDLEWARE={'append': 'ucamwebauth.middleware.RavenLoginRequiredMiddleware'}):
+                response = self.client.get('/accounts/login/raven', {'next': '/'})
+                self.assertEqual(response.status_code, 303)
+                response = self.client.get('/anything')
+                self.assertEqual(response.url, '/app/accounts/login/raven?next=/app/anything')
+
+    def test_anonymous(self):
+        response = self.get('/staff/list')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, '%s?next=%s' % (reverse('raven_login'), '/staff/list%3Fa%3Db'))
+        self.assertEqual(self.get('/staff/public/index').content, b'view')
+        self.assertEqual(self.get('/staff/style.css').content, b'view')
+        self.assertEqual(self.get('/other').content, b'view')
+        self.assertEqual(self.get('/docs/private/').status_code, 302)
+
+    def test_authenticated(self):
+        user = User.objects.get(username=RAVEN_TEST_USER)
+        self.assertEqual(self.get('/staff/list', user).content, b'view')
+        with self.settings(UCAMWEBAUTH_PROTECTED_REQUIRE_CURRENT=True):
+            # No profile
+            self.assertEqual(self.get('/staff/list', user).status_code, 403)
+            UserProfile.objects.create(user=user, raven_for_life=False)
+            user = User.objects.get(username=RAVEN_TEST_USER)
+            self.assertEqual(self.get('/staff/list', user).content, b'view')
+            self.assertEqual(self.get('/staff/list', RavenPrincipal(RAVEN_TEST_USER, True)).status_code, 403)
+
+    def test_login_flow(self):
+        with modify_settings(MIDDLEWARE={'append': 'ucamwebauth.middleware.RavenLoginRequiredMiddleware'}), \
+                self.settings(UCAMWEBAUTH_PROTECTED_PATHS=['/']):
+            response = self.client.get(reverse('raven_login'), {'next': '/'})
+            self.assertEqual(response.status_code, 303)
+            response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+            self.assertEqual(response.status_code, 302)
+
+    async def test_async(self):
+        async def get_response(request):
+            return HttpResponse('view')
+        middleware = RavenLoginRequiredMiddleware(get_response)
+        request = RequestFactory().get('/other')
+        self.assertEqual((await middleware(request)).content, b'view')
+        request = RequestFactory().get('/staff/')
+        request.user = AnonymousUser()
+        self.assertEqual((await middleware(request)).status_code, 302)
+
+
+class WriteBehindTestCase(TestCase):
+    fixtures = ['users.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username=RAVEN_TEST_USER)
+        self.other = User.objects.create(username=RAVEN_NEW_USER)
+        UserProfile.objects.create(user=self.user, raven_for_life=False)
+        UserProfile.objects.create(user=self.other, raven_for_life=False)
+
+    def make_buffer(self, **kwargs):
+        buffer = WriteBehindBuffer(**dict({'interval': 3600}, **kwargs))
+        self.addCleanup(buffer.stop)
+        return buffer
+
+    def test_flush(self):
+        buffer = self.make_buffer()
+        now = timezone.now()
+        buffer.add_last_login(self.user.pk, now - timedelta(minutes=1))
+        buffer.add_last_login(self.user.pk, now)
+        buffer.add_last_login(self.other.pk, now)
+        buffer.add_raven_for_life(self.user.pk, True)
+        self.assertEqual(len(buffer), 3)
+        with self.assertNumQueries(2):
+            self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(User.objects.get(pk=self.user.pk).last_login, now)
+        self.assertEqual(User.objects.get(pk=self.other.pk).last_login, now)
+        self.assertTrue(UserProfile.objects.get(user=self.user).raven_for_life)
+        self.assertFalse(UserProfile.objects.get(user=self.other).raven_for_life)
+        with self.assertNumQueries(0):
+            self.assertEqual(buffer.flush(), 0)
+
+    def test_batch_size(self):
+        buffer = self.make_buffer(batch_size=2)
+        written = threading.Event()
+        buffer.write = mock.Mock(side_effect=lambda last_login, raven_for_life: written.set())
+        buffer.add_last_login(self.user.pk, timezone.now())
+        self.assertFalse(written.wait(0.1))
+        buffer.add_raven_for_life(self.user.pk, True)
+        self.assertTrue(written.wait(5))
+        buffer.write.assert_called_once_with({self.user.pk: mock.ANY}, {self.user.pk: True})
+
+    def test_error(self):
+        buffer = self.make_buffer()
+        buffer.write = mock.Mock(side_effect=ValueError('database down'))
+        buffer.add_raven_for_life(self.user.pk, True)
+        with self.assertLogs('ucamwebauth.writebehind', 'ERROR'):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(len(buffer), 1)
+        del buffer.write
+        self.assertEqual(buffer.flush(), 1)
+        self.assertTrue(UserProfile.objects.get(user=self.user).raven_for_life)
+
+    def test_max_pending(self):
+        buffer = self.make_buffer(max_pending=2)
+        buffer.add_last_login(self.user.pk, timezone.now())
+        self.assertEqual(len(buffer), 1)
+        # Written by the caller
+        buffer.add_raven_for_life(self.user.pk, True)
+        self.assertEqual(len(buffer), 0)
+        self.assertTrue(UserProfile.objects.get(user=self.user).raven_for_life)
+
+    def test_oldest_dropped(self):
+        buffer = self.make_buffer(max_pending=2)
+        buffer.write = mock.Mock(side_effect=ValueError('database down'))
+        now = timezone.now()
+        buffer.add_last_login(self.user.pk, now)
+        with self.assertLogs('ucamwebauth.writebehind', 'ERROR'):
+            buffer.add_last_login(self.other.pk, now)
+        self.assertEqual(len(buffer), 2)
+        with self.assertLogs('ucamwebauth.writebehind', 'WARNING') as logs:
+            buffer.add_raven_for_life(self.user.pk, True)
+        self.assertIn('Dropped the oldest 1 write-behind updates', logs.output[-1])
+        self.assertEqual(buffer._last_login, {self.other.pk: now})
+        self.assertEqual(buffer._raven_for_life, {self.user.pk: True})
+
+    def test_thread_survives_errors(self):
+        buffer = self.make_buffer(interval=0.01)
+        buffer.write = mock.Mock()
+        calls = []
+        called_again = threading.Event()
+
+        def fail_once():
+            calls.append(True)
+            if len(calls) == 1:
+                raise RuntimeError('connection error')
+            called_again.set()
+        with mock.patch.object(writebehind, 'close_old_connections', side_effect=fail_once), \
+                self.assertLogs('ucamwebauth.writebehind', 'ERROR') as logs:
+            buffer.add_last_login(self.user.pk, timezone.now())
+            self.assertTrue(called_again.wait(5))
+            thread = buffer._thread
+        self.assertIn('The write-behind thread failed', logs.output[0])
+        self.assertTrue(thread.is_alive())
+
+    def test_thread_restarted(self):
+        buffer = self.make_buffer()
+        buffer._thread = dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        buffer.add_last_login(self.user.pk, timezone.now())
+        self.assertIsNot(buffer._thread, dead)
+        self.assertTrue(buffer._thread.is_alive())
+
+    def test_login(self):
+        last_login = self.user.last_login
+        with self.settings(UCAMWEBAUTH_WRITE_BEHIND=True, UCAMWEBAUTH_WRITE_BEHIND_INTERVAL=3600,
+                           UCAMWEBAUTH_NOT_CURRENT=True):
+            response = self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response(raven_ptags='')})
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(User.objects.get(pk=self.user.pk).last_login, last_login)
+            self.assertFalse(UserProfile.objects.get(user=self.user).raven_for_life)
+            self.assertEqual(len(get_write_behind_buffer()), 2)
+            self.assertEqual(writebehind.flush(), 2)
+        self.assertGreater(User.objects.get(pk=self.user.pk).last_login, last_login)
+        self.assertTrue(UserProfile.objects.get(user=self.user).raven_for_life)
+
+    def test_disabled(self):
+        self.assertIsNone(get_write_behind_buffer())
+        self.client.get(reverse('raven_return'), {'WLS-Response': create_wls_response()})
+        self.assertGreater(User.objects.get(pk=self.user.pk).last_login, self.user.last_login)
+
+    def test_settings_change_flushes(self):
+        with self.settings(UCAMWEBAUTH_WRITE_BEHIND=True, UCAMWEBAUTH_WRITE_BEHIND_INTERVAL=3600):
+            get_write_behind_buffer().add_raven_for_life(self.user.pk, True)
+        self.assertTrue(UserProfile.objects.get(user=self.user).raven_for_life)
@@ -0,0 +1,104 @@
+"""A cache of the users returned by RavenAuthBackend.get_user, which is called for every request of a logged in user.
+
+The cache is disabled unless UCAMWEBAUTH_USER_CACHE_TIMEOUT is set. Users are kept in an in-process LRU of at most
+UCAMWEBAUTH_USER_CACHE_MAX_ENTRIES entries and, if UCAMWEBAUTH_USER_CACHE_ALIAS names one of the CACHES, in that Django
+cache so that processes can share them. Entries are invalidated when the user or their profile is saved or deleted,
+but only in the process that made the change and the shared cache: other processes may keep using their copy for up to
+UCAMWEBAUTH_USER_CACHE_TIMEOUT seconds.
+"""
+import pickle
+from asgiref.sync import sync_to_async
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from ucamwebauth.conf import get_settings
+from ucamwebauth.utils import TTLCache
+
+
+class UserCache(object):
+
+    key_prefix = 'ucamwebauth:user:'
+
+    def __init__(self, timeout, max_entries=1000, alias=None):
+        self.timeout = timeout
+        self.alias = alias
+        self._local = TTLCache(maxsize=max_entries, timeout=timeout)
+
+    @property
+    def shared(self):
+        if self.alias is None:
+            return None
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get(self, user_id, load):
+        """Returns the user with primary key user_id, calling load(user_id) to fetch it on a cache miss.
+        Every call returns a separate copy, so that requests cannot see each other's changes to it."""
+        data = self._local.get(user_id)
+        if data is None:
+            shared = self.shared
+            key = self.key_prefix + str(user_id)
+            if shared is not None:
+                data = shared.get(key)
+            if data is None:
+                user = load(user_id)
+                if user is None:
+                    return None
+                data = pickle.dumps(user, pickle.HIGHEST_PROTOCOL)
+                if shared is not None:
+                    shared.set(key, data, self.timeout)
+            self._local.set(user_id, data)
+        return pickle.loads(data)
+
+    def invalidate(self, user_id):
+        self._local.delete(user_id)
+        shared = self.shared
+        if shared is not None:
+            shared.delete(self.key_prefix + str(user_id))
+
+
+_user_cache = None
+
+
+def get_user_cache():
+    """Returns the UserCache, or None if it is disabled"""
+    global _user_cache
+    config = get_settings()
+    if not config.user_cache_timeout:
+        return None
+    if _user_cache is None:
+        _user_cache = UserCache(config.user_cache_timeout, config.user_cache_max_entries, config.user_cache_alias)
+    return _user_cache
+
+
+def invalidate_user(user_id):
+    """Removes the user with primary key user_id from the cache, if it is enabled"""
+    user_cache = get_user_cache()
+    if user_cache is not None:
+        user_cache.invalidate(user_id)
+
+
+async def ainvalidate_user(user_id):
+    """The async version of invalidate_user. Only the shared cache is invalidated in a thread: its backend may block
+    or use the ORM."""
+    user_cache = get_user_cache()
+    if user_cache is None:
+        return
+    if user_cache.alias is None:
+        user_cache.invalidate(user_id)
+    else:
+        await sync_to_async(user_cache.invalidate)(user_id)
+
+
+def user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+def profile_changed(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+@receiver(setting_changed)
+def reset_user_cache(setting, **kwargs):
+    global _user_cache
+    if setting.startswith('UCAMWEBAUTH_USER_CACHE_'):
+        _user_cache = None
@@ -1,17 +1,20 @@
 import time
 import calendar
+import threading
 from base64 import b64decode
+from collections import OrderedDict, namedtuple
+from datetime import date
 try:
     from urlparse import parse_qs
-    from urllib import unquote
+    from urllib import unquote, urlencode
 except ImportError:
-    from urllib.parse import parse_qs, unquote
+    from urllib.parse import parse_qs, unquote, urlencode
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.http import HttpResponseRedirect
-try:
-    from django.urls import reverse
-except ImportError:
-    from django.core.urlresolvers import reverse
+from django.urls import get_script_prefix, get_urlconf, reverse
+from ucamwebauth.conf import get_settings
 from ucamwebauth.exceptions import MalformedResponseError
 
 
@@ -31,20 +34,65 @@ def setting(name, default=None):
     return getattr(settings, name, default)
 
 
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
 def parse_time(time_string):
     """Converts a time of the form '20110729T123456Z' to a number of seconds
     since the epoch.
     @exception ValueError if the time is not a valid Raven time"""
+    # Fast path for the canonical form, which is the only one the WLS produces. Anything else goes through strptime,
+    # so exactly the same strings are accepted either way.
+    if len(time_string) == 16 and time_string.isascii() and time_string[8] in 'Tt' and time_string[15] in 'Zz' \
+            and time_string[:8].isdigit() and time_string[9:15].isdigit():
+        hour = int(time_string[9:11])
+        minute = int(time_string[11:13])
+        second = int(time_string[13:15])
+        if hour > 23 or minute > 59 or second > 61:
+            raise ValueError("time data %r does not match format '%%Y%%m%%dT%%H%%M%%SZ'" % time_string)
+        # date() validates the year, month and day of the month like strptime does
+        days = date(int(time_string[:4]), int(time_string[4:6]), int(time_string[6:8])).toordinal() - _EPOCH_ORDINAL
+        return ((days * 24 + hour) * 60 + minute) * 60 + second
     return calendar.timegm(time.strptime(time_string, "%Y%m%dT%H%M%SZ"))
 
 
+def tokenize_response(response_str):
+    """Splits a WLS response into its fields, which are separated by '!' and %-encoded.
+    The version and the number of fields are checked before anything else is decoded, and only the fields that contain
+    a '%' are decoded.
+    @param response_str  The WLS response
+    @return a (ver, tokens, data) tuple: the protocol version, the list of decoded fields (14 for version 3, 13
+    otherwise) and the signed data, i.e. the response up to (not including) the '!' before 'kid', as bytes
+    @exception MalformedResponseError if the version is not supported or the number of fields is wrong"""
+    rawtokens = response_str.split('!')
+    token = rawtokens[0]
+    if '%' in token:
+        token = unquote(token)
+    try:
+        ver = int(token)
+    except ValueError:
+        raise MalformedResponseError("Version number must be an integer, not %s" % token)
+    if not 4 > ver > 0:
+        raise MalformedResponseError("Unsupported version: %d" % ver)
+
+    expected = 14 if ver == 3 else 13
+    if len(rawtokens) != expected:
+        raise MalformedResponseError("Wrong number of parameters in response: expected %d, got %d" %
+                                     (expected, len(rawtokens)))
+
+    tokens = [unquote(token) if '%' in token else token for token in rawtokens]
+    raw = response_str.encode()
+    data = raw[:raw.rfind(b'!', 0, raw.rfind(b'!'))]
+    return ver, tokens, data
+
+
 def get_next_from_wls_response(response_str):
     """ Returns the value of the variable 'next' inside the parameter 'params' of the response
     :param response_str: The WLS response
     :return: the value of the 'next' variable
     """
-    tokens = list(map(unquote, response_str.split('!')))
-    params = parse_qs(tokens[11]) if tokens[0] == '3' else parse_qs(tokens[10])
+    ver, tokens, data = tokenize_response(response_str)
+    params = parse_qs(tokens[11]) if ver == 3 else parse_qs(tokens[10])
     if 'next' in params:
         return params['next'][0]
     else:
@@ -55,11 +103,127 @@ def get_return_url(request):
     """Generate the return URL for a particular request (either a request
     that needs to be authenticated, or one that contains a purported
     authentication response)."""
-    return setting('UCAMWEBAUTH_RETURN_URL',
-                   default=request.build_absolute_uri(reverse('raven_return')))
+    return get_login_urls(request).return_url
+
+
+def reverse_path_info(viewname):
+    """Returns the path of the view viewname as it appears in request.path_info, i.e. without the script prefix"""
+    path = reverse(viewname)
+    prefix = get_script_prefix()
+    if path.startswith(prefix):
+        path = '/' + path[len(prefix):]
+    return path
 
 
 class HttpResponseSeeOther(HttpResponseRedirect):
     """An HttpResponse with a 303 status code, since django doesn't provide one
     by default.  A 303 is required by the the WAA2WLS specification."""
     status_code = 303
+
+
+class TTLCache(object):
+    """A thread-safe, in-process LRU cache whose entries also expire after a timeout.
+    It never holds more than maxsize entries: when full, the least recently used entry is evicted."""
+
+    def __init__(self, maxsize=1024, timeout=None):
+        """@param maxsize  The maximum number of entries
+        @param timeout  The default lifetime of an entry in seconds, or None for entries that do not expire"""
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expiry(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        return None if timeout is None else time.time() + timeout
+
+    def _get(self, key, now):
+        # Must be called with the lock held. Returns the (expiry, value) entry for key or None.
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= now:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def _set(self, key, value, expiry, now):
+        # Must be called with the lock held
+        self._data[key] = (expiry, value)
+        self._data.move_to_end(key)
+        # Entries mostly expire in the order they were inserted, so expired entries are found at the front
+        while self._data:
+            oldest = next(iter(self._data.values()))
+            if oldest[0] is None or oldest[0] > now:
+                break
+            self._data.popitem(last=False)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._get(key, time.time())
+        return default if entry is None else entry[1]
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value, self._expiry(timeout), time.time())
+
+    def add(self, key, value, timeout=None):
+        """Sets key only if it is not already present (and not expired).
+        @return True if the value was stored"""
+        with self._lock:
+            now = time.time()
+            if self._get(key, now) is not None:
+                return False
+            self._set(key, value, self._expiry(timeout), now)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._get(key, time.time()) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+LoginURLs = namedtuple('LoginURLs', 'return_url head tail')
+LoginURLs.__doc__ = """The URLs that only depend on the host a request was sent to: the return URL, and the WLS
+authenticate URL up to (head) and after (tail) the params, which are the only part that depends on the request."""
+
+# Keyed by (scheme, host, script prefix, urlconf). Hosts are checked against ALLOWED_HOSTS before they are cached, but
+# the cache is bounded in case any host is allowed.
+_login_urls = TTLCache(maxsize=256)
+
+
+def get_login_urls(request):
+    """Returns the LoginURLs for the scheme and host of request, which are cached until the settings change."""
+    key = (request.scheme, request.get_host(), get_script_prefix(), get_urlconf())
+    urls = _login_urls.get(key)
+    if urls is None:
+        config = get_settings()
+        return_url = config.return_url
+        if return_url is None:
+            return_url = request.build_absolute_uri(reverse('raven_return'))
+        # aauth is ignored as v3 only supports 'pwd', therefore we do not need it.
+        head = "%s?%s" % (config.login_url, urlencode([('ver', 3), ('url', return_url), ('desc', config.desc),
+                                                       ('iact', config.iact), ('msg', config.msg)]))
+        urls = LoginURLs(return_url, head, urlencode([('fail', config.fail)]))
+        _login_urls.set(key, urls)
+    return urls
+
+
+@receiver(setting_changed)
+def clear_login_urls(setting, **kwargs):
+    if setting.startswith('UCAMWEBAUTH_') or setting in ('ROOT_URLCONF', 'FORCE_SCRIPT_NAME'):
+        _login_urls.clear()
@@ -0,0 +1,159 @@
+"""Verification of the RSA signatures of WLS responses (PKCS #1 v1.5 with SHA-1).
+
+UCAMWEBAUTH_VERIFIER names the verifier class used by RavenResponse:
+
+- ucamwebauth.verifiers.PyOpenSSLVerifier (the default) uses OpenSSL.crypto.verify, which pyOpenSSL has deprecated.
+- ucamwebauth.verifiers.CryptographyVerifier uses the public keys of the certificates, loaded once, with cryptography.
+- ucamwebauth.verifiers.ShadowVerifier runs both: the pyOpenSSL result is used, and the time each took and whether
+  their results differed are recorded, to check that cryptography can be switched to safely.
+
+The key registry (ucamwebauth.keys) keeps the certificates as loaded by the verifier, so changing UCAMWEBAUTH_VERIFIER
+reloads them.
+"""
+import logging
+import threading
+import time
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from ucamwebauth import metrics
+from ucamwebauth.conf import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+class BaseVerifier(object):
+    """Base class for signature verifiers."""
+
+    def load_key(self, pem):
+        """Parses a PEM certificate into the key passed to verify
+        @exception Exception if the certificate is malformed"""
+        raise NotImplementedError
+
+    def verify(self, key, signature, data):
+        """Returns True if signature is a valid signature of the bytes data by key"""
+        raise NotImplementedError
+
+
+class PyOpenSSLVerifier(BaseVerifier):
+
+    def load_key(self, pem):
+        from OpenSSL.crypto import FILETYPE_PEM, load_certificate
+        return load_certificate(FILETYPE_PEM, pem)
+
+    def verify(self, key, signature, data):
+        from OpenSSL.crypto import Error, verify
+        try:
+            verify(key, signature, data, 'sha1')
+        except Error:
+            return False
+        return True
+
+
+class CryptographyVerifier(BaseVerifier):
+
+    def __init__(self):
+        from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+        from cryptography.hazmat.primitives.hashes import SHA1
+        self._padding = PKCS1v15()
+        self._algorithm = SHA1()
+
+    def load_key(self, pem):
+        from cryptography.x509 import load_pem_x509_certificate
+        if isinstance(pem, str):
+            pem = pem.encode()
+        return load_pem_x509_certificate(pem).public_key()
+
+    def verify(self, key, signature, data):
+        from cryptography.exceptions import InvalidSignature
+        try:
+            key.verify(signature, data, self._padding, self._algorithm)
+        except InvalidSignature:
+            return False
+        return True
+
+
+class ShadowVerifier(BaseVerifier):
+    """Verifies every signature with both primary and shadow, and returns the result of primary. Errors in shadow are
+    logged and counted as mismatches, but never fail the verification. With UCAMWEBAUTH_METRICS, every comparison is
+    also recorded as a 'shadow_verify' counter labelled 'match' or 'mismatch'."""
+
+    def __init__(self, primary=None, shadow=None):
+        self.primary = primary or PyOpenSSLVerifier()
+        self.shadow = shadow or CryptographyVerifier()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = self.mismatches = 0
+            self.primary_seconds = self.shadow_seconds = 0.0
+
+    def load_key(self, pem):
+        try:
+            shadow_key = self.shadow.load_key(pem)
+        except Exception as e:
+            logger.warning("%s could not load a certificate: %s" % (type(self.shadow).__name__, e))
+            shadow_key = None
+        return self.primary.load_key(pem), shadow_key
+
+    def verify(self, key, signature, data):
+        primary_key, shadow_key = key
+        start = time.perf_counter()
+        result = self.primary.verify(primary_key, signature, data)
+        middle = time.perf_counter()
+        try:
+            shadow_result = None if shadow_key is None else self.shadow.verify(shadow_key, signature, data)
+        except Exception as e:
+            logger.warning("%s failed: %s" % (type(self.shadow).__name__, e))
+            shadow_result = None
+        end = time.perf_counter()
+        mismatch = shadow_result != result
+        with self._lock:
+            self.calls += 1
+            self.mismatches += mismatch
+            self.primary_seconds += middle - start
+            self.shadow_seconds += end - middle
+        if mismatch:
+            logger.warning("Signature verification mismatch: %s returned %s, %s returned %s" %
+                           (type(self.primary).__name__, result, type(self.shadow).__name__, shadow_result))
+        metrics.incr('shadow_verify', 'mismatch' if mismatch else 'match')
+        return result
+
+    def stats(self):
+        """Returns a dictionary with the number of verifications, of mismatches, and the mean time (in seconds) of a
+        verification by each of the verifiers"""
+        with self._lock:
+            calls = self.calls
+            return {'calls': calls, 'mismatches': self.mismatches,
+                    'primary_mean': self.primary_seconds / calls if calls else None,
+                    'shadow_mean': self.shadow_seconds / calls if calls else None}
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_verifier():
+    """Returns the verifier configured in UCAMWEBAUTH_VERIFIER"""
+    global _verifier
+    verifier = _verifier
+    if verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                path = get_settings().verifier
+                try:
+                    _verifier = import_string(path)()
+                except ImportError as e:
+                    raise ImproperlyConfigured("UCAMWEBAUTH_VERIFIER is not a valid verifier: %s" % e)
+            verifier = _verifier
+    return verifier
+
+
+@receiver(setting_changed)
+def reset_verifier(setting, **kwargs):
+    global _verifier
+    if setting == 'UCAMWEBAUTH_VERIFIER':
+        with _verifier_lock:
+            _verifier = None
@@ -1,32 +1,109 @@
-from django.http import HttpResponseRedirect
+import inspect
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
 from django.contrib.auth import authenticate, login, logout
+from django.contrib.auth.signals import user_login_failed
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponseRedirect
 from django.shortcuts import redirect
 try:
     from urllib import urlencode
     from urlparse import urlparse
 except ImportError:
     from urllib.parse import urlencode, urlparse
-from ucamwebauth import MalformedResponseError
-from ucamwebauth.utils import setting, HttpResponseSeeOther, get_next_from_wls_response, get_return_url
+from ucamwebauth import MalformedResponseError, metrics
+from ucamwebauth.conf import get_settings
+from ucamwebauth.principal import RavenPrincipal, login_principal
+from ucamwebauth.utils import HttpResponseSeeOther, get_login_urls, get_next_from_wls_response
 
 
 def raven_return(request):
+    total = metrics.timer()
     try:
-        token = request.GET['WLS-Response']
-    except KeyError:
-        raise MalformedResponseError("no WLS-Response")
+        token = _get_wls_response(request)
+        # See if this is a valid token
+        user = authenticate(request=request)
+    except Exception as e:
+        metrics.incr('outcome', type(e).__name__)
+        raise
+
+    config = get_settings()
+    if user is None:
+        metrics.incr('outcome', 'rejected')
+        return redirect(config.logout_redirect)
+    else:
+        timer = metrics.timer()
+        _login(request, user)
+        limit_session_expiry(request)
+        timer.lap('login')
+
+    response = _redirect_after_login(request, token)
+    metrics.incr('outcome', 'success')
+    total.lap('total')
+    return response
+
 
-    # See if this is a valid token
-    user = authenticate(request=request)
+async def araven_return(request):
+    """The async version of raven_return, for ASGI deployments (see ucamwebauth.async_urls)"""
+    total = metrics.timer()
+    try:
+        token = _get_wls_response(request)
+        user = await _aauthenticate(request)
+    except Exception as e:
+        metrics.incr('outcome', type(e).__name__)
+        raise
 
     if user is None:
-        return redirect(setting('UCAMWEBAUTH_LOGOUT_REDIRECT', default='/'))
+        metrics.incr('outcome', 'rejected')
+        return redirect(get_settings().logout_redirect)
     else:
-        login(request, user)
+        timer = metrics.timer()
+        await _alogin(request, user)
+        limit_session_expiry(request)
+        timer.lap('login')
+
+    response = _redirect_after_login(request, token)
+    metrics.incr('outcome', 'success')
+    total.lap('total')
+    return response
+
+
+def limit_session_expiry(request):
+    """Caps the expiry of the session at the remaining life of the user's WLS session (RavenResponse.life), bounded by
+    UCAMWEBAUTH_SESSION_LIFE_MIN and UCAMWEBAUTH_SESSION_LIFE_MAX, unless UCAMWEBAUTH_SESSION_LIFE is False. The
+    expiry is never made longer than SESSION_COOKIE_AGE, and is left alone with SESSION_EXPIRE_AT_BROWSER_CLOSE, which
+    set_expiry() would override with a persistent cookie."""
+    config = get_settings()
+    response = getattr(request, 'raven_response', None)
+    if not config.session_life or response is None or settings.SESSION_EXPIRE_AT_BROWSER_CLOSE:
+        return
+    expiry = response.life
+    if expiry is not None:
+        # At least a second: set_expiry(0) would make the session last until the browser is closed
+        expiry = max(expiry, config.session_life_min or 1)
+    if config.session_life_max is not None:
+        expiry = config.session_life_max if expiry is None else min(expiry, config.session_life_max)
+    if expiry is not None and expiry < settings.SESSION_COOKIE_AGE:
+        request.session.set_expiry(expiry)
+
+
+def _get_wls_response(request):
+    try:
+        return request.GET['WLS-Response']
+    except KeyError:
+        raise MalformedResponseError("no WLS-Response")
+
 
+def _redirect_after_login(request, token):
     # Redirect somewhere sensible
 
-    redirect_url = get_next_from_wls_response(token)
+    # The response has already been parsed by RavenAuthBackend, unless another backend authenticated the user
+    response = getattr(request, 'raven_response', None)
+    if response is not None:
+        redirect_url = response.params.get('next', [None])[0]
+    else:
+        redirect_url = get_next_from_wls_response(token)
 
     # Validate redirect_url is relative path or matches host
     if redirect_url is not None:
@@ -37,30 +114,71 @@ def raven_return(request):
     if redirect_url is not None:
         return HttpResponseRedirect(redirect_url)
     else:
-        return HttpResponseRedirect(setting('UCAMWEBAUTH_REDIRECT_AFTER_LOGIN', default='/'))
+        return HttpResponseRedirect(get_settings().redirect_after_login)
+
+
+async def _aauthenticate(request):
+    """Like authenticate(request=request), but awaits the aauthenticate method of the backends that have one (such as
+    RavenAuthBackend) and runs the others in a thread."""
+    # get_backends() returns the backends of AUTHENTICATION_BACKENDS, in order
+    for backend, backend_path in zip(auth.get_backends(), settings.AUTHENTICATION_BACKENDS):
+        method = getattr(backend, 'aauthenticate', None)
+        if method is None:
+            method = sync_to_async(backend.authenticate)
+        try:
+            inspect.signature(method).bind(request)
+        except TypeError:
+            # This backend doesn't accept these credentials as arguments. Try the next one.
+            continue
+        try:
+            user = await method(request)
+        except PermissionDenied:
+            # This backend says to stop in our tracks - this user should not be allowed in at all.
+            break
+        if user is None:
+            continue
+        user.backend = backend_path
+        return user
+    await sync_to_async(user_login_failed.send)(sender=__name__, credentials={}, request=request)
+
+
+def _login(request, user):
+    if isinstance(user, RavenPrincipal):
+        login_principal(request, user)
+    else:
+        login(request, user)
+
+
+async def _alogin(request, user):
+    if isinstance(user, RavenPrincipal):
+        # Cycling the session key may use the database
+        await sync_to_async(login_principal)(request, user)
+    else:
+        # The session is cycled synchronously
+        await sync_to_async(login)(request, user)
 
 
 def raven_login(request):
-    # Get the Raven object and return a redirect to the Raven server
-    login_url = setting('UCAMWEBAUTH_LOGIN_URL')
-    return_url = get_return_url(request)
-    desc = setting('UCAMWEBAUTH_DESC', default='')
-    # aauth is ignored as v3 only supports 'pwd', therefore we do not need it.
-    iact = setting('UCAMWEBAUTH_IACT', default='')
-    msg = setting('UCAMWEBAUTH_MSG', default='')
-    fail = setting('UCAMWEBAUTH_FAIL', default='')
+    # Return a redirect to the Raven server. Only the params depend on the request: the rest of the URL is cached.
+    urls = get_login_urls(request)
     next_p = request.GET.get('next', None)
     if next_p is not None:
-        params = urlencode([('next', next_p)])
-        msg = urlencode([('ver', 3), ('url', return_url), ('desc', desc), ('iact', iact), ('msg', msg),
-                         ('params', params), ('fail', fail)])
-    else:
-        msg = urlencode([('ver', 3), ('url', return_url), ('desc', desc), ('iact', iact), ('msg', msg),
-                         ('fail', fail)])
-
-    return HttpResponseSeeOther("%s?%s" % (login_url, msg))
+        params = urlencode([('params', urlencode([('next', next_p)]))])
+        return HttpResponseSeeOther("%s&%s&%s" % (urls.head, params, urls.tail))
+    return HttpResponseSeeOther("%s&%s" % (urls.head, urls.tail))
 
 
 def raven_logout(request):
     logout(request)
-    return redirect(setting('UCAMWEBAUTH_LOGOUT_REDIRECT', default='/'))
+    return redirect(get_settings().logout_redirect)
+
+
+async def araven_login(request):
+    """The async version of raven_login. Building the redirect does no I/O, so this simply calls raven_login."""
+    return raven_login(request)
+
+
+async def araven_logout(request):
+    """The async version of raven_logout"""
+    await sync_to_async(logout)(request)
+    return redirect(get_settings().logout_redirect)
@@ -0,0 +1,218 @@
+"""Write-behind updates of User.last_login and UserProfile.raven_for_life.
+
+Every login updates last_login (django.contrib.auth.models.update_last_login, a user_logged_in receiver) and, when it
+changed, raven_for_life (RavenAuthBackend.update_profile): under bursts of logins these single-row UPDATEs contend for
+the same tables. When UCAMWEBAUTH_WRITE_BEHIND is True, they are kept in an in-process buffer instead, where several
+updates of the same user coalesce into one, and written in batches by a background thread: with bulk_update for
+last_login and one UPDATE per value for raven_for_life. A batch is written as soon as UCAMWEBAUTH_WRITE_BEHIND_BATCH_SIZE
+users have pending updates, and at least every UCAMWEBAUTH_WRITE_BEHIND_INTERVAL seconds, which bounds how long the
+database lags behind. Pending updates are also written when the process exits (atexit), and can be written at any time
+with flush().
+
+Updates that fail to be written are kept (unless a newer one replaced them) and retried with the next batch. At most
+UCAMWEBAUTH_WRITE_BEHIND_MAX_PENDING users have pending updates: once that many do, the request that adds an update
+writes the buffer itself, so logins slow down to the pace of the database instead of the lag growing, and when a batch
+fails the oldest updates beyond the limit are dropped (last_login before raven_for_life) and counted in the
+'write_behind' metric as 'dropped'. Updates still pending when a process is killed, rather than exiting, are lost. Only
+new profiles are created immediately: the user's profile must exist once they are logged in.
+
+Until its batch is written, a change of raven_for_life is only seen by the request that logged the user in: other
+requests, and the users cached by ucamwebauth.usercache (invalidated when the batch is written, since invalidating
+them earlier would only reload the previous value), see the previous one for up to UCAMWEBAUTH_WRITE_BEHIND_INTERVAL
+seconds.
+"""
+import atexit
+import logging
+import os
+import threading
+from itertools import islice
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import update_last_login as auth_update_last_login
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.utils import timezone
+from ucamwebauth import metrics
+from ucamwebauth.conf import get_settings
+from ucamwebauth.usercache import invalidate_user
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer(object):
+    """Buffers the updates of last_login and raven_for_life, see the module documentation.
+    @param interval The maximum number of seconds between two batches
+    @param batch_size The number of users with pending updates that triggers a batch
+    @param max_pending The number of users with pending updates from which they are written by the caller"""
+
+    def __init__(self, interval=5, batch_size=500, max_pending=10000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        # user id -> value
+        self._last_login = {}
+        self._raven_for_life = {}
+        self._lock = threading.Lock()
+        # Only one batch is written at a time
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._last_login) + len(self._raven_for_life)
+
+    def add_last_login(self, user_id, last_login):
+        self._add(self._last_login, user_id, last_login)
+
+    def add_raven_for_life(self, user_id, raven_for_life):
+        self._add(self._raven_for_life, user_id, raven_for_life)
+
+    def _add(self, pending, user_id, value):
+        with self._lock:
+            pending[user_id] = value
+            size = len(self._last_login) + len(self._raven_for_life)
+            # Also restarts a thread that died
+            if (self._thread is None or not self._thread.is_alive()) and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name='ucamwebauth-write-behind', daemon=True)
+                self._thread.start()
+        if size >= self.max_pending:
+            # The thread does not keep up, or the database is down
+            self.flush()
+        elif size >= self.batch_size:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                # Like the request handlers, do not keep a connection beyond CONN_MAX_AGE or after an error
+                close_old_connections()
+            except Exception:
+                logger.exception("The write-behind thread failed")
+
+    def flush(self):
+        """Writes the pending updates
+        @return the number of users whose updates were written"""
+        with self._flush_lock:
+            with self._lock:
+                last_login, self._last_login = self._last_login, {}
+                raven_for_life, self._raven_for_life = self._raven_for_life, {}
+            if not last_login and not raven_for_life:
+                return 0
+            try:
+                self.write(last_login, raven_for_life)
+            except Exception:
+                logger.exception("Could not write the last_login of %d users and the raven_for_life of %d users" %
+                                 (len(last_login), len(raven_for_life)))
+                metrics.incr('write_behind', 'error')
+                with self._lock:
+                    # The failed updates are older than the pending ones, which replace them
+                    last_login.update(self._last_login)
+                    raven_for_life.update(self._raven_for_life)
+                    self._last_login, self._raven_for_life = last_login, raven_for_life
+                    self._drop_oldest()
+                return 0
+            return len(last_login) + len(raven_for_life)
+
+    def _drop_oldest(self):
+        """Drops the oldest updates beyond max_pending, those of last_login first. Must be called with the lock held."""
+        excess = len(self._last_login) + len(self._raven_for_life) - self.max_pending
+        if excess <= 0:
+            return
+        logger.warning("Dropped the oldest %d write-behind updates" % excess)
+        metrics.incr('write_behind', 'dropped', excess)
+        for pending in (self._last_login, self._raven_for_life):
+            # Dictionaries keep the order of insertion
+            dropped = list(islice(pending, excess))
+            for user_id in dropped:
+                del pending[user_id]
+            excess -= len(dropped)
+
+    def write(self, last_login, raven_for_life):
+        """Writes a batch of updates, each a dictionary mapping user ids to values"""
+        from ucamwebauth.models import UserProfile
+        if last_login:
+            UserModel = get_user_model()
+            UserModel._default_manager.bulk_update([UserModel(pk=user_id, last_login=value)
+                                                    for user_id, value in last_login.items()],
+                                                   ['last_login'], batch_size=self.batch_size)
+            metrics.incr('write_behind', 'last_login', len(last_login))
+        if raven_for_life:
+            for value in (True, False):
+                user_ids = [user_id for user_id, user_value in raven_for_life.items() if user_value is value]
+                if user_ids:
+                    UserProfile.objects.filter(user__in=user_ids).update(raven_for_life=value)
+            # update() does not send post_save, which would invalidate the cached users
+            for user_id in raven_for_life:
+                invalidate_user(user_id)
+            metrics.incr('write_behind', 'raven_for_life', len(raven_for_life))
+
+    def stop(self):
+        """Stops the background thread and writes the pending updates"""
+        self._stopped = True
+        # Before waking the thread, so that the updates are written by the caller
+        self.flush()
+        self._wake.set()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_write_behind_buffer():
+    """Returns the WriteBehindBuffer of the process, or None if UCAMWEBAUTH_WRITE_BEHIND is False"""
+    global _buffer
+    config = get_settings()
+    if not config.write_behind:
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = WriteBehindBuffer(config.write_behind_interval, config.write_behind_batch_size,
+                                        config.write_behind_max_pending)
+        return _buffer
+
+
+def flush():
+    """Writes the pending updates of the process, if any
+    @return the number of users whose updates were written"""
+    buffer = _buffer
+    return 0 if buffer is None else buffer.flush()
+
+
+def update_last_login(sender, user, **kwargs):
+    """Replaces django.contrib.auth.models.update_last_login as the user_logged_in receiver, see the module
+    documentation"""
+    buffer = get_write_behind_buffer()
+    if buffer is None:
+        auth_update_last_login(sender, user, **kwargs)
+        return
+    user.last_login = timezone.now()
+    buffer.add_last_login(user.pk, user.last_login)
+
+
+atexit.register(flush)
+
+
+def _reset_buffer():
+    global _buffer, _buffer_lock
+    # The parent process writes its pending updates, and the thread does not exist in the child
+    _buffer = None
+    _buffer_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_buffer)
+
+
+@receiver(setting_changed)
+def reset_write_behind_buffer(setting, **kwargs):
+    global _buffer
+    if setting.startswith('UCAMWEBAUTH_WRITE_BEHIND'):
+        with _buffer_lock:
+            buffer, _buffer = _buffer, None
+        if buffer is not None:
+            buffer.stop()